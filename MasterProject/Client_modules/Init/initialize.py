@@ -14,6 +14,7 @@ needs to be adjusted to reflect the individual setup
 ### import relevent libraries
 from MasterProject.Client_modules.CoreLib.socProxy import makeProxy
 from MasterProject.Client_modules.PythonDrivers.YOKOGS200 import YOKOGS200
+from MasterProject.Client_modules.PythonDrivers.control_atten import setatten, setattens
 import os
 import pyvisa as visa
 from pathlib import Path
@@ -29,6 +30,7 @@ else:
 
 
 #### define a attenuator class to change define attenuators for the setup
+#### the devices are opened once by the AttenuatorManager in control_atten, setting the value it already has does nothing
 class attenuator:
     def __init__(self, serialNum, attenuation_int= 50, print_int = True):
         self.serialNum = serialNum
@@ -39,6 +41,12 @@ class attenuator:
         self.attenuation = attenuation
         setatten(attenu = attenuation, serial = self.serialNum, printv = printOut)
 
+#### set several attenuators in one call, e.g. SetAttenuations({Atten: 30, Atten2: 10})
+def SetAttenuations(attenuations, printOut = False):
+    for atten, attenuation in attenuations.items():
+        atten.attenuation = attenuation
+    setattens({atten.serialNum: attenuation for atten, attenuation in attenuations.items()}, printv = printOut)
+
 # ##### define the varible attenuators
 # Atten_address = 27797
 # Atten = attenuator(Atten_address)
@@ -1,26 +1,137 @@
+import json
+import queue
+import threading
+
+import h5py
+import numpy as np
 from PyQt5.QtCore import QObject, pyqtSignal
 
 from qick import AveragerProgram, RAveragerProgram
 
 
+class RunningStats:
+    """
+    Online (Welford) mean and variance of arrays that come in one set at a time, no earlier set is kept.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+
+    def add(self, value):
+        value = np.asarray(value, dtype = np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = value.copy()
+            self._m2 = np.zeros_like(self.mean)
+            return
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        """ sample variance over the sets, nan until there are two sets """
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self._m2 / (self.count - 1)
+
+
+class DataWriter(threading.Thread):
+    """
+    Writes the sets of an experiment to one h5 file that stays open for the whole run. The file and the config
+    json are written on this thread, the caller only puts arrays on a queue.
+    Every set is appended to the '<key>_sets' datasets, and the running mean ('<key>') and variance ('<key>_var')
+    are overwritten in place.
+    """
+    def __init__(self, data_filename, config_filename = None, config = None):
+        super().__init__(daemon = True)
+        self.data_filename = data_filename
+        self.config_filename = config_filename
+        self.config = config
+        self.jobs = queue.Queue()
+        self.error = None
+
+    def write_set(self, x_pts, set_num, sets, stats):
+        """ queue one set. sets: {key: array of this set}, stats: {key: RunningStats} """
+        self.jobs.put((np.array(x_pts), set_num,
+                       {key: np.array(val) for key, val in sets.items()},
+                       {key: (val.mean.copy(), val.variance) for key, val in stats.items()}))
+
+    def close(self):
+        """ write everything that is still queued and close the file """
+        self.jobs.put(None)
+        self.join()
+
+    def run(self):
+        try:
+            if self.config_filename is not None:
+                with open(self.config_filename, 'w') as config_file:
+                    json.dump(self.config, config_file, default = _json_default)
+
+            with h5py.File(self.data_filename, 'w') as data_file:
+                while True:
+                    job = self.jobs.get()
+                    if job is None:
+                        return
+                    self._write(data_file, *job)
+        except Exception as e:
+            self.error = e
+            print('DataWriter error: ' + str(e))
+
+    def _write(self, data_file, x_pts, set_num, sets, stats):
+        if 'x_pts' not in data_file:
+            data_file.create_dataset('x_pts', data = x_pts)
+            data_file.create_dataset('set_num', data = set_num)
+            for key, datum in sets.items():
+                data_file.create_dataset(key + '_sets', shape = (0,) + datum.shape, maxshape = (None,) + datum.shape,
+                                         chunks = (1,) + datum.shape, dtype = np.float64)
+                data_file.create_dataset(key, shape = datum.shape, dtype = np.float64)
+                data_file.create_dataset(key + '_var', shape = datum.shape, dtype = np.float64)
+
+        for key, datum in sets.items():
+            dset = data_file[key + '_sets']
+            dset.resize(dset.shape[0] + 1, axis = 0)
+            dset[-1] = datum
+            data_file[key][...] = stats[key][0]
+            data_file[key + '_var'][...] = stats[key][1]
+        data_file['set_num'][()] = set_num
+        data_file.flush()
+
+
+def _json_default(obj):
+    """ Ensure json dump can handle np arrays """
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(str(type(obj)) + ' is not JSON serializable')
+
+
 class ExperimentThread(QObject):
     """
     This class is used to run an RFSOC experiment, meant to be used on a separate QThread than the main loop.
     The point is that running an RFSOC experiment will take a very long time, and we don't want to lock up the UI while
     that's going on. The intended usage is for an ExterimentThread object to be created, moved to a new QThread, then run.
     It will then communicate with the main program via signals, as intended in Qt, making it thread-safe.
+    The average over the sets is kept here, the GUI only gets the updated average of each set to plot and the data
+    is saved by a DataWriter thread, so neither the averaging nor the disk access runs on the GUI thread.
     """
     finished = pyqtSignal() # Signal to send when done running
     updateData = pyqtSignal(object) # Signal to send when receiving new data, including the new data dictionary
     updateProgress = pyqtSignal(int) # Signal to send when finishing a set to update the setsComplete bar
     RFSOC_error = pyqtSignal(Exception) # Signal to send when the RFSOC encounters an error
 
-    def __init__(self, config, soccfg, exp, soc, parent = None):
+    def __init__(self, config, soccfg, exp, soc, parent = None, data_filename = None, config_filename = None):
         super().__init__(parent)
         self.config = config # The config file used to run the experiment
         self.parent = parent # We don't actually want to give it the parent window, that can cause blocking
         self.experiment_instance = exp # The object representing an instance of a QickProgram subclass to be run
         self.soc = soc # The RFSOC!
+        self.data_filename = data_filename # h5 file the sets are written to, nothing is saved if None
+        self.config_filename = config_filename
 
         # ### create the experiment instance
         # self.experiment_instance = exp(soccfg, self.config)
@@ -34,33 +145,50 @@ class ExperimentThread(QObject):
 
         self.running = True
         idx_set = 0
+        stats = {'avgi': RunningStats(), 'avgq': RunningStats()}
 
-        ### loop over all the sets for the data taking
-        while self.running and idx_set < self.config["sets"]:
-
-            #### check what kind of experiment it is
-            if issubclass(type(self.experiment_instance), AveragerProgram):
-                print("I can't handle AveragerProgram yet!")
-                return
-                ### if Averager class, need to loop over variables
-            elif issubclass(type(self.experiment_instance), RAveragerProgram):
-
-                try:
-                    x_pts, avgi, avgq = self.experiment_instance.acquire(self.soc)
-                except Exception as e:
-                    self.RFSOC_error.emit(e)
-                    self.finished.emit()
-                    return # Do not want to update data -- no new data was recorded!
-                data = {'config': self.config, 'data': {'x_pts': x_pts, 'avgi': avgi, 'avgq': avgq, 'set_num': idx_set}}
-
-            # Emit the signal with new data
-            self.updateData.emit(data)
-            # Update the setsComplete bar
-            self.updateProgress.emit(idx_set + 1)
-            self.finished.emit()
+        writer = None
+        if self.data_filename is not None:
+            writer = DataWriter(self.data_filename, self.config_filename, self.config)
+            writer.start()
 
-            idx_set += 1
+        try:
+            ### loop over all the sets for the data taking
+            while self.running and idx_set < self.config["sets"]:
+
+                #### check what kind of experiment it is
+                if issubclass(type(self.experiment_instance), AveragerProgram):
+                    print("I can't handle AveragerProgram yet!")
+                    return
+                    ### if Averager class, need to loop over variables
+                elif issubclass(type(self.experiment_instance), RAveragerProgram):
+
+                    try:
+                        x_pts, avgi, avgq = self.experiment_instance.acquire(self.soc)
+                    except Exception as e:
+                        self.RFSOC_error.emit(e)
+                        return # Do not want to update data -- no new data was recorded!
+
+                ### fold the set into the running average, then only the new average goes to the GUI
+                stats['avgi'].add(avgi)
+                stats['avgq'].add(avgq)
+                if writer is not None:
+                    writer.write_set(x_pts, idx_set, {'avgi': avgi, 'avgq': avgq}, stats)
+
+                data = {'data': {'x_pts': x_pts, 'avgi': stats['avgi'].mean.copy(), 'avgq': stats['avgq'].mean.copy(),
+                                 'set_num': idx_set}}
+
+                # Emit the signal with new data
+                self.updateData.emit(data)
+                # Update the setsComplete bar
+                self.updateProgress.emit(idx_set + 1)
+
+                idx_set += 1
+        finally:
+            if writer is not None:
+                writer.close()
+            self.finished.emit()
 
     def stop(self):
         self.running = False
-        print("trying to stop the thread...")
\ No newline at end of file
+        print("trying to stop the thread...")
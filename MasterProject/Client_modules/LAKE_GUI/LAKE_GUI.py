@@ -212,7 +212,8 @@ class Window(QMainWindow):
 
         ### create the experiment
         self.experiment = self.experiment_instance(soccfg, self.config)
-        self.worker = ExperimentThread(self.config, soccfg = self.soccfg, exp = self.experiment, soc = self.soc)
+        self.worker = ExperimentThread(self.config, soccfg = self.soccfg, exp = self.experiment, soc = self.soc,
+                                       data_filename = self.data_filename, config_filename = self.config_filename)
         self.worker.moveToThread(self.thread) # Move the ExperimentThread onto the actual QThread from the main loop
         # Step 5: Connect signals and slots
         self.thread.started.connect(self.worker.run)
@@ -232,6 +233,8 @@ class Window(QMainWindow):
         self.thread.finished.connect( # Connect finished signal to a slot with an in-line function to re-enable the button
             lambda: self.runExperimentButton.setEnabled(True)
         )
+        image_filename = self.image_filename
+        self.thread.finished.connect(lambda: self.plotWidget.save_fig(image_filename)) # save the final plot once
 
     def stopExperiment(self):
         print("STOP!!!!")
@@ -287,7 +290,8 @@ class Window(QMainWindow):
     def updateData(self, data):
         """ This function updates the data object of the main window. We have to be careful when doing this with multiple
         threads, because we don't want to corrupt the data. Currently, this is only run by the main window, and thus
-        should be thread-safe even without the mutex. """
+        should be thread-safe even without the mutex. The data holds the running average over the sets so far, the
+        averaging and saving are done by the ExperimentThread. """
         self.dataLock.lock() # Make sure no other thread is messing with the data!
         self.data = data
         self.dataLock.unlock() # Release the lock on the mutex
@@ -295,18 +299,6 @@ class Window(QMainWindow):
         ### check what set number is being run
         set_num = data['data']['set_num']
         print(set_num)
-        if set_num == 0:
-            self.data_cur = data
-        elif set_num > 0:
-            ### average together the data weighting the sets
-            avgi = (self.data_cur['data']['avgi'][0][0]*(set_num) + data['data']['avgi'][0][0])/ (set_num+1)
-            avgq = (self.data_cur['data']['avgq'][0][0] * (set_num) + data['data']['avgq'][0][0]) / (set_num+1)
-
-            self.data_cur['data']['avgi'][0][0] = avgi
-            self.data_cur['data']['avgq'][0][0] = avgq
-
-        self.data['data']['avgi'][0][0] = self.data_cur['data']['avgi'][0][0]
-        self.data['data']['avgq'][0][0] = self.data_cur['data']['avgq'][0][0]
 
         ### create a diction to feed into the plot widget for labels
         plot_labels = {
@@ -319,8 +311,8 @@ class Window(QMainWindow):
             plot_labels["y label 1"] = "I (a.u.)"
             plot_labels["y label 2"] = "Q (a.u.)"
 
+        ### the worker already averaged the sets and its writer thread saves them, only plot here
         self._updateCanvas(data['data']['x_pts'], data['data']['avgi'][0][0], data['data']['avgq'][0][0], plot_labels)
-        self.save_data(data, self.data_filename, self.config_filename, self.image_filename)
 
 
     def updateProgress(self, setsComplete):
@@ -352,7 +344,7 @@ class Window(QMainWindow):
 
 
     def _updateCanvas(self, x, i, q, labels):
-        """ Re-draw the canvas using the provided data. Likely will be changed in the future, including signature. """
+        """ Show the provided data. The plot widget updates its lines in place and limits the redraw rate. """
         self.plotWidget.plot1(x, i, labels)
         self.plotWidget.plot2(x, q, labels)
         self.plotWidget.drawCanvas()
@@ -425,58 +417,6 @@ class Window(QMainWindow):
                         return
         self.experimentNameLabel.setText('<html><b>Experiment: ' + self.experiment_name + "</b></html>")
 
-    def save_data(self, data, data_filename, config_filename, image_filename):
-        """
-        This function saves the data passed to it using the experiment name passed to it.
-        I am currently passing these as arguments so that they get copied and we don't have problems with multiple
-        accesses of the actual class variables, but it may be faster/less memory-intensive to use those instead.
-        Think about this more later.
-        This program saves the data separately from the config. This is due to the difficulties associated with saving
-        Python dictionaries in h5 format, and we can't afford to store the data in plaintext so serialising that way is out.
-        Pickling in Python is also a bad option, since it's not general.
-        :param data: dictionary containing the data (and config) to be saved.
-        :param experiment_name: string containing name of the experiment
-        :return: Nothing
-        """
-
-        # Save data
-        data_file = h5py.File(data_filename, 'w') # Create file if does not exist, truncate mode if exists
-        data_file.flush() # Notsure what the point of flushing buffers is, inherited from old code
-        for key, datum in data['data'].items():
-            datum = np.array(datum)
-            # I don't know what is the error that this is supposed to catch. I am leaving it here for now, and adding a print
-            try:
-                data_file.create_dataset(key, shape=datum.shape,
-                                    maxshape=tuple([None] * len(datum.shape)),
-                                    dtype=str(datum.astype(np.float64).dtype))
-            except RuntimeError as e:
-                print(e)
-                del data_file[key]
-                data_file.create_dataset(key, shape=datum.shape,
-                                    maxshape=tuple([None] * len(datum.shape)),
-                                    dtype=str(datum.astype(np.float64).dtype))
-            data_file[key][...] = datum
-        data_file.close()
-
-        # Save config
-        with open(config_filename, 'w') as config_file:
-            json.dump(data['config'], config_file, cls=Window.NpEncoder), #TODO coul dump config directly from self
-
-        #save image
-        self.plotWidget.save_fig(image_filename)
-
-    class NpEncoder(json.JSONEncoder):
-        """ Ensure json dump can handle np arrays """
-        # I took this code from an old Experiment.py, I have no idea whether it's necessary
-        def default(self, obj):
-            if isinstance(obj, np.integer):
-                return int(obj)
-            if isinstance(obj, np.floating):
-                return float(obj)
-            if isinstance(obj, np.ndarray):
-                return obj.tolist()
-            return super(Window.NpEncoder, self).default(obj)
-
 
 
 app = QApplication(sys.argv)
@@ -1,3 +1,5 @@
+import time
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QWidget, QVBoxLayout
 import matplotlib
 matplotlib.use('GTK4Agg') ### this helps plot faster for sets
@@ -7,8 +9,14 @@ from matplotlib.backends.backend_qtagg import (
 
 
 class PlotWidget(QWidget):
-    """ This class represents a widget that contains the main axes for plotting data, as well as the navigation bar """
-    def __init__(self, parent = None, width = 5, height = 3, dpi = 100):
+    """
+    This class represents a widget that contains the main axes for plotting data, as well as the navigation bar.
+    The lines are made once and only have their data replaced on an update. They are animated artists,
+    so a redraw only restores the cached background (axes, ticks, labels) and blits the data on top of it. A full
+    canvas draw only happens when the axes limits or labels change. Redraws are limited to max_fps, an update that
+    comes in too soon is drawn by a timer once the frame is due.
+    """
+    def __init__(self, parent = None, width = 5, height = 3, dpi = 100, max_fps = 20):
         super().__init__()
 
         # Create two maptlotlib FigureCanvas objects for the top and bottom plots
@@ -29,35 +37,97 @@ class PlotWidget(QWidget):
        # layout.addWidget(toolbar2)
         self.setLayout(layout)
 
+        #### persistent artists for each axes, made on the first plot and reused after that
+        self.artists = {self.ax1: None, self.ax2: None}
+        #### background of the figure without the data, grabbed after every full draw
+        self.background = None
+        self.full_draw_needed = True
+        self.canvas1.mpl_connect('draw_event', self._on_draw)
+
+        #### frame rate limit
+        self.min_interval = 1.0 / max_fps
+        self.last_draw = 0.0
+        self.draw_timer = QTimer(self)
+        self.draw_timer.setSingleShot(True)
+        self.draw_timer.timeout.connect(self._draw_now)
+
     def plot1(self, x, y, labels, clear = True):
         """ Plot the data x, y on axes 1 (the top one). """
-        if clear:
-            self.ax1.clear()
-        self.ax1.plot(x, y)
+        self._plot_line(self.ax1, x, y, clear)
         ### set the plot labels
-        self.ax1.set_xlabel(labels["x label"])
         if labels["y label"] == None:
-            self.ax1.set_ylabel(labels["y label 1"])
+            self._set_labels(self.ax1, labels["x label"], labels["y label 1"])
         else:
-            self.ax1.set_ylabel(labels["y label"])
-
+            self._set_labels(self.ax1, labels["x label"], labels["y label"])
 
     def plot2(self, x, y, labels, clear = True):
         """ Plot the data x, y on axes 2 (the bottom one). """
-        if clear:
-            self.ax2.clear()
-        self.ax2.plot(x, y)
+        self._plot_line(self.ax2, x, y, clear)
         ### set the plot labels
-        self.ax2.set_xlabel(labels["x label"])
         if labels["y label"] == None:
-            self.ax2.set_ylabel(labels["y label 2"])
+            self._set_labels(self.ax2, labels["x label"], labels["y label 2"])
         else:
-            self.ax2.set_ylabel(labels["y label"])
+            self._set_labels(self.ax2, labels["x label"], labels["y label"])
 
     def drawCanvas(self):
-        #### note that using cavas.draw() is a very slow process and this should be changed to improve plotting speed
-        self.canvas1.draw()
-
+        """ Show the latest data, at most max_fps times per second. """
+        wait = self.min_interval - (time.time() - self.last_draw)
+        if wait > 0:
+            ### too soon, the timer draws whatever is the latest data once the frame is due
+            if not self.draw_timer.isActive():
+                self.draw_timer.start(int(wait * 1000) + 1)
+            return
+        self._draw_now()
 
     def save_fig(self, full_path_filename):
-        self.canvas1.figure.savefig(full_path_filename)
\ No newline at end of file
+        self.canvas1.figure.savefig(full_path_filename)
+
+    def _plot_line(self, ax, x, y, clear):
+        line = self.artists[ax]
+        if not clear:
+            ### overlay on what is already there, drawn as part of the background
+            ax.plot(x, y)
+            self.full_draw_needed = True
+        elif line is None:
+            ### first plot
+            ax.clear()
+            line, = ax.plot(x, y, animated = True)
+            self.artists[ax] = line
+            self.full_draw_needed = True
+        else:
+            line.set_data(x, y)
+        self._rescale(ax)
+
+    def _rescale(self, ax):
+        #### the background only has to be redrawn when the data no longer fits the axes
+        lims = (ax.get_xlim(), ax.get_ylim())
+        ax.relim()
+        ax.autoscale_view()
+        if lims != (ax.get_xlim(), ax.get_ylim()):
+            self.full_draw_needed = True
+
+    def _set_labels(self, ax, xlabel, ylabel):
+        if ax.get_xlabel() != xlabel or ax.get_ylabel() != ylabel:
+            ax.set_xlabel(xlabel)
+            ax.set_ylabel(ylabel)
+            self.full_draw_needed = True
+
+    def _on_draw(self, event):
+        #### a full draw (from us, a resize or the toolbar) renders everything but the animated artists
+        self.background = self.canvas1.copy_from_bbox(self.canvas1.figure.bbox)
+        self._blit_artists()
+
+    def _draw_now(self):
+        self.last_draw = time.time()
+        if self.full_draw_needed or self.background is None:
+            self.full_draw_needed = False
+            self.canvas1.draw() ### _on_draw takes the new background and blits the data
+        else:
+            self.canvas1.restore_region(self.background)
+            self._blit_artists()
+
+    def _blit_artists(self):
+        for ax, artist in self.artists.items():
+            if artist is not None:
+                ax.draw_artist(artist)
+        self.canvas1.blit(self.canvas1.figure.bbox)
@@ -1,92 +1,227 @@
 import sys
+import time
+import atexit
 from ctypes import *
 from distutils.util import strtobool
 import os
 
-os.add_dll_directory(os.getcwd())
+if hasattr(os, 'add_dll_directory'):
+    os.add_dll_directory(os.getcwd())
 
-def setatten(attenu, serial, printv):
-    if printv == True:
-        print("Setting attenuation")
-    vnx = cdll.VNX_atten64
-    vnx.fnLDA_SetTestMode(False)
 
-    DeviceIDArray = c_int * 20
-    Devices = DeviceIDArray()
+class AttenuatorManager:
+    """
+    Keeps the VNX library loaded and every LDA attenuator open, so setting an attenuation is a single library call.
+    The devices are enumerated once and kept in a serial number -> device handle map. The last value written to each
+    device is cached and a write with the same value is skipped.
+    The devices are closed by close(), at the end of a with block, or when the interpreter exits.
+        with AttenuatorManager() as manager:
+            manager.set(27786, 30)
+    lib: the VNX library, or a MockVNXLibrary to run without the hardware (e.g. on Linux)
+    """
+    step = 0.05 # dB, resolution of SetAttenuationHR
 
-    # GetNumDevices will determine how many LDA devices are availible
-    numDevices = vnx.fnLDA_GetNumDevices()
-    if printv == True:
-        print(str(numDevices), ' device(s) found')
+    def __init__(self, lib=None):
+        self.lib = lib
+        self.handles = {} # serial number -> device id
+        self.values = {} # serial number -> last attenuation written, in units of step
+        self._atexit = False # close is registered to run at exit
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
-    # GetDevInfo generates a list, stored in the devices array, of
-    # every availible LDA device attached to the system
-    # GetDevInfo will return the number of device handles in the array
-    dev_info = vnx.fnLDA_GetDevInfo(Devices)
-    #print('GetDevInfo returned', str(dev_info))
+    def open(self, printv=False):
+        if self.lib is None:
+            self.lib = cdll.VNX_atten64
+        if not self._atexit:
+            # release the devices even if a script never calls close
+            atexit.register(self.close)
+            self._atexit = True
+        self.lib.fnLDA_SetTestMode(False)
 
-    for i in range(0,5):
-        # GetSerialNumber will return the devices serial number
-        ser_num_i = vnx.fnLDA_GetSerialNumber(Devices[i])
+        DeviceIDArray = c_int * 20
+        Devices = DeviceIDArray()
+
+        # GetNumDevices will determine how many LDA devices are availible
+        numDevices = self.lib.fnLDA_GetNumDevices()
         if printv == True:
-            print('Device ' + str(i) + ' Serial number:', str(ser_num_i))
-        if ser_num_i == serial:
+            print(str(numDevices), ' device(s) found')
+
+        # GetDevInfo generates a list, stored in the devices array, of
+        # every availible LDA device attached to the system
+        self.lib.fnLDA_GetDevInfo(Devices)
+
+        for i in range(numDevices):
+            # GetSerialNumber will return the devices serial number
+            ser_num_i = self.lib.fnLDA_GetSerialNumber(Devices[i])
             if printv == True:
-                print('Device was found to be device ' + str(i))
+                print('Device ' + str(i) + ' Serial number:', str(ser_num_i))
+            if ser_num_i in self.handles:
+                continue
             # InitDevice wil prepare the device for operation
-            init_dev = vnx.fnLDA_InitDevice(Devices[i])
-            #print('InitDevice returned', str(init_dev))
-
-            #### Device 0 ####
-            # GetNumChannels will return the number of channels on the device
-            num_channels = vnx.fnLDA_GetNumChannels(Devices[i]);
-            if num_channels < 1:
-                num_channels = 1
-
-            #print("Num channels = %d" %num_channels)
-            # Input desired attenuation level for channel 1
-            #print('Set attenuation level for channel 1 of device')
-            #atten = float(input(': '))
-            atten = float(attenu)
-            attenuation = atten / .05
-            atten = round(attenuation)
-
-            # Select channel 1
-            channel_1 = vnx.fnLDA_SetChannel(Devices[i], 1)
-            if channel_1 != 0:
-                if printv == True:
-                    print('SetChannel returned error', channel_1)
-            # Set attenuation level for channe 1
-            result_1 = vnx.fnLDA_SetAttenuationHR(Devices[i], int(atten))
-            if result_1 != 0:
-                if printv == True:
-                    print('SetAttenuationHR returned error', result_1)
-
-            # Get channel 1 attenuation
-            result_1 = vnx.fnLDA_GetAttenuationHR(Devices[i])
-
-            # Display attenuation level for channel 1
-            if result_1 < 0:
-                if printv == True:
-                    print('GetAttenuationHR returned error', result)
-            else:
-                atten_db = result_1 / 20
-                if printv == True:
-                    print('Set attenuation:', atten_db)
+            self.lib.fnLDA_InitDevice(Devices[i])
+            # Select channel 1, it stays selected while the device is open
+            channel_1 = self.lib.fnLDA_SetChannel(Devices[i], 1)
+            if channel_1 != 0 and printv == True:
+                print('SetChannel returned error', channel_1)
+            self.handles[ser_num_i] = Devices[i]
 
+    def close(self):
+        for serial, device in self.handles.items():
             # Always close the device when done with it
-            result = vnx.fnLDA_CloseDevice(Devices[i])
-
+            result = self.lib.fnLDA_CloseDevice(device)
             if result != 0:
-                if printv == True:
-                    print('CloseDevice returned an error', result)
+                print('CloseDevice returned an error', result, 'for', serial)
+        self.handles = {}
+        self.values = {}
+        if self._atexit:
+            atexit.unregister(self.close)
+            self._atexit = False
+
+    def set(self, serial, attenu, printv=False, force=False):
+        """ Set the attenuation (dB) of one attenuator. Nothing is written if it is already at that value. """
+        if serial not in self.handles:
+            self.open(printv=printv)
+            if serial not in self.handles:
+                print('Attenuator ' + str(serial) + ' not found')
+                return
+
+        atten = round(float(attenu) / self.step)
+        if not force and self.values.get(serial) == atten:
+            return
+
+        # Set attenuation level for channel 1
+        result_1 = self.lib.fnLDA_SetAttenuationHR(self.handles[serial], int(atten))
+        if result_1 != 0:
+            if printv == True:
+                print('SetAttenuationHR returned error', result_1)
+            self.values.pop(serial, None)
+            return
+        self.values[serial] = atten
+
+        if printv == True:
+            print('Set attenuation:', self.get(serial, read=True))
+
+    def set_many(self, attenuations, printv=False):
+        """ attenuations: {serial number: attenuation (dB)}, set in one call """
+        for serial, attenu in attenuations.items():
+            self.set(serial, attenu, printv=printv)
+
+    def get(self, serial, read=False):
+        """ Attenuation (dB) of one attenuator, the cached value unless read is True """
+        if not read and serial in self.values:
+            return self.values[serial] * self.step
+        # Get channel 1 attenuation
+        result_1 = self.lib.fnLDA_GetAttenuationHR(self.handles[serial])
+        if result_1 < 0:
+            print('GetAttenuationHR returned error', result_1)
+            return None
+        return result_1 / 20
+
+
+#### manager shared by setatten and every attenuator object
+_manager = AttenuatorManager()
+
+
+def get_manager():
+    return _manager
+
+
+def setatten(attenu, serial, printv):
+    if printv == True:
+        print("Setting attenuation")
+    _manager.set(serial, attenu, printv=printv)
+
+
+def setattens(attenuations, printv=False):
+    """ set many attenuators at once, attenuations: {serial number: attenuation (dB)} """
+    _manager.set_many(attenuations, printv=printv)
+
+
+class MockVNXLibrary:
+    """
+    Stand in for the VNX_atten64 library with the functions used above. call_time is the time a library call takes
+    and init_time the extra time of InitDevice, so the sweep overhead can be timed without the hardware.
+    """
+    def __init__(self, serials=(27786, 27787, 27797), call_time=1e-3, init_time=0.1):
+        self.serials = list(serials)
+        self.call_time = call_time
+        self.init_time = init_time
+        self.attenuation = {serial: 0 for serial in self.serials}
+        self.calls = 0
+
+    def _call(self, extra=0.0):
+        self.calls += 1
+        time.sleep(self.call_time + extra)
+
+    def fnLDA_SetTestMode(self, mode):
+        self._call()
+
+    def fnLDA_GetNumDevices(self):
+        self._call()
+        return len(self.serials)
+
+    def fnLDA_GetDevInfo(self, devices):
+        self._call()
+        for i in range(len(self.serials)):
+            devices[i] = i + 1
+        return len(self.serials)
+
+    def fnLDA_GetSerialNumber(self, device):
+        self._call()
+        return self.serials[device - 1]
+
+    def fnLDA_InitDevice(self, device):
+        self._call(self.init_time)
+        return 0
+
+    def fnLDA_GetNumChannels(self, device):
+        self._call()
+        return 1
+
+    def fnLDA_SetChannel(self, device, channel):
+        self._call()
+        return 0
+
+    def fnLDA_SetAttenuationHR(self, device, value):
+        self._call()
+        self.attenuation[self.serials[device - 1]] = value
+        return 0
+
+    def fnLDA_GetAttenuationHR(self, device):
+        self._call()
+        return self.attenuation[self.serials[device - 1]]
+
+    def fnLDA_CloseDevice(self, device):
+        self._call()
+        return 0
+
+
+def benchmark(points=20, serials=(27786, 27787)):
+    """ power sweep overhead: reopening the devices for every point (the old setatten) against the manager """
+    lib = MockVNXLibrary(serials=serials)
+    start = time.time()
+    for idx in range(points):
+        for serial in serials:
+            with AttenuatorManager(lib) as manager:
+                manager.set(serial, idx)
+    t_reopen = time.time() - start
+
+    with AttenuatorManager(lib) as manager:
+        start = time.time()
+        for idx in range(points):
+            manager.set_many({serial: idx % 5 for serial in serials})
+        t_cached = time.time() - start
+    print('reopen every point: ' + str(round(t_reopen / points * 1e3, 1)) + ' ms/point, cached: '
+          + str(round(t_cached / points * 1e3, 1)) + ' ms/point')
 
-        else:
-            pass
 
 if __name__ == "__main__":
     atten = 30 #sys.argv[1]
     serial = 27786 #sys.argv[2]
     printv = True #sys.argv[3]
     boolprint = bool(strtobool(str(printv)))
-    setatten(float(atten), int(serial), boolprint)
\ No newline at end of file
+    setatten(float(atten), int(serial), boolprint)
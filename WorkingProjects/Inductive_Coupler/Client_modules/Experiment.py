@@ -3,6 +3,7 @@ import json
 import numpy as np
 import h5py
 import datetime
+import time
 from pathlib import Path
 
 class MakeFile(h5py.File):
@@ -35,6 +36,29 @@ class MakeFile(h5py.File):
                                 dtype=str(data.astype(np.float64).dtype))
         self[key][...] = data
 
+    def add_stream(self, key, row_shape=(), dtype=np.float64, nrows=0, chunk_rows=1):
+        """ pre-allocates a chunked dataset of nrows rows that can keep growing along its first axis
+            @param row_shape - shape of a single row (one gain/flux/wait point)
+            @param dtype - dtype the rows are stored with
+            @param nrows - number of rows to pre-allocate, unwritten float rows read back as nan
+            @param chunk_rows - number of rows per hdf5 chunk
+        """
+        row_shape = tuple(row_shape)
+        dtype = np.dtype(dtype)
+        fillvalue = np.nan if dtype.kind in 'fc' else 0
+        return self.create_dataset(key, shape=(nrows,) + row_shape,
+                                   maxshape=(None,) + row_shape,
+                                   chunks=(max(chunk_rows, 1),) + tuple(max(n, 1) for n in row_shape),
+                                   dtype=dtype, fillvalue=fillvalue)
+
+    def write_rows(self, key, start, rows):
+        """ writes rows start, start + 1, ... of a dataset made with add_stream, growing it if needed """
+        dset = self[key]
+        stop = start + len(rows)
+        if stop > dset.shape[0]:
+            dset.resize(stop, axis=0)
+        dset[start:stop] = rows
+
 
 class NpEncoder(json.JSONEncoder):
     """ Ensure json dump can handle np arrays """
@@ -48,6 +72,53 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
+class SweepTimer:
+    """ per point timing of a sweep and the estimate of when it is done """
+
+    def __init__(self, npoints):
+        self.npoints = npoints
+        self.durations = []
+        self.start_time = datetime.datetime.now()
+        self._t0 = None
+
+    @property
+    def points_done(self):
+        return len(self.durations)
+
+    def start_point(self):
+        self._t0 = time.time()
+
+    def stop_point(self):
+        self.durations.append(time.time() - self._t0)
+        return self.durations[-1]
+
+    def remaining(self):
+        #### median of the last points, so a slow first point (compiling, ramping) doesn't dominate
+        if not self.durations:
+            return np.nan
+        return np.median(self.durations[-20:]) * max(self.npoints - self.points_done, 0)
+
+    def report(self):
+        end_time = datetime.datetime.now() + datetime.timedelta(seconds=self.remaining())
+        print('point ' + str(self.points_done) + '/' + str(self.npoints) + ', last point took '
+              + str(round(self.durations[-1], 2)) + ' s, estimated end: ' + end_time.strftime("%Y/%m/%d %H:%M:%S"))
+
+    def stats(self):
+        durations = np.array(self.durations)
+        return {'points': len(durations), 'total': np.sum(durations), 'mean': np.mean(durations),
+                'median': np.median(durations), 'std': np.std(durations),
+                'min': np.min(durations), 'max': np.max(durations)}
+
+    def summary(self):
+        if not self.durations:
+            return 'no points taken'
+        stats = self.stats()
+        return ('sweep done: ' + str(stats['points']) + ' points in ' + str(round(stats['total'] / 60, 2))
+                + ' min, per point ' + str(round(stats['median'], 2)) + ' s median, '
+                + str(round(stats['mean'], 2)) + ' +/- ' + str(round(stats['std'], 2)) + ' s mean, '
+                + str(round(stats['max'], 2)) + ' s max')
+
+
 class ExperimentClass:
     """Base class for all experiments"""
 
@@ -72,6 +143,9 @@ class ExperimentClass:
         self.cfg = cfg
         self.soc = soc
         self.soccfg = soccfg
+        self.stream_file = None
+        self.streamed_keys = set()
+        self.rows_done = 0
         if config_file is not None:
             self.config_file = os.path.join(path, config_file)
         else:
@@ -171,12 +245,80 @@ class ExperimentClass:
     def display(self, data=None, **kwargs):
         pass
 
+    def open_stream(self, layout, nrows, static=None, chunk_rows=1, resume=None):
+        """ opens the data file for checkpointing a sweep row by row, see checkpoint
+            @param layout - dict of key: (row_shape, dtype) for the datasets filled row by row
+            @param nrows - number of rows (sweep points) to pre-allocate
+            @param static - dict of arrays known before the sweep starts (gain/wait vectors)
+            @param resume - data file of an unfinished run of the same sweep, the rows it has are kept and
+                            the sweep carries on in that file
+            returns the number of rows already done, a dict of those rows for every layout key and the attrs
+            saved with the last checkpoint
+        """
+        self.close_stream()
+        if resume is not None:
+            self.fname = resume
+            self.iname = resume[:-3] + '.png'
+            self.cname = resume[:-3] + '.json'
+        f = self.datafile()
+        self.stream_file = f
+        self.streamed_keys = set(layout.keys())
+        self.rows_done = int(f.attrs['rows_done']) if (resume is not None and 'rows_done' in f.attrs) else 0
+
+        if static is not None:
+            for k, d in static.items():
+                if resume is not None and k in f and not np.array_equal(np.array(f[k]), np.array(d)):
+                    self.close_stream()
+                    raise ValueError(k + " in " + resume + " is not the same as in this sweep")
+                f.add(k, np.array(d))
+
+        done = {}
+        for k, (row_shape, dtype) in layout.items():
+            if self.rows_done > 0 and k in f and f[k].shape[1:] == tuple(row_shape):
+                done[k] = np.array(f[k][:self.rows_done])
+                continue
+            if k in f:
+                del f[k]
+            f.add_stream(k, row_shape, dtype, nrows=nrows, chunk_rows=chunk_rows)
+        if len(done) != len(layout):  # a layout key is missing, nothing can be trusted
+            self.rows_done = 0
+            done = {}
+        f.attrs['rows_done'] = self.rows_done
+        f.flush()
+        return self.rows_done, done, dict(f.attrs)
+
+    def checkpoint(self, data, rows_done, attrs=None):
+        """ writes the rows finished since the last checkpoint and records the progress in the file
+            @param data - dict holding the full (nrows, ...) array of every layout key
+            @param rows_done - rows 0 .. rows_done - 1 are finished
+            @param attrs - anything else needed to resume (kept in the file attrs)
+        """
+        f = self.stream_file
+        for k in self.streamed_keys:
+            f.write_rows(k, self.rows_done, np.asarray(data[k])[self.rows_done:rows_done])
+        if attrs is not None:
+            for k, v in attrs.items():
+                f.attrs[k] = v
+        f.attrs['rows_done'] = rows_done
+        f.flush()
+        self.rows_done = rows_done
+
+    def close_stream(self):
+        if self.stream_file is not None:
+            if self.stream_file.id.valid:
+                self.stream_file.close()
+            self.stream_file = None
+
     def save_data(self, data=None):  #do I want to try to make this a very general function to save a dictionary containing arrays and variables?
         if data is None:
             data=self.data
 
+        #### checkpointed keys are already on disk
+        self.close_stream()
         with self.datafile() as f:
             for k, d in data.items():
+                if k in self.streamed_keys:
+                    continue
                 f.add(k, np.array(d))
 
     def load_data(self, f):
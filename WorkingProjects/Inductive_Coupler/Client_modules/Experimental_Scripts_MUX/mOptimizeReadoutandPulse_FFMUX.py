@@ -7,9 +7,11 @@ from WorkingProjects.Inductive_Coupler.Client_modules.mTransmissionFF import Sin
 from WorkingProjects.Inductive_Coupler.Client_modules.Experimental_Scripts_MUX.mSingleShotProgramFFMUX import SingleShotProgram
 from WorkingProjects.Inductive_Coupler.Client_modules.Experimental_Scripts_MUX.mSingleShotProgramFF_HigherLevelsMUX import SingleShotProgramFF_2StatesMUX
 
-from WorkingProjects.Inductive_Coupler.Client_modules.Experiment import ExperimentClass
+from WorkingProjects.Inductive_Coupler.Client_modules.Experiment import ExperimentClass, SweepTimer
 from WorkingProjects.Inductive_Coupler.Client_modules.Helpers.hist_analysis import *
 # from WorkingProjects.Inductive_Coupler.Client_modules.Experiment_Scripts.mSingleShotProgramFF_HigherLevels import * #SingleShotProgramFF_2States, hist
+from WorkingProjects.Inductive_Coupler.Client_modules.Helpers.AdaptiveSampling import AdaptiveGrid
+import itertools
 import time
 from tqdm.notebook import tqdm
 
@@ -34,8 +36,13 @@ class ReadOpt_wSingleShotFFMUX(ExperimentClass):
                  calibrate = True, cavityAtten =None):
         super().__init__(soc=soc, soccfg=soccfg, path=path, prefix=prefix,outerFolder=outerFolder, cfg=cfg, config_file=config_file, progress=progress)
 
-    def acquire(self, progress=False, plotDisp = True, plotSave = True, calibrate=False, cavityAtten=None, figNum = 1):
+    def acquire(self, progress=False, plotDisp = True, plotSave = True, calibrate=False, cavityAtten=None, figNum = 1,
+                adaptive=False, budget=0.3, coarse=4, peak_weight=0.7, resume=None):
         #### function used to actually find the cavity parameters
+        #### adaptive: only a budget (number, or fraction if <= 1) of the gain x frequency points is taken, starting
+        #### from a grid with spacing coarse and refining around the best fidelity (peak_weight) and large changes
+        #### resume: data file of an unfinished full grid run with the same gains and frequencies, carries on from its
+        #### last gain row. adaptive runs pick their points from the data as it comes in and are not checkpointed
         expt_cfg = {
             ### define the attenuator parameters
             "cav_gain_Start": self.cfg["cav_gain_Start"],
@@ -57,12 +64,33 @@ class ReadOpt_wSingleShotFFMUX(ExperimentClass):
         Z_fid = np.full((len(Y), len(X)), np.nan)
         Z_overlap = np.full((len(Y), len(X)), np.nan)
 
+        #### raw shots for the full grid, indexed as [gain][freq][shot], filled in as the sweep runs and saved with
+        #### the data as shots_i_g, shots_q_g, shots_i_e and shots_q_e
+        self.shots = {key: np.full((len(Y), len(X), self.cfg["shots"]), np.nan) for key in ['i_g', 'q_g', 'i_e', 'q_e']}
+
         self.data= {
             'config': self.cfg,
             'data': {'fid_mat': Z_fid, 'overlap_mat': Z_overlap,
                      'trans_fpts':self.trans_fpts, 'gain_pts':self.gain_pts,
                      }
         }
+        self.data['data'].update({'shots_' + key: value for key, value in self.shots.items()})
+
+        #### every finished gain row goes straight to the data file, so a stopped sweep can be resumed
+        first_row = 0
+        if not adaptive:
+            layout = {'fid_mat': ((len(X),), np.float64), 'overlap_mat': ((len(X),), np.float64)}
+            layout.update({'shots_' + key: ((len(X), self.cfg["shots"]), np.float64) for key in self.shots})
+            first_row, done, attrs = self.open_stream(
+                layout=layout, nrows=len(Y),
+                static={'trans_fpts': self.trans_fpts, 'gain_pts': self.gain_pts},
+                resume=resume)
+            if first_row > 0:
+                print('resuming from gain row ' + str(first_row))
+                for key, rows in done.items():
+                    self.data['data'][key][:first_row] = rows
+        elif resume is not None:
+            raise ValueError('adaptive runs can not be resumed')
 
         ### create the figure and subplots that data will be plotted on
         while plt.fignum_exists(num = figNum):
@@ -71,129 +99,151 @@ class ReadOpt_wSingleShotFFMUX(ExperimentClass):
         plt.suptitle(self.titlename)
 
 
-        #### start a timer for estimating the time for the scan
-        startTime = datetime.datetime.now()
-        # print('') ### print empty row for spacing
-        print('starting date time: ' + startTime.strftime("%Y/%m/%d %H:%M:%S"))
-        start = time.time()
-
-        ### start the loop over attenuations
-        for idf_cavgain in range(len(self.gain_pts)):
-            # start_2 = time.time()
-            ### set the cavity attenuation
+        #### adaptive mode: start on a coarse grid and refine around the best fidelity and where it changes fast,
+        #### the points that are not taken are interpolated for the plots
+        sampler = AdaptiveGrid(Z_fid.shape, coarse=coarse, budget=budget, peak_weight=peak_weight) if adaptive else None
+        if adaptive:
+            points = (np.unravel_index(flat, Z_fid.shape) for flat in sampler.points(Z_fid))
+            num_points = sampler.budget
+        else:
+            points = itertools.product(range(first_row, len(self.gain_pts)), range(len(self.trans_fpts)))
+            num_points = (expt_cfg["cav_gain_Points"] - first_row) * expt_cfg["TransNumPoints"]
+        timer = SweepTimer(num_points)
+
+        def shown(Z):
+            return sampler.interpolate(Z) if adaptive else Z
+
+        ax_plot_0 = ax_plot_1 = cbar0 = cbar1 = None
+
+        def plot_maps():
+            nonlocal ax_plot_0, ax_plot_1, cbar0, cbar1
+            if ax_plot_0 is None:
+
+                ax_plot_0 = axs[0].imshow(
+                    shown(Z_fid)*100,
+                    aspect='auto',
+                    extent=[X[0] - X_step / 2, X[-1] + X_step / 2,
+                            Y[0] - Y_step / 2, Y[-1] + Y_step / 2],
+                    origin='lower',
+                    interpolation='none',
+                )
+                cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
+                cbar0.set_label('fidelity (%)', rotation=90)
+
+                ax_plot_1 = axs[1].imshow(
+                    shown(Z_overlap),
+                    aspect='auto',
+                    extent=[X[0] - X_step / 2, X[-1] + X_step / 2,
+                            Y[0] - Y_step / 2, Y[-1] + Y_step / 2],
+                    origin='lower',
+                    interpolation='none',
+                )
+                cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
+                cbar1.set_label('overlap err (a.u.)', rotation=90)
+            else:
+                ax_plot_0.set_data(shown(Z_fid)*100)
+                ax_plot_0.autoscale()
+                cbar0.remove()
+                cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
+                cbar0.set_label('fidelity (%)', rotation=90)
+
+                ax_plot_1.set_data(shown(Z_overlap))
+                ax_plot_1.autoscale()
+                cbar1.remove()
+                cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
+                cbar1.set_label('overlap err (a.u.)', rotation=90)
+
+            axs[0].set_ylabel("Cavity Gain (a.u.)")
+            axs[0].set_xlabel("Cavity Frequency (GHz)")
+            axs[0].set_title("fidelity")
+
+            axs[1].set_ylabel("Cavity Atten (dB")
+            axs[1].set_xlabel("Cavity Frequency (GHz)")
+            axs[1].set_title("overlap err")
+
+            if plotDisp:
+                plt.show(block=False)
+                plt.pause(0.1)
+
+        ### start the loop over the (attenuation, transmission) points
+        for idx_point, (idf_cavgain, idx_trans) in enumerate(points):
+            timer.start_point()
+            ### set the cavity attenuation and transmission point
             self.cfg["pulse_gains"] = [self.gain_pts[idf_cavgain] / 32000]
-            ### start the loop over transmission points
-            for idx_trans in range(len(self.trans_fpts)):
-                self.cfg["mixer_freq"] = self.trans_fpts[idx_trans]
-                # prog = SingleShotProgram(self.soccfg, self.cfg)
-                # shots_i0, shots_q0 = prog.acquire(self.soc, load_pulses=True)
-                i_g, q_g, i_e, q_e = self._acquireSingleShotData()
-                if plt.fignum_exists(10):
-                    plt.close(10)
-
-                fid, threshold, angle = hist_process(data=[i_g, q_g, i_e, q_e], plot=False, ran=None, figNum=10, print_fidelities=False)
-
-                # plt.show(block=False)
-                # plt.pause(1)
-                # plt.close(10)
-
-                Z_fid[idf_cavgain, idx_trans] = fid
-                self.data['data']['fid_mat'][idf_cavgain, idx_trans] = fid
-
-                #### plotting
-                if idf_cavgain == 0 and idx_trans ==0:
-
-                    ax_plot_0 = axs[0].imshow(
-                        Z_fid*100,
-                        aspect='auto',
-                        extent=[X[0] - X_step / 2, X[-1] + X_step / 2,
-                                Y[0] - Y_step / 2, Y[-1] + Y_step / 2],
-                        origin='lower',
-                        interpolation='none',
-                    )
-                    cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
-                    cbar0.set_label('fidelity (%)', rotation=90)
-                else:
-                    ax_plot_0.set_data(Z_fid*100)
-                    ax_plot_0.autoscale()
-                    cbar0.remove()
-                    cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
-                    cbar0.set_label('fidelity (%)', rotation=90)
-
-
-
-
-                axs[0].set_ylabel("Cavity Gain (a.u.)")
-                axs[0].set_xlabel("Cavity Frequency (GHz)")
-                axs[0].set_title("fidelity")
-
-                #### perform a mixed shot analysis, decide to combine shots or not based on 'arb' or 'const' qubit drive
-
-                if self.cfg["qubit_pulse_style"] in ["flat_top", "arb"]:
-                    mixed_i = np.concatenate((i_g, i_e))
-                    mixed_q = np.concatenate((q_g, q_e))
-
-                    mixed = MixedShots(mixed_i, mixed_q)
-
-                    overlapErr = mixed.OverlapErr
-
-                    Z_overlap[idf_cavgain, idx_trans] = overlapErr
-                    self.data['data']['overlap_mat'][idf_cavgain, idx_trans] = overlapErr
-
-                    # while plt.fignum_exists(num=5):
-                    #     plt.close(5)
-                    # mixed.PlotGaussFit()
-                elif self.cfg["qubit_pulse_style"] == "const":
-                    mixed = MixedShots(i_e, q_e)
-
-                    overlapErr = mixed.OverlapErr
-                    Z_overlap[idf_cavgain, idx_trans] = overlapErr
-                    self.data['data']['overlap_mat'][idf_cavgain, idx_trans] = overlapErr
+            self.cfg["mixer_freq"] = self.trans_fpts[idx_trans]
+            #### the programs are rebuilt for every point, neither the gain nor the frequency can be swept in tProc
+            #### registers: see _buildSingleShotPrograms. only the qubit envelope is uploaded, and it is the same for
+            #### every point, so the pulses are loaded for the first point only
+            i_g, q_g, i_e, q_e = self._acquireSingleShotData(load_pulses = (idx_point == 0))
+
+            self.shots['i_g'][idf_cavgain, idx_trans] = i_g
+            self.shots['q_g'][idf_cavgain, idx_trans] = q_g
+            self.shots['i_e'][idf_cavgain, idx_trans] = i_e
+            self.shots['q_e'][idf_cavgain, idx_trans] = q_e
+
+            if adaptive:
+                #### the sampler needs the fidelity of every point before it picks the next ones
+                Z_fid[idf_cavgain, idx_trans], Z_overlap[idf_cavgain, idx_trans] = \
+                    self._analyzePoint(idf_cavgain, idx_trans)
+                row_done = (idx_point + 1) % len(X) == 0  #### plot about as often as a full sweep plots a row
+            elif idx_trans == len(X) - 1:
+                #### analyse the finished gain row in one pass over its shots and write it to the data file
+                fid_row, overlap_row = self._analyzeShots(idf_cavgain)
+                Z_fid[idf_cavgain, :] = fid_row
+                Z_overlap[idf_cavgain, :] = overlap_row
+                self.checkpoint(self.data['data'], idf_cavgain + 1)
+                row_done = True
+            else:
+                row_done = False
+            timer.stop_point()
 
+            if row_done:
+                timer.report()
                 #### plotting
-                if idf_cavgain == 0 and idx_trans ==0:
-                    ax_plot_1 = axs[1].imshow(
-                        Z_overlap,
-                        aspect='auto',
-                        extent=[X[0] - X_step / 2, X[-1] + X_step / 2,
-                                Y[0] - Y_step / 2, Y[-1] + Y_step / 2],
-                        origin='lower',
-                        interpolation='none',
-                    )
-                    cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
-                    cbar1.set_label('overlap err (a.u.)', rotation=90)
-                else:
-                    ax_plot_1.set_data(Z_overlap)
-                    ax_plot_1.autoscale()
-                    cbar1.remove()
-                    cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
-                    cbar1.set_label('overlap err (a.u.)', rotation=90)
+                plot_maps()
 
+        if adaptive:
+            plot_maps()
+            #### the points that were taken, in the order they were taken, with their gain and frequency
+            self.data['data']['sample_order'] = np.array(sampler.order)
+            self.data['data']['sample_coords'] = sampler.coordinates(self.gain_pts, self.trans_fpts)
+            self.data['data']['fid_interp'] = sampler.interpolate(Z_fid)
+            self.data['data']['overlap_interp'] = sampler.interpolate(Z_overlap)
 
+        print(timer.summary())
 
-                axs[1].set_ylabel("Cavity Atten (dB")
-                axs[1].set_xlabel("Cavity Frequency (GHz)")
-                axs[1].set_title("overlap err")
-
-                if plotDisp:
-                    plt.show(block=False)
-                    plt.pause(0.1)
+        plt.savefig(self.iname)  #### save the figure
 
+        return self.data
 
-                if idf_cavgain == 0 and idx_trans ==0:  ### during the first run create a time estimate for the data aqcuisition
-                    t_delta = time.time() - start  ### time for single full row in seconds
-                    timeEst = t_delta * expt_cfg["cav_gain_Points"] * expt_cfg["TransNumPoints"]  ### estimate for full scan
-                    StopTime = startTime + datetime.timedelta(seconds=timeEst)
-                    print('Time for 1 sweep: ' + str(round(t_delta / 60, 2)) + ' min')
-                    print('estimated total time: ' + str(round(timeEst / 60, 2)) + ' min')
-                    print('estimated end: ' + StopTime.strftime("%Y/%m/%d %H:%M:%S"))
+    def _analyzeShots(self, idf_cavgain):
+        #### fidelity and overlap error for every frequency point of one gain row of self.shots
+        fid_row, threshold_row, angle_row = hist_process_batch(
+            [self.shots[key][idf_cavgain] for key in ['i_g', 'q_g', 'i_e', 'q_e']])
+        overlap_row = np.array([self._overlapErr(idf_cavgain, idx_trans) for idx_trans in range(len(self.trans_fpts))])
 
+        return fid_row, overlap_row
 
-        print('actual end: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    def _analyzePoint(self, idf_cavgain, idx_trans):
+        #### fidelity and overlap error of a single point of self.shots
+        fid, threshold, angle = hist_process_batch(
+            [self.shots[key][idf_cavgain, idx_trans] for key in ['i_g', 'q_g', 'i_e', 'q_e']])
+        return fid, self._overlapErr(idf_cavgain, idx_trans)
 
-        plt.savefig(self.iname)  #### save the figure
+    def _overlapErr(self, idf_cavgain, idx_trans):
+        i_g = self.shots['i_g'][idf_cavgain, idx_trans]
+        q_g = self.shots['q_g'][idf_cavgain, idx_trans]
+        i_e = self.shots['i_e'][idf_cavgain, idx_trans]
+        q_e = self.shots['q_e'][idf_cavgain, idx_trans]
 
-        return self.data
+        #### perform a mixed shot analysis, decide to combine shots or not based on 'arb' or 'const' qubit drive
+        if self.cfg["qubit_pulse_style"] in ["flat_top", "arb"]:
+            mixed = MixedShots(np.concatenate((i_g, i_e)), np.concatenate((q_g, q_e)))
+            return mixed.OverlapErr
+        elif self.cfg["qubit_pulse_style"] == "const":
+            mixed = MixedShots(i_e, q_e)
+            return mixed.OverlapErr
+        return np.nan
 
 
     def _calibrate(self, progress=False, plotDisp = True, plotSave = True, figNum = 1, cavityAtten = None):
@@ -277,27 +327,38 @@ class ReadOpt_wSingleShotFFMUX(ExperimentClass):
 
         return data_I, data_Q
 
-    def _acquireSingleShotData(self):
-        #### pull the data from the single hots
+    def _buildSingleShotPrograms(self):
+        #### build the ground (no qubit pulse) and excited state programs
+        #### the readout is a tone of the muxed generator. its gain (mux_gains) and the mixer frequency are written to
+        #### the generator by declare_gen and the downconversion frequency of the readouts by declare_readout, all when
+        #### the program is built. none of them is a tProc register, so every readout gain and frequency needs its own
+        #### program
         self.cfg["Pulse"] = False
-        prog = SingleShotProgram(self.soccfg, self.cfg)
-        shots_ig,shots_qg = prog.acquire(self.soc, load_pulses=True)
+        prog_g = SingleShotProgram(self.soccfg, self.cfg)
 
         self.cfg["Pulse"] = True
-        prog = SingleShotProgram(self.soccfg, self.cfg)
-        shots_ie,shots_qe = prog.acquire(self.soc, load_pulses=True)
+        prog_e = SingleShotProgram(self.soccfg, self.cfg)
+
+        return prog_g, prog_e
+
+    def _acquireSingleShotData(self, load_pulses=True):
+        #### pull the data from the single hots
+        #### load_pulses: False when the envelopes of an earlier point with the same qubit pulse are still loaded
+        prog_g, prog_e = self._buildSingleShotPrograms()
+
+        shots_ig,shots_qg = prog_g.acquire(self.soc, load_pulses=load_pulses)
+        shots_ie,shots_qe = prog_e.acquire(self.soc, load_pulses=load_pulses)
 
         i_g = shots_ig[0][0]
         q_g = shots_qg[0][0]
         i_e = shots_ie[0][0]
         q_e = shots_qe[0][0]
 
-        ### use the helper histogram to find the fidelity and such
-        fid, threshold, angle = hist_process(data=[i_g, q_g, i_e, q_e], plot=False, ran=None, print_fidelities=False)
-
-        self.fid = fid
-        self.threshold = threshold
-        self.angle = angle
+        ### fidelity, threshold and angle of the last point taken
+        fid, threshold, angle = hist_process_batch([i_g, q_g, i_e, q_e])
+        self.fid = float(fid)
+        self.threshold = float(threshold)
+        self.angle = float(angle)
 
         return i_g, q_g, i_e, q_e
 
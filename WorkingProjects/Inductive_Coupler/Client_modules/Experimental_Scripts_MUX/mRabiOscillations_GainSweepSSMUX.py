@@ -196,6 +196,7 @@ class Oscillations_Gain_2nd(ExperimentClass):
                 plotSave = True):
 
         gainVec = np.array([int(x) for x in np.linspace(self.cfg["gainStart"],self.cfg["gainStop"], self.cfg["gainNumPoints"])])
+        FF.FFPulseMemory.reset()  # the board may have been loaded by another experiment
         while plt.fignum_exists(num = figNum):
             figNum += 1
         fig, axs = plt.subplots(1,1, figsize = (10,8), num = figNum)
@@ -251,7 +252,8 @@ class Oscillations_Gain_2nd(ExperimentClass):
                 self.cfg["variable_wait"] = t
                 print('vwait ', t)
                 prog = OscillationsProgram(self.soccfg, self.cfg)
-                results.append(prog.acquire(self.soc, load_pulses=True))
+                #### only envelopes that changed since the last program are uploaded
+                results.append(prog.acquire(self.soc, load_pulses=FF.FFPulseMemory.load(prog, self.soc)))
 
                 # print(prog)
                 # self.soc.load_bin_program(prog.compile())
@@ -406,6 +408,7 @@ class Oscillations_Gain_SSMUX(ExperimentClass):
                 plotSave = True):
 
         gainVec = np.array([int(x) for x in np.linspace(self.cfg["gainStart"],self.cfg["gainStop"], self.cfg["gainNumPoints"])])
+        FF.FFPulseMemory.reset()  # the board may have been loaded by another experiment
         while plt.fignum_exists(num = figNum):
             figNum += 1
         fig, axs = plt.subplots(1,1, figsize = (10,8), num = figNum)
@@ -475,7 +478,7 @@ class Oscillations_Gain_SSMUX(ExperimentClass):
                     # print('wait time: ', t)
                     prog = OscillationsProgramSS(self.soccfg, self.cfg)
                     shots_i0, shots_q0 = prog.acquire(self.soc,
-                                                      load_pulses=True)
+                                                      load_pulses=FF.FFPulseMemory.load(prog, self.soc))
                     rotated_iq = rotate_data((shots_i0[j], shots_q0[j]), theta=angle[j])
                     rotated_iq_array.append(rotated_iq)
                     excited_percentage = count_percentage(rotated_iq, threshold = threshold[j])
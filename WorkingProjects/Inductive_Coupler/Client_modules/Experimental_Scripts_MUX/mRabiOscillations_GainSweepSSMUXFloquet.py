@@ -3,7 +3,7 @@ from WorkingProjects.Inductive_Coupler.Client_modules.socProxy import makeProxy
 import matplotlib.pyplot as plt
 import numpy as np
 from qick.helpers import gauss
-from WorkingProjects.Inductive_Coupler.Client_modules.Experiment import ExperimentClass
+from WorkingProjects.Inductive_Coupler.Client_modules.Experiment import ExperimentClass, SweepTimer
 import datetime
 from tqdm.notebook import tqdm
 from WorkingProjects.Inductive_Coupler.Client_modules.Helpers.rotate_SS_data import *
@@ -79,6 +79,132 @@ class OscillationsProgram(AveragerProgram):
         FF.FFPulses_direct(self, list_of_gains, length_dt, previous_gains= previous_gains, t_start = t_start,
                            IQPulseArray=IQPulseArray, waveform_label = waveform_label)
 
+class OscillationsProgramR(RAveragerProgram):
+    """
+    OscillationsProgram with the wait time swept in registers: the 16 sub-cycle shifted copies of the FF pulses
+    are uploaded once and every wait time only sets the address and length registers of the FF channels, read
+    from a table in tProc memory. Plays the same samples as FFPulses_direct for each wait time in
+    start + step * arange(expts) (in 1/16 clock cycles).
+    """
+    table_addr = 256  # tProc memory, 2 words per wait time
+    table_size = 768
+
+    def initialize(self):
+        cfg = self.cfg
+
+        # Qubit
+        self.declare_gen(ch=cfg["qubit_ch"], nqz=cfg["qubit_nqz"])  # Qubit
+        self.pulse_sigma = self.us2cycles(cfg["sigma"], gen_ch=self.cfg["qubit_ch"])
+        self.pulse_qubit_length = self.us2cycles(cfg["sigma"] * 4, gen_ch=self.cfg["qubit_ch"])
+        self.add_gauss(ch=cfg["qubit_ch"], name="qubit", sigma=self.pulse_sigma, length=self.pulse_qubit_length)
+
+        self.freq_01 = self.freq2reg(cfg["qubit_freq01"], gen_ch=self.cfg["qubit_ch"])
+        self.freq_12 = self.freq2reg(cfg["qubit_freq12"], gen_ch=self.cfg["qubit_ch"])
+
+        # Readout: resonator DAC gen and readout ADCs
+        self.declare_gen(ch=cfg["res_ch"], nqz=cfg["nqz"])  # Readout
+        f_res = self.freq2reg(cfg["pulse_freq"], gen_ch=cfg["res_ch"], ro_ch=cfg["ro_chs"][0])  # conver f_res to dac register value
+        self.set_pulse_registers(ch=cfg["res_ch"], style="const", freq=f_res, phase=cfg["res_phase"],
+                                 gain=cfg["pulse_gain"],
+                                 length=self.us2cycles(cfg["length"]))
+        for ch in [0, 1]:  # configure the readout lengths and downconversion frequencies
+            self.declare_readout(ch=ch, length=self.us2cycles(cfg["readout_length"]),
+                                 freq=cfg["pulse_freq"], gen_ch=cfg["res_ch"])
+
+        FF.FFDefinitions(self)
+
+        # define registers for sweep
+        self.rps = []
+        self.r_addrs = []
+        self.r_modes = []
+        for channel in self.FFChannels:
+            self.rps.append(self.ch_page(gen_ch=channel))
+            self.r_addrs.append(self.sreg(gen_ch=channel, name='addr'))
+            self.r_modes.append(self.sreg(gen_ch=channel, name="mode"))  # length reg in last 16 bits of mode register
+
+        # load waveforms: shifted copies long enough for the longest wait, then the shortest (3 cycle) pulse
+        wait_points = cfg["start"] + cfg["step"] * np.arange(cfg["expts"])
+        if 2 * cfg["expts"] > self.table_size:
+            raise ValueError("at most " + str(self.table_size // 2) + " wait times per program")
+        self.sweep_length = 16 * (int(np.max(wait_points)) // 16 + 2)
+        FF.LoadWaveforms(self, prev_value=list(self.FFPulse), length=self.sweep_length)
+        for FFChannel in self.FFChannels:
+            self.add_pulse(ch=FFChannel, name="short", idata=np.zeros(48), qdata=np.zeros(48))
+
+        # table of (address, extra clock cycles) for every wait time
+        addrs, extra_cycles = FF.SubCycleSweepTable(wait_points, self.sweep_length)
+        rp = self.rps[0]
+        for idx, (addr, extra) in enumerate(zip(addrs, extra_cycles)):
+            self.regwi(rp, 6, int(addr))
+            self.memwi(rp, 6, self.table_addr + 2 * idx)
+            self.regwi(rp, 6, int(extra))
+            self.memwi(rp, 6, self.table_addr + 2 * idx + 1)
+        for rp in set(self.rps):
+            self.regwi(rp, 5, self.table_addr)  # table pointer of the current wait time
+
+        self.sync_all(200)
+
+    def body(self):
+        self.sync_all(gen_t0=self.gen_t0)
+        self.FFPulses(self.FFPulse, 2 * self.cfg["sigma"] * 4 + 1.01)
+        self.setup_and_pulse(ch=self.cfg["qubit_ch"], style="arb", freq=self.freq_01, phase=0,
+                             gain=self.cfg["qubit_gain01"],
+                             waveform="qubit", t=self.us2cycles(1))
+        self.setup_and_pulse(ch=self.cfg["qubit_ch"], style="arb", freq=self.freq_12, phase=0,
+                             gain=self.cfg["qubit_gain12"],
+                             waveform="qubit")
+        self.FFPulses_sweep(1)
+        self.sync_all(gen_t0=self.gen_t0)
+        self.sync(self.rps[0], 7)  # the FF pulses were longer than the 3 cycles the program assumes
+
+        self.FFPulses(self.FFReadouts, self.cfg["length"])
+
+        self.measure(pulse_ch=self.cfg["res_ch"],
+                     adcs=[0, 1],
+                     adc_trig_offset=self.us2cycles(self.cfg["adc_trig_offset"]),
+                     wait=True,
+                     syncdelay=self.us2cycles(10))
+
+        # Net-zero-flux FF pulses, the generators play them back to back so the timing doesn't matter
+        self.FFPulses(-1 * self.FFReadouts, self.cfg["length"])
+        self.FFPulses_sweep(-1)
+        self.FFPulses(-1 * self.FFPulse, 2 * self.cfg["sigma"] * 4 + 1.01)
+        self.sync_all(self.us2cycles(self.cfg["relax_delay"]))
+
+    def FFPulses_sweep(self, sign):
+        # FF experiment pulses of the current wait time, registers 6 and 7 get its address and extra cycles
+        for FFChannel, rp, r_addr, r_mode, gain, IQPulse in zip(self.FFChannels, self.rps, self.r_addrs, self.r_modes,
+                                                                self.FFPulse, self.cfg["IDataArray"]):
+            if sign < 0 and IQPulse is None:
+                # as in OscillationsProgram: the net-zero pulse of a step is a constant -Gain_Pulse
+                self.set_pulse_registers(ch=FFChannel, style='const', freq=0, phase=0, gain=-int(gain), length=3)
+            else:
+                self.set_pulse_registers(ch=FFChannel, freq=0, phase=0, gain=sign * self.soccfg['gens'][FFChannel]['maxv'],
+                                         style='arb', waveform="short", outsel="input")
+                self.memr(rp, 6, 5)
+                self.mathi(rp, r_addr, 6, '+', 0)
+            self.mathi(rp, 7, 5, '+', 1)
+            self.memr(rp, 7, 7)
+            self.math(rp, r_mode, r_mode, '+', 7)
+            self.pulse(ch=FFChannel)
+
+    def update(self):
+        for rp in set(self.rps):  # increment once per page! some channels use the same page
+            self.mathi(rp, 5, 5, '+', 2)
+
+    def compile(self):
+        #### the FF experiment gains only enter the waveforms, so all gain rows share one binary
+        #### which channels have an IDataArray does change the program, see FFPulses_sweep
+        key = FF.config_hash(self.cfg, ignore=('IDataArray', 'Gain_Expt'))
+        key += str([IQPulse is None for IQPulse in self.cfg["IDataArray"]])
+        if key not in FF.CompiledPrograms:
+            FF.CompiledPrograms[key] = super().compile()
+        return FF.CompiledPrograms[key]
+
+    def FFPulses(self, list_of_gains, length_us, t_start='auto'):
+        FF.FFPulses(self, list_of_gains, length_us, t_start)
+
+
 class OscillationsProgramSS(AveragerProgram):
     def initialize(self):
         cfg = self.cfg
@@ -193,7 +319,8 @@ class Oscillations_Gain_2nd(ExperimentClass):
         self.Q_Range = Q_Excited - Q_Ground
 
     def acquire(self, threshold = None, angle = None, progress=False, figNum = 1, plotDisp = True,
-                plotSave = True):
+                plotSave = True, resume = None):
+        #### resume: data file of an unfinished run with the same gains and wait times, carries on from its last row
 
         gainVec = np.array([int(x) for x in np.linspace(self.cfg["gainStart"],self.cfg["gainStop"], self.cfg["gainNumPoints"])])
         while plt.fignum_exists(num = figNum):
@@ -222,9 +349,21 @@ class Oscillations_Gain_2nd(ExperimentClass):
         Y = gainVec
         Y_step = Y[1] - Y[0]
 
-        startTime = datetime.datetime.now()
-        print('') ### print empty row for spacing
-        print('starting date time: ' + startTime.strftime("%Y/%m/%d %H:%M:%S"))
+        #### every finished row goes straight to the data file, so a stopped sweep can be resumed
+        first_row, done, attrs = self.open_stream(
+            layout={'oscillation_I': ((self.cfg["expts"],), np.float64),
+                    'oscillation_Q': ((self.cfg["expts"],), np.float64)},
+            nrows=self.cfg["gainNumPoints"],
+            static={'wait_times': self.wait_times, 'gainVec': gainVec},
+            resume=resume)
+        if first_row > 0:
+            print('resuming from gain row ' + str(first_row))
+            self.I_data[:first_row] = done['oscillation_I']
+            self.Q_data[:first_row] = done['oscillation_Q']
+            Z_values[:first_row] = (self.I_data[:first_row] - self.I_Ground) / self.I_Range
+            phase_multiplicative = attrs['phase_multiplicative']
+
+        FF.FFPulseMemory.reset()  # the board may have been loaded by another experiment
         if np.array(self.cfg["IDataArray"]).any() != None:
 
             self.cfg["IDataArray"][0] = Compensated_Pulse(self.cfg['FF_Qubits']['1']['Gain_Expt'], self.cfg['FF_Qubits'][
@@ -236,40 +375,23 @@ class Oscillations_Gain_2nd(ExperimentClass):
             self.cfg["IDataArray"][3] = Compensated_Pulse(self.cfg['FF_Qubits']['4']['Gain_Expt'], self.cfg['FF_Qubits'][
                                                                                '4']['Gain_Pulse'], 4)
 
-        start = time.time()
-        for i in range(self.cfg["gainNumPoints"]):
-            if i % 5 == 1:
-                self.save_data(self.data)
+        timer = SweepTimer(self.cfg["gainNumPoints"] - first_row)
+        for i in range(first_row, self.cfg["gainNumPoints"]):
+            timer.start_point()
             self.cfg['FF_Qubits'][str(self.cfg["qubitIndex"])]['Gain_Expt'] = int(gainVec[i])
             if type(self.cfg["IDataArray"][0]) != type(None):
                 self.cfg["IDataArray"][self.cfg["qubitIndex"] - 1] = Compensated_Pulse(int(gainVec[i]),
                                                                                    self.cfg['FF_Qubits'][str(self.cfg["qubitIndex"])]['Gain_Pulse'],
                                                                                        self.cfg["qubitIndex"])
-            results = []
-            start = time.time()
-            for t in tqdm(tpts, position=0, disable=True):
-                self.cfg["variable_wait"] = t
-                print('vwait ', t)
-                prog = OscillationsProgram(self.soccfg, self.cfg)
-                results.append(prog.acquire(self.soc, load_pulses=True))
-
-                # print(prog)
-                # self.soc.load_bin_program(prog.compile())
-                # # # Start tProc.
-                # self.soc.tproc.start()
-                # print("freq:  ", self.soc.tproc.single_read(addr=130))
-                # print("phase: ", self.soc.tproc.single_read(addr=131))
-                # print("addr:  ", self.soc.tproc.single_read(addr=132))
-                # print("gain:  ", self.soc.tproc.single_read(addr=133))
-                # print("mode:  ", self.soc.tproc.single_read(addr=134))
-                # print("time:  ", self.soc.tproc.single_read(addr=135))
-            print(f'Time: {time.time() - start}')
-            results = np.transpose(results)
+            #### one program for the whole row, the wait times are swept in registers. Only the waveforms of the
+            #### swept qubit change from row to row, the rest stays on the board
+            prog = OscillationsProgramR(self.soccfg, self.cfg)
+            x_pts, avgi, avgq = prog.acquire(self.soc, load_pulses=FF.FFPulseMemory.load(prog, self.soc))
 
             # self.data['data']["RotatedIQ"][i, :] = np.array(rotated_iq_array)
 
-            i_data = results[0][0][0]
-            q_data = results[0][0][1]
+            i_data = avgi[0][0]
+            q_data = avgq[0][0]
             complex = i_data + 1j * q_data
 
             # i_data_new = Amplitude_IQ(i_data, q_data)
@@ -286,13 +408,14 @@ class Oscillations_Gain_2nd(ExperimentClass):
             self.data['data']["oscillation_I"][i, :] = i_data
             self.data['data']["oscillation_Q"][i, :] = q_data
             Z_values[i, :] = (i_data - self.I_Ground) / self.I_Range
+            self.checkpoint(self.data['data'], i + 1, attrs={'phase_multiplicative': phase_multiplicative})
 
             # if np.abs(self.I_Range) > np.abs(self.Q_Range):
             #     Z_values[i, :] = (results[0][0][0] - self.I_Ground) / self.I_Range
             # else:
             #     Z_values[i, :] = (results[0][0][1] - self.Q_Ground) / self.Q_Range
 
-            if i == 0:
+            if i == first_row:
                 ax_plot_1 = axs.imshow(
                     Z_values,
                     aspect='auto',
@@ -324,19 +447,14 @@ class Oscillations_Gain_2nd(ExperimentClass):
                 plt.show(block=False)
                 plt.pause(0.1)
 
-            if i ==0: ### during the first run create a time estimate for the data aqcuisition
-                t_delta = time.time() - start + 5 * 2### time for single full row in seconds
-                timeEst = (t_delta )*self.cfg["gainNumPoints"]  ### estimate for full scan
-                StopTime = startTime + datetime.timedelta(seconds=timeEst)
-                print('Time for 1 sweep: ' + str(round(t_delta/60, 2)) + ' min')
-                print('estimated total time: ' + str(round(timeEst/60, 2)) + ' min')
-                print('estimated end: ' + StopTime.strftime("%Y/%m/%d %H:%M:%S"))
+            timer.stop_point()
+            timer.report()
 
 
         if plotSave:
             plt.savefig(self.iname) #### save the figure
 
-        print(f'Time: {time.time() - start}')
+        print(timer.summary())
 
 
         # results = np.transpose(results)
@@ -195,119 +195,120 @@ class SpecVsQblox(ExperimentClass):
         start = time.time()
 
 
-        QbloxClass = Qblox()
-        #### loop over the qblox vector
-        for i in range(expt_cfg["qbloxNumPoints"]):
-            if i != 0:
-                time.sleep(self.cfg['sleep_time'])
-            if i % 5 == 1:
-                self.save_data(self.data)
-                self.soc.reset_gens()
-            ### set the qblox voltage for the specific run
-            # self.qblox.SetVoltage(qbloxVec[i])
-            voltages_for_qblox = []
-            for m in range(len(self.cfg['DACs'])):
-                voltages_for_qblox.append(qbloxVec[m][i])
-            print(voltages_for_qblox)
-            QbloxClass.set_voltage(self.cfg['DACs'], voltages_for_qblox)
-            # QbloxClass.print_voltages()
-            time.sleep(1)
-            ### take the transmission data
-            # data_I, data_Q = self._aquireTransData()
-            # self.data['data']['trans_Imat'][i,:] = data_I
-            # self.data['data']['trans_Qmat'][i,:] = data_Q
-            #
-            # #### plot out the transmission data
-            # sig = data_I + 1j * data_Q
-            # avgamp0 = np.abs(sig)
-            # Z_trans[i, :] = avgamp0
-            # # axs[0].plot(x_pts, avgamp0, label="Amplitude; ADC 0")
-            # if i == 1:
-            #     ax_plot_0 = axs[0].imshow(
-            #         Z_trans,
-            #         aspect='auto',
-            #         extent=[np.min(X_trans)-X_trans_step/2,np.max(X_trans)+X_trans_step/2,np.min(Y)-Y_step/2,np.max(Y)+Y_step/2],
-            #         origin= 'lower',
-            #         interpolation= 'none',
-            #     )
-            #     cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
-            #     cbar0.set_label('a.u.', rotation=90)
-            # else:
-            #     ax_plot_0.set_data(Z_trans)
-            #     ax_plot_0.autoscale()
-            #     cbar0.remove()
-            #     cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
-            #     cbar0.set_label('a.u.', rotation=90)
-            #
-            # axs[0].set_ylabel("Yoko Voltage (V)")
-            # axs[0].set_xlabel("Cavity Frequency (GHz)")
-            # axs[0].set_title("Cavity Transmission")
-            #
-            # if plotDisp:
-            #     plt.show(block=False)
-            #     plt.pause(0.1)
-            if i != expt_cfg["qbloxNumPoints"]:
-                time.sleep(self.cfg['sleep_time'])
-
-            ### take the spec data
-            data_I, data_Q = self._aquireSpecData()
-            data_I = data_I[0]
-            data_Q = data_Q[0]
-
-            self.data['data']['spec_Imat'][i,:] = data_I
-            self.data['data']['spec_Qmat'][i,:] = data_Q
-
-            #### plot out the spec data
-            sig = data_I + 1j * data_Q
-
-
-            avgamp0 = np.abs(sig)
-            if smart_normalize:
-                avgamp0 = Normalize_Qubit_Data(data_I[0], data_Q[0])
-            Z_spec[i, :] = avgamp0  #- self.cfg["minADC"]
-            if i == 0:
-
-                ax_plot_1 = axs.imshow(
-                    Z_spec,
-                    aspect='auto',
-                    extent=[X_spec[0]-X_spec_step/2,X_spec[-1]+X_spec_step/2,Y[0]-Y_step/2,Y[-1]+Y_step/2],
-                    origin='lower',
-                    interpolation = 'none',
-                )
-                cbar1 = fig.colorbar(ax_plot_1, ax=axs, extend='both')
-                cbar1.set_label('a.u.', rotation=90)
-            else:
-                ax_plot_1.set_data(Z_spec)
-                ax_plot_1.autoscale()
-                cbar1.remove()
-                cbar1 = fig.colorbar(ax_plot_1, ax=axs, extend='both')
-                cbar1.set_label('a.u.', rotation=90)
-            # if i ==0: #### if first sweep add a colorbar
-            #     cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
-            #     cbar1.set_label('a.u.', rotation=90)
-            # else:
-            #     cbar1.remove()
-            #     cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
-            #     cbar1.set_label('a.u.', rotation=90)
-
-            axs.set_ylabel("Qblox (V)")
-            axs.set_xlabel("Spec Frequency (GHz)")
-            axs.set_title(f"{self.titlename}, QDAC: {self.cfg['DACs']}, "
-                             f"Cav Freq: {np.round(self.cfg['pulse_freqs'][0] + self.cfg['mixer_freq'] + self.cfg['cavity_LO'] / 1e6, 3)}")
-
-            if plotDisp:
-                plt.show(block=False)
-                plt.pause(0.1)
-
-            if i ==0: ### during the first run create a time estimate for the data aqcuisition
-                t_delta = time.time() - start + self.cfg["sleep_time"] * 2### time for single full row in seconds
-                timeEst = (t_delta )*expt_cfg["qbloxNumPoints"]  ### estimate for full scan
-                StopTime = startTime + datetime.timedelta(seconds=timeEst)
-                print('Time for 1 sweep: ' + str(round(t_delta/60, 2)) + ' min')
-                print('estimated total time: ' + str(round(timeEst/60, 2)) + ' min')
-                print('estimated end: ' + StopTime.strftime("%Y/%m/%d %H:%M:%S"))
-
-        print('actual end: '+ datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+        #### one serial session for the whole sweep, closed when the loop ends or raises
+        with Qblox() as QbloxClass:
+            #### loop over the qblox vector
+            for i in range(expt_cfg["qbloxNumPoints"]):
+                if i != 0:
+                    time.sleep(self.cfg['sleep_time'])
+                if i % 5 == 1:
+                    self.save_data(self.data)
+                    self.soc.reset_gens()
+                ### set the qblox voltage for the specific run
+                # self.qblox.SetVoltage(qbloxVec[i])
+                voltages_for_qblox = []
+                for m in range(len(self.cfg['DACs'])):
+                    voltages_for_qblox.append(qbloxVec[m][i])
+                print(voltages_for_qblox)
+                QbloxClass.set_voltage(self.cfg['DACs'], voltages_for_qblox)
+                # QbloxClass.print_voltages()
+                time.sleep(1)
+                ### take the transmission data
+                # data_I, data_Q = self._aquireTransData()
+                # self.data['data']['trans_Imat'][i,:] = data_I
+                # self.data['data']['trans_Qmat'][i,:] = data_Q
+                #
+                # #### plot out the transmission data
+                # sig = data_I + 1j * data_Q
+                # avgamp0 = np.abs(sig)
+                # Z_trans[i, :] = avgamp0
+                # # axs[0].plot(x_pts, avgamp0, label="Amplitude; ADC 0")
+                # if i == 1:
+                #     ax_plot_0 = axs[0].imshow(
+                #         Z_trans,
+                #         aspect='auto',
+                #         extent=[np.min(X_trans)-X_trans_step/2,np.max(X_trans)+X_trans_step/2,np.min(Y)-Y_step/2,np.max(Y)+Y_step/2],
+                #         origin= 'lower',
+                #         interpolation= 'none',
+                #     )
+                #     cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
+                #     cbar0.set_label('a.u.', rotation=90)
+                # else:
+                #     ax_plot_0.set_data(Z_trans)
+                #     ax_plot_0.autoscale()
+                #     cbar0.remove()
+                #     cbar0 = fig.colorbar(ax_plot_0, ax=axs[0], extend='both')
+                #     cbar0.set_label('a.u.', rotation=90)
+                #
+                # axs[0].set_ylabel("Yoko Voltage (V)")
+                # axs[0].set_xlabel("Cavity Frequency (GHz)")
+                # axs[0].set_title("Cavity Transmission")
+                #
+                # if plotDisp:
+                #     plt.show(block=False)
+                #     plt.pause(0.1)
+                if i != expt_cfg["qbloxNumPoints"]:
+                    time.sleep(self.cfg['sleep_time'])
+
+                ### take the spec data
+                data_I, data_Q = self._aquireSpecData()
+                data_I = data_I[0]
+                data_Q = data_Q[0]
+
+                self.data['data']['spec_Imat'][i,:] = data_I
+                self.data['data']['spec_Qmat'][i,:] = data_Q
+
+                #### plot out the spec data
+                sig = data_I + 1j * data_Q
+
+
+                avgamp0 = np.abs(sig)
+                if smart_normalize:
+                    avgamp0 = Normalize_Qubit_Data(data_I[0], data_Q[0])
+                Z_spec[i, :] = avgamp0  #- self.cfg["minADC"]
+                if i == 0:
+
+                    ax_plot_1 = axs.imshow(
+                        Z_spec,
+                        aspect='auto',
+                        extent=[X_spec[0]-X_spec_step/2,X_spec[-1]+X_spec_step/2,Y[0]-Y_step/2,Y[-1]+Y_step/2],
+                        origin='lower',
+                        interpolation = 'none',
+                    )
+                    cbar1 = fig.colorbar(ax_plot_1, ax=axs, extend='both')
+                    cbar1.set_label('a.u.', rotation=90)
+                else:
+                    ax_plot_1.set_data(Z_spec)
+                    ax_plot_1.autoscale()
+                    cbar1.remove()
+                    cbar1 = fig.colorbar(ax_plot_1, ax=axs, extend='both')
+                    cbar1.set_label('a.u.', rotation=90)
+                # if i ==0: #### if first sweep add a colorbar
+                #     cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
+                #     cbar1.set_label('a.u.', rotation=90)
+                # else:
+                #     cbar1.remove()
+                #     cbar1 = fig.colorbar(ax_plot_1, ax=axs[1], extend='both')
+                #     cbar1.set_label('a.u.', rotation=90)
+
+                axs.set_ylabel("Qblox (V)")
+                axs.set_xlabel("Spec Frequency (GHz)")
+                axs.set_title(f"{self.titlename}, QDAC: {self.cfg['DACs']}, "
+                                 f"Cav Freq: {np.round(self.cfg['pulse_freqs'][0] + self.cfg['mixer_freq'] + self.cfg['cavity_LO'] / 1e6, 3)}")
+
+                if plotDisp:
+                    plt.show(block=False)
+                    plt.pause(0.1)
+
+                if i ==0: ### during the first run create a time estimate for the data aqcuisition
+                    t_delta = time.time() - start + self.cfg["sleep_time"] * 2### time for single full row in seconds
+                    timeEst = (t_delta )*expt_cfg["qbloxNumPoints"]  ### estimate for full scan
+                    StopTime = startTime + datetime.timedelta(seconds=timeEst)
+                    print('Time for 1 sweep: ' + str(round(t_delta/60, 2)) + ' min')
+                    print('estimated total time: ' + str(round(timeEst/60, 2)) + ' min')
+                    print('estimated end: ' + StopTime.strftime("%Y/%m/%d %H:%M:%S"))
+
+            print('actual end: '+ datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
         if plotSave:
             plt.savefig(self.iname) #### save the figure
@@ -0,0 +1,159 @@
+#### adaptive sampling of a sweep grid. the sweep starts on a coarse lattice of the full (fine) grid and keeps
+#### splitting the cells of the lattice where the data changes the most, until the point budget is used up.
+#### a cell is a box between measured corners, splitting it measures the middle of every edge, face and the
+#### center, so the cells always stay boxes on the fine grid and the unmeasured points can be filled in by
+#### multilinear interpolation from the corners of the cell they are in.
+#### the score of a cell is the spread of its corner values (gradient) plus how far the points of its last split
+#### were off the interpolation from the parent corners (curvature), peak_weight mixes in how close the cell is
+#### to the largest value taken so far
+
+import itertools
+import numpy as np
+
+
+class AdaptiveGrid:
+    def __init__(self, shape, coarse=4, budget=0.3, peak_weight=0.0, split_fraction=0.25):
+        """
+        @param shape - shape of the full grid the points are taken from
+        @param coarse - spacing of the starting lattice in grid points, an int or one per axis
+        @param budget - number of points to take in total, or the fraction of the full grid if <= 1
+        @param peak_weight - 0 refines only on gradient and curvature, 1 only around the largest values
+                             (e.g. the best fidelity)
+        @param split_fraction - fraction of the splittable cells that is split every round
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.size = int(np.prod(self.shape))
+        coarse = np.broadcast_to(coarse, (len(self.shape),))
+        self.lattice = [np.unique(np.r_[np.arange(0, n, max(int(c), 1)), n - 1]) for n, c in zip(self.shape, coarse)]
+        if budget <= 1:
+            budget = int(np.ceil(budget * self.size))
+        self.budget = int(min(max(budget, np.prod([len(l) for l in self.lattice])), self.size))
+        self.peak_weight = peak_weight
+        self.split_fraction = split_fraction
+
+        #### cells are (lows, highs, curvature err), the starting cells are the boxes of the lattice
+        self.cells = []
+        for box in itertools.product(*[list(zip(l[:-1], l[1:])) if len(l) > 1 else [(l[0], l[0])]
+                                       for l in self.lattice]):
+            self.cells.append((tuple(int(b[0]) for b in box), tuple(int(b[1]) for b in box), 0.0))
+        self.measured = np.zeros(self.shape, dtype=bool)
+        self.order = []  #### flat indices of the points in the order they were handed out
+
+    @staticmethod
+    def _corners(lo, hi):
+        return list(itertools.product(*[sorted({a, b}) for a, b in zip(lo, hi)]))
+
+    @staticmethod
+    def _children(lo, hi):
+        halves = [[(a, (a + b) // 2), ((a + b) // 2, b)] if b - a >= 2 else [(a, b)] for a, b in zip(lo, hi)]
+        return [(tuple(h[0] for h in box), tuple(h[1] for h in box)) for box in itertools.product(*halves)]
+
+    @staticmethod
+    def _splittable(cell):
+        return any(b - a >= 2 for a, b in zip(cell[0], cell[1]))
+
+    @staticmethod
+    def _predict(lo, hi, values, idx):
+        #### multilinear interpolation at idx from the corners of the box lo, hi
+        value = 0.0
+        for corner in itertools.product(*[[(a, 1.0)] if a == b else [(a, (b - i) / (b - a)), (b, (i - a) / (b - a))]
+                                          for a, b, i in zip(lo, hi, idx)]):
+            weight = np.prod([w for _, w in corner])
+            if weight != 0:
+                value = value + weight * values[tuple(c for c, _ in corner)]
+        return value
+
+    def _range(self, values):
+        #### offset and scale of the values taken so far, the scores are relative to them
+        taken = np.asarray(values)[self.measured]
+        if taken.size == 0 or not np.any(np.isfinite(taken)):
+            return 0.0, 1.0
+        vmin, vmax = np.nanmin(taken), np.nanmax(taken)
+        return vmin, (vmax - vmin) if vmax > vmin else 1.0
+
+    def _score(self, cell, values, vmin, scale):
+        corners = np.array([values[c] for c in self._corners(cell[0], cell[1])], dtype=float)
+        with np.errstate(invalid='ignore'):
+            spread = np.nanmax(np.ptp(corners, axis=0)) / scale if corners.size else 0.0
+            peak = (np.nanmax(corners) - vmin) / scale if corners.size else 0.0
+        spread = 0.0 if not np.isfinite(spread) else spread
+        peak = 0.0 if not np.isfinite(peak) else peak
+        return (1 - self.peak_weight) * (spread + cell[2]) + self.peak_weight * peak
+
+    def points(self, values, done=None):
+        """
+        generator of the flat indices of the points to take next. values is the array (shape + value shape)
+        the caller fills in, the values of the points handed out are read once a round of points is finished,
+        so a point has to be filled in before the next one is asked for.
+        done is a mask of points that are already in values (resumed sweep), they count towards the budget
+        """
+        if done is not None:
+            self.measured |= np.asarray(done, dtype=bool).reshape(self.shape)
+
+        def hand_out(idx):
+            self.measured[idx] = True
+            flat = int(np.ravel_multi_index(idx, self.shape))
+            self.order.append(flat)
+            return flat
+
+        for idx in itertools.product(*self.lattice):
+            idx = tuple(int(i) for i in idx)
+            if not self.measured[idx]:
+                yield hand_out(idx)
+
+        while True:
+            splittable = [cell for cell in self.cells if self._splittable(cell)]
+            if not splittable or np.sum(self.measured) >= self.budget:
+                return
+            vmin, scale = self._range(values)
+            scores = np.array([self._score(cell, values, vmin, scale) for cell in splittable])
+            num_split = max(1, int(np.ceil(self.split_fraction * len(splittable))))
+            chosen = [splittable[k] for k in np.argsort(-scores, kind='stable')[:num_split]]
+
+            new_points = []
+            for lo, hi, _ in chosen:
+                for child_lo, child_hi in self._children(lo, hi):
+                    for corner in self._corners(child_lo, child_hi):
+                        if not self.measured[corner] and corner not in new_points:
+                            new_points.append(corner)
+            for idx in new_points:
+                if np.sum(self.measured) >= self.budget:
+                    return
+                yield hand_out(idx)
+
+            #### the round is done, split the chosen cells and carry the interpolation error of the new points
+            #### over to the children
+            vmin, scale = self._range(values)
+            chosen_keys = {(lo, hi) for lo, hi, _ in chosen}
+            cells = [cell for cell in self.cells if (cell[0], cell[1]) not in chosen_keys]
+            for lo, hi, _ in chosen:
+                children = self._children(lo, hi)
+                corners = {c for child in children for c in self._corners(*child)} - set(self._corners(lo, hi))
+                err = 0.0
+                for idx in corners:
+                    with np.errstate(invalid='ignore'):
+                        off = np.nanmax(np.abs(np.asarray(values[idx], dtype=float)
+                                               - self._predict(lo, hi, values, idx))) / scale
+                    if np.isfinite(off):
+                        err = max(err, off)
+                cells += [(child_lo, child_hi, err) for child_lo, child_hi in children]
+            self.cells = cells
+
+    def interpolate(self, values):
+        """
+        values filled in on the full grid for display, the points that were not taken are interpolated from the
+        corners of their cell. the smaller cells go last so they win on edges shared with a coarser neighbour
+        """
+        filled = np.array(values, dtype=float)
+        for lo, hi, _ in sorted(self.cells, key=lambda cell: -np.prod([b - a + 1 for a, b in zip(cell[0], cell[1])])):
+            if not all(self.measured[c] for c in self._corners(lo, hi)):
+                continue
+            for idx in itertools.product(*[range(a, b + 1) for a, b in zip(lo, hi)]):
+                if not self.measured[idx]:
+                    filled[idx] = self._predict(lo, hi, values, idx)
+        return filled
+
+    def coordinates(self, *axes):
+        #### axis values of the points taken, in the order they were handed out, shape (points, axes)
+        idx = np.unravel_index(np.array(self.order, dtype=int), self.shape)
+        return np.column_stack([np.asarray(axis)[i] for axis, i in zip(axes, idx)])
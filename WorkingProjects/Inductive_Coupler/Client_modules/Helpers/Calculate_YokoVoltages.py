@@ -1,40 +1,13 @@
 
-import itertools
 import numpy as np
 import pickle
+from WorkingProjects.Inductive_Coupler.Client_modules.Helpers.FluxToVoltage import flux_to_voltage
 
 
 def voltage_to_flux(voltage_vector, voltage_matrix, offset_vector):
     return (voltage_matrix.dot(voltage_vector) - offset_vector)
 
 
-# for more qubits, change repeat = 4 in itertools:
-x = [0, 1, 2, 3]  # this should remain 4 because this counts the different fluxes:[fluxlow, -low, high, -high]
-all_combinatorics = [p for p in itertools.product(x, repeat=4)]
-
-
-def flux_to_voltage(flux_quanta, Voltage_matrix_inverse, FluxQuanta_offsets, minimum_only=False):
-    fluxes_low, fluxes_high = flux_quanta
-    all_flux_quantas = []
-    for i in range(len(fluxes_low)):
-        all_flux_quantas.append([fluxes_low[i], -fluxes_low[i], fluxes_high[i], -fluxes_high[i]])
-
-    minimum = np.inf
-    minimum_voltages = np.array([0, 0, 0])
-    for comb in all_combinatorics:
-        index1, index2, index3, index4 = comb
-        flux_array = [all_flux_quantas[0][index1], all_flux_quantas[1][index2], all_flux_quantas[2][index3],
-                      all_flux_quantas[3][index4]]
-        # print(Voltage_matrix_inverse,FluxQuanta_offsets, flux_array )
-
-        voltages = Voltage_matrix_inverse.dot(FluxQuanta_offsets + flux_array)
-        voltages_squared = np.sum(voltages ** 2)
-        if voltages_squared < minimum:
-            minimum = voltages_squared
-            minimum_voltages = voltages
-
-    return (minimum_voltages)
-
 def Ej(d, phiext):
     '''
     phiext is in units of flux quanta
@@ -110,8 +83,9 @@ if EjEc_together:
         fluxes_low = []
         fluxes_high = []
 
-        for i in range(len(frequency_array)):
-            freq = frequency_array[i]
+        frequency_array = np.asarray(frequency_array)
+        for i in range(frequency_array.shape[-1]):
+            freq = frequency_array[..., i]
             parameter = list_of_dictionaries[i]
             d = parameter['di']
             offset = parameter['EjEc']
@@ -119,7 +93,7 @@ if EjEc_together:
             fluxes_low.append(flux(freq, offset, d))
             fluxes_high.append(1 - flux(freq, offset, d))
 
-        return (np.array(fluxes_low), np.array(fluxes_high))
+        return (np.stack(fluxes_low, axis=-1), np.stack(fluxes_high, axis=-1))
     def flux(frequency, EjEc, d):
         EjEc *= 8
         numerator = np.sqrt((frequency ** 4) / (EjEc ** 2) - d ** 2)
@@ -156,8 +130,9 @@ if not EjEc_together:
         fluxes_low = []
         fluxes_high = []
 
-        for i in range(len(frequency_array)):
-            freq = frequency_array[i]
+        frequency_array = np.asarray(frequency_array)
+        for i in range(frequency_array.shape[-1]):
+            freq = frequency_array[..., i]
             parameter = list_of_dictionaries[i]
             d = parameter['di']
             Ej_ = parameter['Ej']
@@ -165,7 +140,7 @@ if not EjEc_together:
             flux_value = flux(freq, Ej_, Ec_, d)
             fluxes_low.append(flux(freq, Ej_, Ec_,  d))
             fluxes_high.append(1 - flux(freq, Ej_, Ec_, d))
-        return(np.array(fluxes_low), np.array(fluxes_high))
+        return(np.stack(fluxes_low, axis=-1), np.stack(fluxes_high, axis=-1))
 
     # def flux(frequency, Ej_, Ec_, d):
     #     Ej_ *= 8
@@ -189,7 +164,7 @@ def same_format(results):
     offset_vector = results['Fitted Offset Vector']
     cavity_dictionaries = results['Cavity Dictionaries']
     list_of_dictionaries = [{'di': results['Fitted d'][i], 'Ej': results['Fitted Ej'][i],
-                             'Ec': results['Fitted Ec'][i], 'flux_quanta': 1 / voltage_matrix [i, i]} for i in range(4)]
+                             'Ec': results['Fitted Ec'][i], 'flux_quanta': 1 / voltage_matrix [i, i]} for i in range(len(results['Fitted d']))]
     # offset_vector = np.array([1 / voltage_matrix [i, i] for i in range(4)])
 
     return (list_of_dictionaries, voltage_matrix, inverse_voltage_matrix, offset_vector,cavity_dictionaries)
@@ -1,6 +1,7 @@
 import pickle
 import numpy as np
 import matplotlib.pyplot as plt
+from WorkingProjects.Inductive_Coupler.Client_modules.Helpers.FF_utils import FFWaveforms, FF_SAMPLE_US
 
 def QuadExponentialFit(t, A1, T1, A2, T2, A3, T3, A4, T4):
     return(A1 * np.exp(-t / T1) + A2 * np.exp(-t / T2) + A3 * np.exp(-t / T3) + A4 * np.exp(-t / T4))
@@ -8,28 +9,16 @@ def QuadExponentialFit(t, A1, T1, A2, T2, A3, T3, A4, T4):
 def DoubleExponentialFit(t, A1, T1, A2, T2):
     return (A1 * np.exp(-t / T1) + A2 * np.exp(-t / T2))
 
+#### the predistortion curves are computed once in FFWaveforms, later calls only slice the stored curve
 def Compensated_AWG(Num_Points, Fit_Parameters, maximum = 1.5):
-    step = 0.00232515 / 16
-    time = np.arange(0,Num_Points)*step
-    ideal_AWG = np.ones(Num_Points)
-    analytic_n = QuadExponentialFit(time, Fit_Parameters[0], Fit_Parameters[1], Fit_Parameters[2],
-                                   Fit_Parameters[3], Fit_Parameters[4], Fit_Parameters[5],
-                                   Fit_Parameters[6], Fit_Parameters[7])
-    analytic_n[analytic_n < -0.8] = -0.8
-    v_awg = ideal_AWG / (1 + analytic_n)
-    v_awg[v_awg > maximum] = maximum
-    return(time, v_awg)
+    time = np.arange(0,Num_Points)*FF_SAMPLE_US
+    v_awg = FFWaveforms.compensation(Num_Points, Fit_Parameters[:8], maximum = maximum)
+    return(time, v_awg.copy())
 
 def Compensated_AWG_LongTimes(Num_Points, Fit_Parameters, maximum = 1.5):
-    step = 0.00232515 / 16
-    time = np.arange(0,Num_Points)*step
-    ideal_AWG = np.ones(Num_Points)
-    analytic_n = DoubleExponentialFit(time, Fit_Parameters[0], Fit_Parameters[1], Fit_Parameters[2],
-                                   Fit_Parameters[3])
-    analytic_n[analytic_n < -0.8] = -0.8
-    v_awg = ideal_AWG / (1 + analytic_n)
-    v_awg[v_awg > maximum] = maximum
-    return(time, v_awg)
+    time = np.arange(0,Num_Points)*FF_SAMPLE_US
+    v_awg = FFWaveforms.compensation(Num_Points, Fit_Parameters[:4], maximum = maximum)
+    return(time, v_awg.copy())
 
 
 # Qubit1_Long = pickle.load(open('Z:/Jeronimo/Qubit_Calibration_FF_Params/Qubit1_Fit_LongTimes_Corrected_1.p', 'rb'))
@@ -1,4 +1,225 @@
 import numpy as np
+import os
+import hashlib
+import json
+from collections import OrderedDict
+
+#### one DAC sample of a fast flux generator, 1/16 of a clock cycle, in us
+FF_SAMPLE_US = 0.00232515 / 16
+
+
+class WaveformLibrary:
+    """
+    Fast flux waveforms computed once and reused. A waveform is a step from prev_value to gain,
+    predistorted with the exponential fit parameters of the channel (none for a plain step), cut to
+    length samples and padded at the start to whole clock cycles (at least 3), as FFPulses_direct does.
+    Waveforms are keyed by (channel, gain, length, prev_value, fit parameters). The max_items most
+    recently used are kept in memory, with path set they are also saved as .npy files and read back
+    in later sessions. Returned arrays are read only, copy them before changing them.
+    """
+    def __init__(self, max_items=512, path=None):
+        self.max_items = max_items
+        self.path = path
+        self.waveforms = OrderedDict()
+        self.compensations = {}
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def compensation(self, num_points, fit_parameters, maximum=1.5):
+        """
+        1 / (1 + sum_i A_i exp(-t / T_i)) for fit_parameters [A1, T1, A2, T2, ...], the same as
+        Compensated_AWG (quad exponential) and Compensated_AWG_LongTimes (double exponential).
+        The curve is kept at the longest length asked for, shorter ones are slices of it.
+        """
+        key = (tuple(float(p) for p in fit_parameters), float(maximum))
+        v_awg = self.compensations.get(key)
+        if v_awg is None or len(v_awg) < num_points:
+            length = max(num_points, 0 if v_awg is None else 2 * len(v_awg))
+            time = np.arange(0, length) * FF_SAMPLE_US
+            analytic_n = fit_parameters[0] * np.exp(-time / fit_parameters[1])
+            for idx in range(2, len(fit_parameters), 2):
+                analytic_n = analytic_n + fit_parameters[idx] * np.exp(-time / fit_parameters[idx + 1])
+            analytic_n[analytic_n < -0.8] = -0.8
+            v_awg = np.ones(length) / (1 + analytic_n)
+            v_awg[v_awg > maximum] = maximum
+            v_awg.setflags(write=False)
+            self.compensations[key] = v_awg
+        return v_awg[:num_points]
+
+    def waveform(self, channel, gain, length, prev_value=0, fit_parameters=None, maximum=1.5):
+        """ clock aligned step from prev_value to gain, length in samples (1/16 clock cycle) """
+        fit_key = None if fit_parameters is None else tuple(float(p) for p in fit_parameters)
+        key = (int(channel), float(gain), int(length), float(prev_value), fit_key, float(maximum))
+        return self._lookup(key, lambda: self._build(gain, length, prev_value, fit_parameters, maximum))
+
+    def step(self, channel, gain, length, prev_value=0, fit_parameters=None, maximum=1.5):
+        """ the step from prev_value to gain, length samples, without the clock alignment """
+        fit_key = None if fit_parameters is None else tuple(float(p) for p in fit_parameters)
+        key = ('step', int(channel), float(gain), int(length), float(prev_value), fit_key, float(maximum))
+        return self._lookup(key, lambda: self._step(gain, length, prev_value, fit_parameters, maximum))
+
+    def shifted(self, channel, gain, length, prev_value=0, fit_parameters=None, maximum=1.5):
+        """
+        the 16 sub-cycle shifted copies that LoadWaveforms uploads, as an array [shift - 1][sample].
+        The waveform is preceded by 3 clock cycles of prev_value and copy i starts i samples in.
+        """
+        fit_key = None if fit_parameters is None else tuple(float(p) for p in fit_parameters)
+        key = ('shifted', int(channel), float(gain), int(length), float(prev_value), fit_key, float(maximum))
+
+        def build():
+            pulse = self._step(gain, length, prev_value, fit_parameters, maximum)
+            return shift_copies(np.concatenate([prev_value * np.ones(48), pulse]))
+        return self._lookup(key, build)
+
+    def shifted_array(self, channel, IQPulse, prev_value=0):
+        """ shifted copies of a given array, keyed by its contents """
+        IQPulse = np.asarray(IQPulse, dtype=float)
+        key = ('shifted_array', int(channel), hashlib.sha1(IQPulse.tobytes()).hexdigest(), float(prev_value))
+        return self._lookup(key, lambda: shift_copies(np.concatenate([prev_value * np.ones(48), IQPulse])))
+
+    def _step(self, gain, length, prev_value, fit_parameters, maximum):
+        if fit_parameters is None:
+            return gain * np.ones(length)
+        #### same as Compensated_Pulse in the experiment scripts
+        pulse = (self.compensation(length, fit_parameters, maximum) - 1) * (gain - prev_value) + gain
+        return np.clip(pulse, -32000, 32000)
+
+    def _build(self, gain, length, prev_value, fit_parameters, maximum):
+        return clock_align(self._step(gain, length, prev_value, fit_parameters, maximum), prev_value)
+
+    def _lookup(self, key, build):
+        if key in self.waveforms:
+            self.waveforms.move_to_end(key)
+            self.hits += 1
+            return self.waveforms[key]
+
+        file_name = None
+        if self.path is not None:
+            file_name = os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+        if file_name is not None and os.path.exists(file_name):
+            data = np.load(file_name)
+            self.hits += 1
+        else:
+            data = np.asarray(build(), dtype=float)
+            self.misses += 1
+            if file_name is not None:
+                np.save(file_name, data)
+
+        data.setflags(write=False)
+        self.waveforms[key] = data
+        if len(self.waveforms) > self.max_items:
+            self.waveforms.popitem(last=False)
+        return data
+
+    def clear(self):
+        self.waveforms.clear()
+        self.compensations.clear()
+
+
+class PulseMemory:
+    """
+    Keeps track of what is in the waveform memory of each generator of the board, so that a new program
+    only uploads the envelopes that changed. Use it in place of load_pulses:
+        prog.acquire(soc, load_pulses=FF.FFPulseMemory.load(prog, soc))
+    If the envelopes of the program can't be read (different qick version) it returns True and acquire
+    uploads everything as before. Call reset() if something else may have written to the board.
+    """
+    def __init__(self):
+        self.loaded = {}  # {ch: {addr: (length, digest)}}
+        self.uploads = 0
+        self.skipped = 0
+
+    def load(self, prog, soc):
+        envelopes = program_envelopes(prog)
+        if envelopes is None:
+            self.reset()
+            return True
+        for ch, name, addr, data in envelopes:
+            data = np.ascontiguousarray(data)
+            digest = hashlib.sha1(data.tobytes()).hexdigest()
+            length = len(data)
+            channel_memory = self.loaded.setdefault(ch, {})
+            if channel_memory.get(addr) == (length, digest):
+                self.skipped += 1
+                continue
+            soc.load_pulse_data(ch, data=data, addr=addr)
+            self.uploads += 1
+            #### anything this envelope overlaps is no longer on the board
+            for other_addr in [a for a, (l, d) in channel_memory.items() if a < addr + length and addr < a + l]:
+                del channel_memory[other_addr]
+            channel_memory[addr] = (length, digest)
+        return False
+
+    def reset(self):
+        self.loaded = {}
+
+
+def program_envelopes(prog):
+    """ (channel, name, address, data) of every envelope added to a program, None if unknown """
+    try:
+        envelopes = prog.envelopes
+        items = envelopes.items() if isinstance(envelopes, dict) else enumerate(envelopes)
+        return [(ch, name, env['addr'], env['data'])
+                for ch, channel_envs in items for name, env in channel_envs['envs'].items()]
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+def clock_align(IQPulse, prev_value=0):
+    """ pad the start of a pulse with prev_value to whole clock cycles (16 samples), at least 3 """
+    if len(IQPulse) % 16 != 0:  # need to pad beginning
+        extralen = 16 - (len(IQPulse) % 16)
+        IQPulse = np.concatenate([prev_value * np.ones(extralen), IQPulse])
+    if len(IQPulse) // 16 < 3:
+        extralen = 48 - len(IQPulse)
+        IQPulse = np.concatenate([prev_value * np.ones(extralen), IQPulse])
+    return IQPulse
+
+
+def shift_copies(IQPulse):
+    """ copies i = 1..16 of IQPulse[i:len(IQPulse) - 16 + i], all len(IQPulse) - 16 long """
+    idx = np.arange(1, 17)[:, np.newaxis] + np.arange(len(IQPulse) - 16)
+    return IQPulse[idx]
+
+
+def SubCycleSweepTable(wait_points, length):
+    """
+    For sweeping the length of an FFPulses_direct pulse with registers instead of new programs: wait_points in
+    samples (1/16 clock cycle), length the pulse length given to LoadWaveforms (>= max(wait_points) + 16).
+    Returns the address (in clock cycles, copy '1' at 0) and the number of clock cycles over the shortest pulse
+    (3 cycles) for every point. Playing that many cycles from that address gives the same samples as
+    FFPulses_direct with length_dt = wait point.
+    """
+    wait_points = np.asarray(wait_points).astype(int)
+    if np.any(wait_points < 1) or np.any(wait_points > length - 16):
+        raise ValueError("wait points have to be between 1 and length - 16 = " + str(length - 16))
+    copy_cycles = length // 16 + 2
+    n_cycles = np.maximum(3, -(-wait_points // 16))
+    start = 48 - 16 * n_cycles + wait_points  # first sample played, counted in the pulse with 48 prev samples in front
+    shift = (start - 1) % 16 + 1
+    addrs = (shift - 1) * copy_cycles + (start - shift) // 16
+    return addrs, n_cycles - 3
+
+
+def config_hash(cfg, ignore=()):
+    """ hash of a config, leaving out the keys in ignore at any level """
+    def strip(value):
+        if isinstance(value, dict):
+            return {str(k): strip(v) for k, v in value.items() if k not in ignore}
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [strip(v) for v in value]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+    return hashlib.sha1(json.dumps(strip(cfg), sort_keys=True, default=str).encode()).hexdigest()
+
+
+#### shared by all programs of a session
+FFWaveforms = WaveformLibrary()
+FFPulseMemory = PulseMemory()
+CompiledPrograms = {}  # {config_hash: binary}, see OscillationsProgramR.compile
 
 
 # def LoadWaveforms_initial(instance, gains, length):
@@ -13,24 +234,29 @@ import numpy as np
 #         instance.set_pulse_registers(ch=instance.FFChannels[i], style='const', freq=0, phase=0,
 #                                      gain=gain, length=length)
 
-def LoadWaveforms(instance, prev_value=0):
+def LoadWaveforms(instance, prev_value=0, length=None):
+    # length (in samples, multiple of 16) overrides cfg['FFlength'] and cuts the IDataArray pulses to it
     if type(prev_value) in [int, float]:
         prev_value = [prev_value] * len(instance.FFChannels)
+    if length is None:
+        length = instance.cfg['FFlength']
     for gain, IQPulse, FFChannel, prev_val in zip(instance.FFExpts, instance.cfg["IDataArray"], instance.FFChannels,
                                                   prev_value):
         # print("prev val {}, gain {}".format(prev_val, gain))
         gencfg = instance.soccfg['gens'][FFChannel]
+        # the 16 shifted copies (with 3 clock cycles of prev_val in front) come from the waveform library
         if IQPulse is None:  # if not specified, assume constant of max value
-            # print("IQPulse is none, setting to length ", instance.cfg['FFlength'])
-            IQPulse = gain * np.ones(instance.cfg['FFlength'])
-        # add buffer to beginning of IQPulse
-        IQPulse = np.concatenate([prev_val * np.ones(48), IQPulse])
-        # print(IQPulse[:48 + 16])
+            shifted = FFWaveforms.shifted(FFChannel, gain, length, prev_val)
+        else:
+            if length != instance.cfg['FFlength']:
+                IQPulse = np.asarray(IQPulse)[:length]
+                IQPulse = np.concatenate([IQPulse, IQPulse[-1] * np.ones(length - len(IQPulse))])
+            shifted = FFWaveforms.shifted_array(FFChannel, IQPulse, prev_val)
+        qdata = np.zeros(shifted.shape[1])
         # now iterate through and add pulses
         for i in range(1, 17):
-            # create shifted pulse. Note all pulses are len(IQPulse) + 2 clock cycles!
-            idata = IQPulse[i:len(IQPulse) - 16 + i]
-            instance.add_pulse(ch=FFChannel, name=str(i), idata=idata, qdata=np.zeros_like(idata))
+            # shifted pulse. Note all pulses are len(IQPulse) + 2 clock cycles!
+            instance.add_pulse(ch=FFChannel, name=str(i), idata=shifted[i - 1], qdata=qdata)
         # set pulse register because we want to save the correct one (in register 4)
         instance.set_pulse_registers(ch=FFChannel, freq=0, phase=0, gain=gencfg['maxv'], style='arb',
                                      waveform='1', outsel="input")
@@ -55,7 +281,7 @@ def FFPulses_direct(instance, list_of_gains, length_dt,  previous_gains, t_start
         gencfg = instance.soccfg['gens'][instance.FFChannels[i]]
         if IQPulse is None:
             # print("[IQPulse] Using array of {}".format(gencfg['maxv']))
-            IQPulse = np.ones(length_dt) * gain
+            IQPulse = FFWaveforms.step(instance.FFChannels[i], gain, length_dt, previous_gains[i])
         else:
             # print("[IQPulse] Using custom array in gain units, assuming sampling per 1/16 clock cycle")
 
@@ -65,16 +291,7 @@ def FFPulses_direct(instance, list_of_gains, length_dt,  previous_gains, t_start
                                                                                       gencfg['maxv']))
 
         IQPulse = IQPulse[:length_dt]  # truncate pulse to desired length
-        if len(IQPulse) % 16 != 0:  # need to pad beginning
-            extralen = 16 - (len(IQPulse) % 16)
-            # print("  Padding pulse beginning: length {}, value {}".format(extralen, padval))
-            IQPulse = np.concatenate([previous_gains[i] * np.ones(extralen), IQPulse])
-        if len(IQPulse) // 16 < 3:
-            # print("  Padding pulse to 3ccs")
-            extralen = 48 - len(IQPulse)
-            IQPulse = np.concatenate([previous_gains[i] * np.ones(extralen), IQPulse])
-            print(IQPulse[:48])
-        # print(len(IQPulse))
+        IQPulse = clock_align(IQPulse, previous_gains[i])
 
         # figure out name and add pulse
         # print("waveforms: ", instance._gen_mgrs[i].pulses.keys())
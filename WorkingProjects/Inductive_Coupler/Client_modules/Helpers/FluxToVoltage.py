@@ -0,0 +1,94 @@
+#### minimal norm yoko voltages for a set of target fluxes, for any number of qubits and many targets at once
+#### every qubit can sit at one of 4 flux branches [low, -low, high, -high]. the voltages of a choice of branches are
+#### V = M^-1 (offsets + flux), and the choice with the smallest |V| is returned.
+#### up to max_combinations all 4^N choices are evaluated as one batched matrix product, above that a branch and
+#### bound search is used so the run time does not grow as 4^N
+
+import itertools
+import numpy as np
+
+NUM_BRANCHES = 4
+
+
+def flux_branches(fluxes_low, fluxes_high):
+    """
+    fluxes_low, fluxes_high: [..., N]
+    returns: [..., N, 4], the flux of every branch of every qubit
+    """
+    fluxes_low = np.asarray(fluxes_low, dtype=float)
+    fluxes_high = np.asarray(fluxes_high, dtype=float)
+    return np.stack([fluxes_low, -fluxes_low, fluxes_high, -fluxes_high], axis=-1)
+
+
+def _solve_all(branches, Voltage_matrix_inverse, FluxQuanta_offsets, chunk_elements=2**24):
+    #### every branch choice at once: branches [B, N, 4] -> voltages [B, N]
+    B, N = branches.shape[:2]
+    combs = np.array(list(itertools.product(range(NUM_BRANCHES), repeat=N)))  ### [4^N, N]
+    best = np.empty((B, N))
+    chunk = max(1, chunk_elements // (len(combs) * N))
+    for start in range(0, B, chunk):
+        sel = branches[start:start + chunk]
+        ### flux of every combination: [b, 4^N, N]
+        flux_array = np.take_along_axis(sel[:, np.newaxis, :, :],
+                                        combs[np.newaxis, :, :, np.newaxis], axis=-1)[..., 0]
+        voltages = (FluxQuanta_offsets + flux_array) @ Voltage_matrix_inverse.T
+        idx = np.argmin(np.sum(voltages ** 2, axis=-1), axis=-1)
+        best[start:start + chunk] = voltages[np.arange(len(sel)), idx]
+    return best
+
+
+def _solve_branch_and_bound(branches, Voltage_matrix_inverse, FluxQuanta_offsets):
+    #### |M^-1 (o + f)|^2 = |R (o + f)|^2 with R upper triangular (QR of M^-1), row k of R only depends on the
+    #### fluxes k..N-1. choosing the qubits from the last to the first, the sum over the rows already fixed is a
+    #### lower bound for every completion, so a branch is dropped as soon as it is above the best full choice.
+    B, N = branches.shape[:2]
+    R = np.linalg.qr(Voltage_matrix_inverse, mode='r')
+    best = np.empty((B, N))
+    for idx_b in range(B):
+        x = FluxQuanta_offsets[:, np.newaxis] + branches[idx_b]  ### [N, 4] o_k + f_k for every branch
+        best_norm = np.inf
+        best_choice = None
+        vals = np.zeros(N)  ### o + f of the branches chosen so far, filled from the last qubit down
+
+        #### depth first over the qubits, partial: norm of the rows k+1..N-1
+        def search(k, partial):
+            nonlocal best_norm, best_choice
+            ### contribution of row k for each branch of qubit k, the later qubits are already fixed
+            row_rest = R[k, k + 1:] @ vals[k + 1:]
+            costs = partial + (R[k, k] * x[k] + row_rest) ** 2
+            for branch in np.argsort(costs):
+                if costs[branch] >= best_norm:
+                    break
+                vals[k] = x[k, branch]
+                if k == 0:
+                    best_norm = costs[branch]
+                    best_choice = vals.copy()
+                else:
+                    search(k - 1, costs[branch])
+
+        search(N - 1, 0.0)
+        best[idx_b] = Voltage_matrix_inverse.dot(best_choice)
+    return best
+
+
+def flux_to_voltage(flux_quanta, Voltage_matrix_inverse, FluxQuanta_offsets, minimum_only=False,
+                    max_combinations=NUM_BRANCHES ** 8):
+    """
+    flux_quanta: (fluxes_low, fluxes_high), each [N] for one target or [..., N] for a batch of targets
+    Voltage_matrix_inverse: [N, N], FluxQuanta_offsets: [N]
+    max_combinations: above this many branch choices (4^N) the branch and bound search is used
+    returns: minimal norm voltages with the shape of fluxes_low
+    """
+    fluxes_low, fluxes_high = flux_quanta
+    branches = flux_branches(fluxes_low, fluxes_high)
+    out_shape = branches.shape[:-1]
+    branches = branches.reshape((-1,) + branches.shape[-2:])
+    Voltage_matrix_inverse = np.asarray(Voltage_matrix_inverse, dtype=float)
+    FluxQuanta_offsets = np.asarray(FluxQuanta_offsets, dtype=float)
+
+    if NUM_BRANCHES ** branches.shape[1] <= max_combinations:
+        voltages = _solve_all(branches, Voltage_matrix_inverse, FluxQuanta_offsets)
+    else:
+        voltages = _solve_branch_and_bound(branches, Voltage_matrix_inverse, FluxQuanta_offsets)
+
+    return voltages.reshape(out_shape)
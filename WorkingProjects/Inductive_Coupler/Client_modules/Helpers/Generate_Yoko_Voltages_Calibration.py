@@ -1,38 +1,13 @@
 
-import itertools
 import numpy as np
 import pickle
+from WorkingProjects.Inductive_Coupler.Client_modules.Helpers.FluxToVoltage import flux_to_voltage
 
 
 def voltage_to_flux(voltage_vector, voltage_matrix, offset_vector):
     return (voltage_matrix.dot(voltage_vector) - offset_vector)
 
 
-# for more qubits, change repeat = 4 in itertools:
-x = [0, 1, 2, 3]  # this should remain 4 because this counts the different fluxes:[fluxlow, -low, high, -high]
-all_combinatorics = [p for p in itertools.product(x, repeat=4)]
-
-
-def flux_to_voltage(flux_quanta, Voltage_matrix_inverse, FluxQuanta_offsets, minimum_only=False):
-    fluxes_low, fluxes_high = flux_quanta
-    all_flux_quantas = []
-    for i in range(len(fluxes_low)):
-        all_flux_quantas.append([fluxes_low[i], -fluxes_low[i], fluxes_high[i], -fluxes_high[i]])
-
-    minimum = np.inf
-    minimum_voltages = np.array([0, 0, 0])
-    for comb in all_combinatorics:
-        index1, index2, index3, index4 = comb
-        flux_array = [all_flux_quantas[0][index1], all_flux_quantas[1][index2], all_flux_quantas[2][index3],
-                      all_flux_quantas[3][index4]]
-        voltages = Voltage_matrix_inverse.dot(FluxQuanta_offsets + flux_array)
-        voltages_squared = np.sum(voltages ** 2)
-        if voltages_squared < minimum:
-            minimum = voltages_squared
-            minimum_voltages = voltages
-
-    return (minimum_voltages)
-
 def Ej(d, phiext):
     '''
     phiext is in units of flux quanta
@@ -50,8 +25,9 @@ def Flux_Freq(frequency_array, list_of_dictionaries):
     fluxes_low = []
     fluxes_high = []
 
-    for i in range(len(frequency_array)):
-        freq = frequency_array[i]
+    frequency_array = np.asarray(frequency_array)
+    for i in range(frequency_array.shape[-1]):
+        freq = frequency_array[..., i]
         parameter = list_of_dictionaries[i]
         d = parameter['di']
         offset = parameter['EjEc']
@@ -59,7 +35,7 @@ def Flux_Freq(frequency_array, list_of_dictionaries):
         fluxes_low.append(flux(freq, offset, d))
         fluxes_high.append(1 - flux(freq, offset, d))
 
-    return (np.array(fluxes_low), np.array(fluxes_high))
+    return (np.stack(fluxes_low, axis=-1), np.stack(fluxes_high, axis=-1))
 
 
 def Freq_to_Voltage(frequency_list, list_of_dictionaries, inverse_voltage_matrix, offset_vector):
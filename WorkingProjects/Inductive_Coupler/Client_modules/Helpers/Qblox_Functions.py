@@ -3,11 +3,51 @@ import numpy as np
 import time
 
 class Qblox():
-    def __init__(self, COM_speed = 1e6, port = 'COM3', timeout = 1, reset_voltages = False):
+    '''
+    Controller for the D5a module of the SPI rack. The serial session is opened on first use and kept open until
+    close() (or the end of a with block), so a sweep only pays the connection and settle time once.
+    persistent = False gives the old behaviour of opening and closing the session for every call.
+    The voltages last written are cached by D5aModule.voltages, so a ramp never reads the DACs back first.
+    '''
+    def __init__(self, COM_speed = 1e6, port = 'COM3', timeout = 1, reset_voltages = False, module = 2,
+                 persistent = True, settle_time = 2, spi_rack_class = SPIRack):
         self.COM_speed = COM_speed
         self.port = port
         self.timeout = timeout
         self.reset_voltages = reset_voltages
+        self.module = module
+        self.persistent = persistent
+        self.settle_time = settle_time ### wait after opening the session and after a non persistent ramp
+        self.spi_rack_class = spi_rack_class ### FakeSPIRack to run without the rack
+        self.spi_rack = None
+        self.D5a = None
+
+    def connect(self):
+        if self.D5a is None:
+            self.spi_rack = self.spi_rack_class(self.port, self.COM_speed, self.timeout)
+            self.D5a = D5aModule(self.spi_rack, module=self.module, reset_voltages=self.reset_voltages)
+            time.sleep(self.settle_time)
+        return self.D5a
+
+    def close(self):
+        if self.spi_rack is not None:
+            self.spi_rack.close()
+        self.spi_rack = None
+        self.D5a = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _done(self):
+        #### end of a call, only closes the session when it is not kept open
+        if not self.persistent:
+            time.sleep(self.settle_time)
+            self.close()
+
     def set_range(self, range_number = None):
         '''
         range_numbers:
@@ -15,37 +55,132 @@ class Qblox():
         # -4 to 4 Volt: range_4V_bi (span 2)
         # -2 to 2 Volt: range_2V_bi (span 4)
         '''
-        spi_rack = SPIRack(self.port, self.COM_speed, self.timeout)
-        D5a = D5aModule(spi_rack, module=2, reset_voltages=self.reset_voltages)
-        time.sleep(2)
+        D5a = self.connect()
         if type(range_number) == int:
-            for i in range(D5a._num_dacs):
-                if not D5a.get_settings(i)[1] == range_number:
-                    current_settings = D5a.get_settings(i)
-                    D5a.change_span(i, range_number)
-                    D5a.set_voltage(i, current_settings[0])
+            span = range_number
         else:
             span = D5a.range_4V_bi
-            for i in range(D5a._num_dacs):
-                if not D5a.get_settings(i)[1] == span:
-                    current_settings = D5a.get_settings(i)
-                    D5a.change_span(i, span)
-                    D5a.set_voltage(i, current_settings[0])
-        time.sleep(2)
-        spi_rack.close()
+        for i in range(D5a._num_dacs):
+            if not D5a.span[i] == span:
+                current_voltage = D5a.voltages[i]
+                D5a.change_span(i, span)
+                D5a.set_voltage(i, current_voltage)
+        self._done()
 
     def set_voltage(self, DACs, voltages, ramp_step=None, ramp_interval=None):
-        spi_rack = SPIRack(self.port, self.COM_speed, self.timeout)
-        D5a = D5aModule(spi_rack, module=2, reset_voltages=self.reset_voltages)
-        time.sleep(2)
+        '''
+        Ramp all the DACs together: every ramp_interval each DAC that has not reached its target moves one
+        ramp_step, so the ramp takes as long as the largest move instead of the sum of all of them.
+        A DAC that is already at its target (within one DAC step) is not written at all.
+        '''
+        D5a = self.connect()
+        if ramp_step is None:
+            ramp_step = D5a.ramp_step
+        if ramp_interval is None:
+            ramp_interval = D5a.ramp_interval
+
+        ramps = []
         for DA, vol in zip(DACs, voltages):
-            D5a.set_voltage_ramp(DA, vol, ramp_step=ramp_step, ramp_interval=ramp_interval)
-        time.sleep(2)
-        spi_rack.close()
+            DA = int(DA)
+            if D5a.span[DA] == D5a.range_4V_uni:
+                raise ValueError('Span is set to range_4V_uni (0). Check connection ')
+            current_voltage = D5a.voltages[DA]
+            if np.abs(current_voltage - vol) < D5a.get_stepsize(DA):
+                continue
+            ### same steps as D5aModule.set_voltage_ramp, ending on the target
+            steps = np.arange(current_voltage, vol, np.sign(vol - current_voltage) * ramp_step)[1:]
+            ramps.append((DA, np.append(steps, vol)))
 
-    def print_voltages(self):
-        spi_rack = SPIRack(self.port, self.COM_speed, self.timeout)
-        D5a = D5aModule(spi_rack, module=2, reset_voltages=self.reset_voltages)
-        for i in range(D5a._num_dacs):
-            print(f'{i}: {np.round(D5a.get_settings(i)[0], 4)} V')
-        spi_rack.close()
+        num_steps = max([len(steps) for DA, steps in ramps], default = 0)
+        for idx_step in range(num_steps):
+            ### the next step waits until ramp_interval after the start of this one, so the write time is not added on
+            ### top, but a slow write pushes the next steps back instead of bunching them up
+            t_step = time.time()
+            for DA, steps in ramps:
+                if idx_step < len(steps):
+                    D5a.set_voltage(DA, steps[idx_step])
+            if idx_step < num_steps - 1:
+                time.sleep(max(0, t_step + ramp_interval - time.time()))
+        self._done()
+
+    def get_voltages(self, read = False):
+        '''
+        voltages of all DACs, from the cache unless read is True
+        '''
+        D5a = self.connect()
+        if read:
+            for i in range(D5a._num_dacs):
+                D5a.get_settings(i)
+        voltages = list(D5a.voltages)
+        self._done()
+        return voltages
+
+    def print_voltages(self, read = False):
+        for i, voltage in enumerate(self.get_voltages(read = read)):
+            print(f'{i}: {np.round(voltage, 4)} V')
+
+
+class FakeSPIRack():
+    '''
+    Stand in for SPIRack that answers the D5a (LTC2758) commands, used to run and time Qblox without the rack.
+    byte_time: time a byte takes on the serial bus, 1e6 baud with 10 bits per byte is 1e-5 s
+    '''
+    def __init__(self, port = 'COM3', baud = 1e6, timeout = 1, byte_time = 1e-5):
+        self.port = port
+        self.byte_time = byte_time
+        self.codes = {} ### (module, DAC) -> 18 bit DAC code
+        self.spans = {} ### (module, DAC) -> span
+        self.writes = 0
+
+    def unlock(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _dac(self, module, chip, data):
+        return (module, 2 * chip + (data[0] & 0b1111) // 2)
+
+    def write_data(self, module, chip, SPI_mode, SPI_speed, data):
+        time.sleep(self.byte_time * (len(data) + 1))
+        self.writes += 1
+        command = data[0] >> 4
+        dac = self._dac(module, chip, data)
+        if command in [0b0010, 0b0110]:
+            self.spans[dac] = data[2]
+        elif command in [0b0011, 0b0111]:
+            self.codes[dac] = (data[1] << 10) | (data[2] << 2) | (data[3] >> 6)
+
+    def read_data(self, module, chip, SPI_mode, SPI_speed, data):
+        time.sleep(self.byte_time * 2 * (len(data) + 1))
+        command = data[0] >> 4
+        dac = self._dac(module, chip, data)
+        if command == 0b1101:
+            code = self.codes.get(dac, 2 ** 17) ### midscale, 0 V on the bipolar spans
+            return bytearray([0, (code >> 10) & 0xFF, (code >> 2) & 0xFF, (code & 0b11) << 6])
+        return bytearray([0, 0, self.spans.get(dac, D5aModule.range_4V_bi), 0])
+
+
+def benchmark(DACs = (0, 1, 2, 3), voltage = 0.3, ramp_interval = 0.01):
+    '''
+    time a move of all DACs with one DAC after the other (D5aModule.set_voltage_ramp) and with the interleaved ramp
+    '''
+    spi_rack = FakeSPIRack()
+    D5a = D5aModule(spi_rack, module=2, reset_voltages=False)
+    start = time.time()
+    for DA in DACs:
+        D5a.set_voltage_ramp(DA, voltage, ramp_interval=ramp_interval)
+    t_sequential = time.time() - start
+
+    qblox = Qblox(spi_rack_class = FakeSPIRack, settle_time = 0)
+    qblox.connect()
+    start = time.time()
+    qblox.set_voltage(DACs, [voltage] * len(DACs), ramp_interval=ramp_interval)
+    t_interleaved = time.time() - start
+    print('sequential: ' + str(round(t_sequential, 2)) + ' s, interleaved: ' + str(round(t_interleaved, 2)) + ' s')
+    print(qblox.get_voltages(read = True)[:len(DACs)])
+    qblox.close()
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -97,4 +97,41 @@ def hist_process(data=None, plot=True, ran=None, figNum = 1, title = '', alpha =
         # axs[2].set_title(f"Fidelity = {fid * 100:.2f}%; Thresh: {threshold:.3f}")
         axs[2].set_title(f"Fi: {fid * 100:.1f}%; Thr: {threshold:.1f}; ne: {ne_contrast:.2f}, ng: {ng_contrast:.2f}")
 
-    return fid, threshold, theta
\ No newline at end of file
+    return fid, threshold, theta
+
+def hist_process_batch(data):
+    """
+    hist_process for a stack of sweep points at once, without any plotting
+    data: [ig, qg, ie, qe], each an array of shape [..., shots], e.g. [gain][freq][shot]
+    the threshold is exact, found from the sorted projections instead of a 200 bin histogram,
+    shots at or below the threshold are called g
+    returns: fid, threshold, theta, each of shape [...]
+    """
+    ig, qg, ie, qe = [np.asarray(d, dtype=float) for d in data]
+
+    """Compute the rotation angle"""
+    theta = -np.arctan2(np.median(qe, axis=-1) - np.median(qg, axis=-1),
+                        np.median(ie, axis=-1) - np.median(ig, axis=-1))
+
+    """Rotate the IQ data, only the projection on the new I axis is needed"""
+    cos_t = np.cos(theta)[..., np.newaxis]
+    sin_t = np.sin(theta)[..., np.newaxis]
+    ig_new = ig * cos_t - qg * sin_t
+    ie_new = ie * cos_t - qe * sin_t
+
+    """Sort all shots together, every g shot below a threshold adds 1/Ng to the contrast and every e shot -1/Ne"""
+    proj = np.concatenate((ig_new, ie_new), axis=-1)
+    weights = np.concatenate((np.full(ig_new.shape, 1.0 / ig_new.shape[-1]),
+                              np.full(ie_new.shape, -1.0 / ie_new.shape[-1])), axis=-1)
+    order = np.argsort(proj, axis=-1)
+    proj = np.take_along_axis(proj, order, axis=-1)
+    contrast = np.cumsum(np.take_along_axis(weights, order, axis=-1), axis=-1)
+
+    ### a threshold can only sit between two different values, so equal shots are always called the same
+    contrast[..., :-1][np.diff(proj, axis=-1) == 0] = -np.inf
+
+    tind = np.argmax(contrast, axis=-1)[..., np.newaxis]
+    fid = np.take_along_axis(contrast, tind, axis=-1)[..., 0]
+    threshold = np.take_along_axis(proj, tind, axis=-1)[..., 0]
+
+    return fid, threshold, theta
@@ -1,7 +1,9 @@
 import numpy as np
 from getInputDicts import *
 
-def printSweepTime(chipDict,dBm_lookup_file):
+# timePerPoint: seconds per frequency point and rep, ResSweep.acquire measures it (data['data']['timePerPoint'] is per
+# point, divide by n_reps). .024 s was the time with a program built and loaded for every point
+def printSweepTime(chipDict,dBm_lookup_file,timePerPoint=.024):
     inputDicts = getInputDicts(chipDict,measType='power_sweep',dBm_lookup_file=dBm_lookup_file)
     inputDict=inputDicts[0]
-    print('Time per sweep (2 resonators):',sum(np.multiply(inputDict['n_roundsList'],inputDict['n_repsList']))*(.024*inputDict['n_expts'])/60,'min')
\ No newline at end of file
+    print('Time per sweep (2 resonators):',sum(np.multiply(inputDict['n_roundsList'],inputDict['n_repsList']))*(timePerPoint*inputDict['n_expts'])/60,'min')
\ No newline at end of file
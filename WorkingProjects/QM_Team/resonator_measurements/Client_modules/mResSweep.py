@@ -14,6 +14,7 @@ import pickle
 import os
 import warnings
 import PythonDrivers.readTempLog as tempLog
+from resonatorFit import fitResSweep, hangerS21, PARAMS
 
 # ============================================= #
 # Russell McLellan, supported by Sara Sussman and Sho Uemura
@@ -168,64 +169,53 @@ class ResSweep(ExperimentClass):
         return 20 * np.log10(np.abs(1 - ((Q0 / Qc) - 2j * Q0 * asymm / (2 * np.pi * freq0)) / (
                     1 + 2j * Q0 * (xData - freq0) / freq0))) + offset
 
+    # builds the ring up program and one sweep program per mixer frequency, once for the whole acquire, so the rounds
+    # after the first reuse them. The readouts are declared with gen_ch=res_ch, which fixes their downconversion
+    # frequency to the mixer frequency at build time, so a built program can't be retuned to another point
+    def buildPrograms(self):
+        cfgRing = dict(self.cfg, ring_time_gen=self.ring_up_time_gen, mixer_freq=self.mixerArray_f[0], reps=2)
+        progRing = ResSweepProgram(self.soccfg, cfgRing)
+        progsSweep = [ResSweepProgram(self.soccfg, dict(self.cfg, ring_time_gen=self.ring_between_time_gen,
+                                                         mixer_freq=f, reps=self.n_reps))
+                      for f in self.mixerArray_f]
+        return progRing, progsSweep
+
     # function to perform a frequency sweep
     def acquire(self, progress=False, debug=False):
-        diList = [[] for i in self.mixerArray_f]
-        dqList = [[] for i in self.mixerArray_f]
-        iqListRound = [[] for i in self.mixerArray_f]
-        ampArrayTMP = [np.asarray([0. for ii in self.mixerArray_f]) for i in self.res_f]
-        IArray = [np.asarray([0. for ii in self.mixerArray_f]) for i in self.res_f]
-        QArray = [np.asarray([0. for ii in self.mixerArray_f]) for i in self.res_f]
+        nCh = len(self.cfg['ro_chs'])
+        # I and Q of every point of every round, indexed as [round][readout channel][frequency]
+        IArrayRounds = np.zeros((self.n_rounds, nCh, len(self.mixerArray_f)))
+        QArrayRounds = np.zeros((self.n_rounds, nCh, len(self.mixerArray_f)))
+
+        progRing, progsSweep = self.buildPrograms()
+        self.cfg['reps'] = self.n_reps
+        self.cfg['ring_time_gen'] = self.ring_between_time_gen
 
         start = time.time()
         for roundInd in range(self.n_rounds):
             roundStart = time.time()
 
             # ring up the resonator
-            self.cfg['ring_time_gen'] = self.ring_up_time_gen
-            self.cfg['mixer_freq'] = self.mixerArray_f[0]
-            self.cfg['reps'] = 2
-            prog = ResSweepProgram(self.soccfg, self.cfg)
-            dummy = prog.acquire(self.soc, load_pulses=True, debug=False) # we throw out the data we collect during ring up
-
-            # acquire sweeps of data
-            self.cfg['reps'] = self.n_reps
-            self.cfg['ring_time_gen'] = self.ring_between_time_gen
-            for fInd, f in enumerate(tqdm(self.mixerArray_f)):
-                self.cfg['mixer_freq'] = f
-                # if fInd % 50 == 0:
-                #     print('{0}: {1:0.2f} s'.format(fInd, time.time() - roundStart))
-                # freqStart = time.time()
-                prog = ResSweepProgram(self.soccfg, self.cfg)
-                print(np.shape(iqListRound[fInd]))
-                print(np.shape(prog.acquire(self.soc, load_pulses=True, debug=False)))
+            dummy = progRing.acquire(self.soc, load_pulses=(roundInd == 0), debug=debug) # we throw out the data we collect during ring up
+
+            # acquire sweeps of data. All pulses are const, there are no envelopes to load after the first point
+            for fInd, progSweep in enumerate(tqdm(progsSweep)):
+                avg_di, avg_dq = progSweep.acquire(self.soc, load_pulses=(roundInd == 0 and fInd == 0), debug=debug)
 
                 # compensate for non-zero centered I and Q values
-                for i in range(len(self.cfg['ro_chs'])):
-                    iqListRound[fInd][0][i] += self.IQoffset
-                    iqListRound[fInd][1][i] += self.IQoffset
-                # diList[fInd] = prog.di_buf
-                # dqList[fInd] = prog.dq_buf
-                # print('Frequency {0}, time {1:0.3f} s'.format(fInd, time.time() - freqStart))
-
-            # add the frequencies to older measurements
-            for IQInd in range(len(self.cfg['ro_chs'])):
-                for freqInd, iq in enumerate(iqListRound):
-                    ampArrayTMP[IQInd][freqInd] += abs(np.asarray(iq[0][IQInd]) + 1j * np.asarray(iq[1][IQInd]))
-                    IArray[IQInd][freqInd] += np.asarray(iq[0][IQInd])
-                    QArray[IQInd][freqInd] += np.asarray(iq[1][IQInd])
+                IArrayRounds[roundInd, :, fInd] = np.reshape(avg_di, (nCh, -1))[:, 0] + self.IQoffset
+                QArrayRounds[roundInd, :, fInd] = np.reshape(avg_dq, (nCh, -1))[:, 0] + self.IQoffset
 
             print('Round {0}, time {1:0.3f} s'.format(roundInd, time.time() - roundStart))
 
         print('Final time = {0:0.3f} s'.format(time.time() - start))
+        self.timePerPoint = (time.time() - start) / (self.n_rounds * len(self.mixerArray_f))
 
-        # normalize measurements and find amplitudes
-        ampArray = [i/self.n_rounds for i in ampArrayTMP]
+        # reps are coherent averages of I and Q, rounds average amplitudes only
+        ampArray = np.mean(np.abs(IArrayRounds + 1j * QArrayRounds), axis=0)
         ampArray_log = 20*np.log10(ampArray)
-
-        for i in range(len(self.cfg['ro_chs'])):
-            IArray[i] = IArray[i]/self.n_rounds
-            QArray[i] = QArray[i] / self.n_rounds
+        IArray = np.mean(IArrayRounds, axis=0)
+        QArray = np.mean(QArrayRounds, axis=0)
 
         data={'config': self.cfg,
               'inputDict': self.inputDict,
@@ -234,12 +224,15 @@ class ResSweep(ExperimentClass):
                   'ampArray_log': ampArray_log,
                   'IArray': IArray,
                   'QArray': QArray,
+                  'IArrayRounds': IArrayRounds,
+                  'QArrayRounds': QArrayRounds,
                   'f': self.resArray_f,
                   'power': self.inputDict['power'],
                   # 'diList': diList,
                   # 'dqList': dqList,
                   'endTime': time.time(),
                   'startTime': start,
+                  'timePerPoint': self.timePerPoint,
                   'temperature_mK': self.readTemp()
               }}
         self.data=data
@@ -260,20 +253,18 @@ class ResSweep(ExperimentClass):
 
         return logTemp
 
-    # call this function after acquire to plot the results with a preliminary fit
+    # call this function after acquire to plot the results with a preliminary fit. All channels are fitted together
+    # with the complex hanger model from resonatorFit, the fit results are returned. The cable delay in us is taken
+    # from inputDict['cable_delay'] if it was measured, otherwise it is estimated from the traces
     def display(self, data=None, fit=True, **kwargs):
         if data == None:
             data = self.data
         data = data['data']
 
-        pOpt = [[] for i in self.res_f]
-        pCov = [[] for i in self.res_f]
-        for i in range(len(self.cfg['ro_chs'])):
-            centerF = self.resArray_f[i][data['ampArray_log'][i].argmin()]
-            pOpt[i], pCov[i] = curve_fit(self.hangerFit, (self.resArray_f[i]) * 10 ** 6, data['ampArray_log'][i],
-                                         p0=[(centerF) * 10 ** 6, 1e6, 1e6, 0, 0], maxfev=100000)
-            pOpt[i][1] = abs(pOpt[i][1])
-            pOpt[i][2] = abs(pOpt[i][2])
+        fits = None
+        if fit:
+            fits = fitResSweep(data, tau=self.inputDict.get('cable_delay'))
+            self.fits = fits
 
         if len(self.cfg['ro_chs']) == 1:
             fig, axs = plt.subplots(1, 1, figsize=(4.5, 4.5), dpi=75)
@@ -295,16 +286,23 @@ class ResSweep(ExperimentClass):
 
         for i in range(len(self.cfg['ro_chs'])):
             axs[i].plot(self.resArray_f[i], data['ampArray_log'][i], '.', label='data', markersize=2)
-            axs[i].plot(self.resArray_f[i], self.hangerFit((self.resArray_f[i]) * 10 ** 6, *pOpt[i]), label='fit')
+            if fit:
+                fitS21 = hangerS21(self.resArray_f[i], [fits[name][i] for name in PARAMS], fits['fRef'][i])
+                axs[i].plot(self.resArray_f[i], 20 * np.log10(np.abs(fitS21)), label='fit')
             axs[i].set_ylabel('10log10(I^2 + Q^2)')
             axs[i].set_xlabel('Frequency [MHz]')
             axs[i].legend(loc='best')
-            axs[i].set_title('f = {0:.0f} MHz, Q_int = {1:0.4e} , Q_c = {2:0.4e}'.format(self.res_f[i], pOpt[i][1], pOpt[i][2]))
+            if fit:
+                axs[i].set_title('f = {0:.0f} MHz, Q_int = {1:0.4e} , Q_c = {2:0.4e}'.format(self.res_f[i], fits['Qi'][i], fits['Qc'][i]))
+            else:
+                axs[i].set_title('f = {0:.0f} MHz'.format(self.res_f[i]))
             axs[i].grid()
 
         plt.savefig(self.path+'/'+self.filename+'_sweep.png', bbox_inches='tight')
         plt.show()
 
+        return fits
+
     # call this function after acquire to save the data
     def save_data(self, data=None):
         print(f'Saving {self.filename}')
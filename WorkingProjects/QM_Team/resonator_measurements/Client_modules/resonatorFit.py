@@ -0,0 +1,346 @@
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# ============================================= #
+# Batch fits of the complex hanger model to resonator sweeps
+#
+# Purpose of this file is to fit many S21 traces at once, e.g. all readout channels of all powers of a power sweep,
+# instead of one curve_fit per trace on the dB magnitude. The model is the complex hanger response
+#
+#   S21(f) = a exp(i(alpha - 2 pi (f - fRef) tau)) (1 - (Q/Qc) exp(i phi) / (1 + 2i Q (f - f0)/f0))
+#
+# with Q the loaded quality factor, Qc the magnitude of the coupling quality factor, phi the impedance mismatch
+# (asymmetry) angle and 1/Qi = 1/Q - cos(phi)/Qc. Frequencies are in MHz, so tau is in us.
+#
+# Fitting is done in three steps, all vectorized over traces:
+# 0. unless it is given, the cable delay is estimated from the phase slope off resonance and left free in step 2.
+#    The complex model is sensitive to the delay, where the dB magnitude was not
+# 1. an algebraic (Kasa) circle fit in the IQ plane, and the phase around the circle center, give starting values
+#    for all parameters without any iteration
+# 2. Levenberg-Marquardt on the real and imaginary residuals with the analytic Jacobian of the model. All traces
+#    take their steps together, with their own damping
+# Large batches can also be split over worker processes. When workers > 1 on Windows the calling script needs the
+# usual if __name__ == '__main__' guard.
+#
+# Parameter order everywhere is PARAMS. fitHanger returns a dictionary of arrays, one entry per trace
+# ============================================= #
+
+PARAMS = ['f0', 'Q', 'Qc', 'phi', 'a', 'alpha', 'tau']
+
+
+# complex hanger model. f is (..., N), params is (..., 7), fRef is (...) or a scalar
+def hangerS21(f, params, fRef=None):
+    f = np.asarray(f, dtype=float)
+    params = np.asarray(params, dtype=float)
+    if fRef is None:
+        fRef = f[..., f.shape[-1] // 2]
+    f0, Q, Qc, phi, a, alpha, tau = [params[..., i, None] for i in range(len(PARAMS))]
+    g = 1 + 2j * Q * (f - f0) / f0
+    pre = a * np.exp(1j * (alpha - 2 * np.pi * (f - np.asarray(fRef)[..., None]) * tau))
+    return pre * (1 - (Q / Qc) * np.exp(1j * phi) / g)
+
+
+# model and its analytic derivatives with respect to PARAMS, jac is (..., 7, N) so every derivative is contiguous
+def hangerJacobian(f, params, fRef):
+    f0, Q, Qc, phi, a, alpha, tau = [params[..., i, None] for i in range(len(PARAMS))]
+    df = f - fRef[..., None]
+    x = (f - f0) / f0
+    g = 1 + 2j * Q * x
+    pre = a * np.exp(1j * (alpha - 2 * np.pi * df * tau))
+    u = pre * ((Q / Qc) * np.exp(1j * phi)) / g
+    v = u / g
+    S = pre - u
+
+    jac = np.empty(S.shape[:-1] + (len(PARAMS),) + S.shape[-1:], dtype=complex)
+    jac[..., 0, :] = v * (-2j * Q / f0) * (f / f0)
+    jac[..., 1, :] = -u / Q + v * (2j * x)
+    jac[..., 2, :] = u / Qc
+    jac[..., 3, :] = -1j * u
+    jac[..., 4, :] = S / a
+    jac[..., 5, :] = 1j * S
+    jac[..., 6, :] = (-2j * np.pi) * df * S
+    return S, jac
+
+
+# algebraic circle fit x^2 + y^2 + D x + E y + F = 0 for every trace of z (K, N). Returns centers and radii
+def circleFit(z):
+    x, y = z.real, z.imag
+    M = np.stack([x, y, np.ones_like(x)], axis=-1)
+    b = -(x ** 2 + y ** 2)
+    coeffs = np.linalg.solve(np.einsum('kni,knj->kij', M, M), np.einsum('kni,kn->ki', M, b)[..., None])[..., 0]
+    D, E, F = np.moveaxis(coeffs, -1, 0)
+    zc = -D / 2 - 1j * E / 2
+    r = np.sqrt(np.maximum(np.abs(zc) ** 2 - F, 0))
+    return zc, r
+
+
+# cable delay in us of every trace of z (K, N) from the phase slope of the first and last edge of the points, which
+# are mostly off resonance. The resonance still tilts the edges a little, the fit refines the delay from here
+def estimateDelay(f, z, edge=0.1):
+    N = z.shape[1]
+    n = max(int(edge * N), 2)
+    phase = np.unwrap(np.angle(z), axis=1)
+    # slope on each side separately, the resonance in between adds a phase jump
+    slopes = []
+    for side in (slice(0, n), slice(N - n, N)):
+        x = f[:, side] - np.mean(f[:, side], axis=1, keepdims=True)
+        y = phase[:, side] - np.mean(phase[:, side], axis=1, keepdims=True)
+        slopes.append(np.sum(x * y, axis=1) / np.sum(x * x, axis=1))
+    return -np.mean(slopes, axis=0) / (2 * np.pi)
+
+
+# starting values from the circle. The phase around the center drops by up to 2 pi through the resonance, f0 is
+# where it is halfway and the linewidth f0/Q is the distance between the points a quarter turn to either side.
+# The off resonant point is opposite to f0 on the circle and sets the amplitude and phase normalization
+def guessHanger(f, z, fRef, tau=0.):
+    K = z.shape[0]
+    rows = np.arange(K)
+    tau = np.broadcast_to(np.asarray(tau, dtype=float), (K,))
+    z = z * np.exp(2j * np.pi * (f - fRef[:, None]) * tau[:, None])
+    zc, r = circleFit(z)
+    theta = np.unwrap(np.angle(z - zc[:, None]), axis=1)
+    mid = (theta[:, 0] + theta[:, -1]) / 2
+
+    i0 = np.argmin(np.abs(theta - mid[:, None]), axis=1)
+    iA = np.argmin(np.abs(theta - (mid + np.pi / 2)[:, None]), axis=1)
+    iB = np.argmin(np.abs(theta - (mid - np.pi / 2)[:, None]), axis=1)
+    f0 = f[rows, i0]
+    fwhm = np.maximum(np.abs(f[rows, iB] - f[rows, iA]), np.abs(f[:, 1] - f[:, 0]))
+    Q = f0 / fwhm
+
+    P = zc - r * np.exp(1j * mid)
+    a = np.abs(P)
+    rNorm = r / a
+    phi = np.angle(1 - zc / P)
+    Qc = Q / (2 * rNorm)
+
+    return np.stack([f0, Q, Qc, phi, a, np.angle(P), tau], axis=-1)
+
+
+# cost, normal matrix and gradient of the free parameters. The fit is least squares on the real and imaginary parts,
+# whose normal matrix and gradient are the real parts of J^H J and J^H res
+def _residuals(f, z, params, fRef, free):
+    S, jac = hangerJacobian(f, params, fRef)
+    res = S - z
+    J = jac[:, free]
+    Jc = np.conj(J)
+    A = np.matmul(Jc, np.swapaxes(J, 1, 2)).real
+    grad = np.matmul(Jc, res[..., None])[..., 0].real
+    return np.sum(np.abs(res) ** 2, axis=1), A, grad
+
+
+# batched Levenberg-Marquardt with Marquardt scaling, each trace has its own damping
+def _levenbergMarquardt(f, z, params, fRef, free, maxIter=100, tol=1e-10):
+    K = z.shape[0]
+    lam = np.full(K, 1e-3)
+    cost, A, grad = _residuals(f, z, params, fRef, free)
+    active = np.ones(K, dtype=bool)
+    nIter = np.zeros(K, dtype=int)
+
+    for it in range(maxIter):
+        if not np.any(active):
+            break
+        # floor on the diagonal, a trace that wandered off (e.g. Qc far too large) can lose all sensitivity to a
+        # parameter and would leave the damped matrix singular
+        diag = np.einsum('kii->ki', A[active])
+        diag = np.maximum(diag, 1e-12 * np.max(diag, axis=1, keepdims=True) + 1e-300)
+        step = np.linalg.solve(A[active] + lam[active, None, None] * np.einsum('ki,ij->kij', diag, np.eye(len(free))),
+                               -grad[active][..., None])[..., 0]
+
+        trial = params[active].copy()
+        trial[:, free] += step
+        costTrial, ATrial, gradTrial = _residuals(f[active], z[active], trial, fRef[active], free)
+        better = costTrial < cost[active]
+
+        idx = np.flatnonzero(active)
+        good = idx[better]
+        params[good] = trial[better]
+        A[good] = ATrial[better]
+        grad[good] = gradTrial[better]
+        change = (cost[good] - costTrial[better]) / np.maximum(cost[good], 1e-300)
+        cost[good] = costTrial[better]
+        lam[good] /= 3
+        lam[idx[~better]] *= 4
+        nIter[active] += 1
+
+        # a trace is done when an accepted step barely changes its cost, or when the damping blows up
+        done = np.zeros(K, dtype=bool)
+        done[good[change < tol]] = True
+        done[lam > 1e12] = True
+        active &= ~done
+
+    # covariance of the free parameters, scaled by the residual variance. The parameters differ by many orders of
+    # magnitude, so the normal matrix is normalized to unit diagonal before it is inverted
+    scale = 1 / np.sqrt(np.maximum(np.einsum('kii->ki', A), 1e-300))
+    dof = max(2 * z.shape[1] - len(free), 1)
+    cov = np.linalg.pinv(A * scale[:, :, None] * scale[:, None, :]) * scale[:, :, None] * scale[:, None, :]
+    cov *= (cost / dof)[:, None, None]
+    return params, cov, cost, nIter
+
+
+def _fitBlock(f, z, fRef, tau, fitDelay, maxIter):
+    params = guessHanger(f, z, fRef, tau=tau)
+    free = np.arange(len(PARAMS)) if fitDelay else np.arange(len(PARAMS) - 1)
+    params, cov, cost, nIter = _levenbergMarquardt(f, z, params, fRef, free, maxIter=maxIter)
+    err = np.zeros_like(params)
+    err[:, free] = np.sqrt(np.abs(np.einsum('kii->ki', cov)))
+    return params, err, cov, cost, nIter
+
+
+def fitHanger(f, S21, tau=None, fitDelay=None, workers=1, blockSize=32, maxIter=100):
+    """
+    Fit the complex hanger model to a batch of traces.
+    f, S21 - (K, N) or (N,) arrays of frequency in MHz and complex transmission, all traces the same length
+    tau - cable delay in us of the traces as given, a scalar or one per trace. Estimated with estimateDelay if None
+    fitDelay - whether tau is a free parameter of the fit. If None it is free when it was estimated and fixed when
+               it was given, e.g. measured on a wide sweep. A sweep only a few linewidths wide barely constrains it
+               on its own, but does refine a good starting value
+    workers - number of processes, traces are handed out in blocks of blockSize
+    Returns a dictionary of (K,) arrays: PARAMS, their errors (key + '_err'), Qi and Qi_err, the residual cost,
+    the number of iterations and whether the trace was conjugated because it circles the other way round. phi,
+    alpha and tau of conjugated traces describe the conjugate of the trace
+    """
+    f = np.atleast_2d(np.asarray(f, dtype=float))
+    z = np.atleast_2d(np.asarray(S21, dtype=complex)).copy()
+    f = np.broadcast_to(f, z.shape).copy()
+    K = z.shape[0]
+    fRef = f[:, f.shape[1] // 2].copy()
+    if fitDelay is None:
+        fitDelay = tau is None
+    if tau is None:
+        tau = estimateDelay(f, z)
+    tau = np.broadcast_to(np.asarray(tau, dtype=float), (K,))
+
+    # the model circles clockwise with frequency, traces taken with the opposite IQ convention are conjugated. The
+    # direction is taken with the delay removed, a long delay can wind the trace the other way
+    zd = z * np.exp(2j * np.pi * (f - fRef[:, None]) * tau[:, None])
+    zc, r = circleFit(zd)
+    theta = np.unwrap(np.angle(zd - zc[:, None]), axis=1)
+    conjugated = theta[:, -1] > theta[:, 0]
+    z[conjugated] = np.conj(z[conjugated])
+    tau = np.where(conjugated, -tau, tau)
+
+    blocks = [(f[i:i + blockSize], z[i:i + blockSize], fRef[i:i + blockSize], tau[i:i + blockSize], fitDelay, maxIter)
+              for i in range(0, K, blockSize)]
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_fitBlock, *zip(*blocks)))
+    else:
+        results = [_fitBlock(*block) for block in blocks]
+    params, err, cov, cost, nIter = [np.concatenate(i) for i in zip(*results)]
+
+    # Q, Qc and a only enter squared or through the sign of the circle, report them positive
+    params[:, 1:3] = np.abs(params[:, 1:3])
+    f0, Q, Qc, phi = params[:, 0], params[:, 1], params[:, 2], params[:, 3]
+    Qi = 1 / (1 / Q - np.cos(phi) / Qc)
+    # error of Qi propagated from the covariance of Q, Qc and phi
+    grad = np.stack([Qi ** 2 / Q ** 2, -Qi ** 2 * np.cos(phi) / Qc ** 2, -Qi ** 2 * np.sin(phi) / Qc], axis=-1)
+    Qi_err = np.sqrt(np.abs(np.einsum('ki,kij,kj->k', grad, cov[:, 1:4, 1:4], grad)))
+
+    fits = {name: params[:, i] for i, name in enumerate(PARAMS)}
+    fits.update({name + '_err': err[:, i] for i, name in enumerate(PARAMS)})
+    fits.update({'Qi': Qi, 'Qi_err': Qi_err, 'fRef': fRef, 'cost': cost, 'nIter': nIter,
+                 'conjugated': conjugated})
+    return fits
+
+
+# fits all readout channels of one ResSweep acquisition. Accepts the dictionary returned by acquire or its 'data'
+def fitResSweep(data, **kwargs):
+    if 'data' in data:
+        data = data['data']
+    f = np.asarray(data['f'], dtype=float)
+    S21 = np.asarray(data['IArray']) + 1j * np.asarray(data['QArray'])
+    return fitHanger(f, S21, **kwargs)
+
+
+def fitPowerSweep(dataList, powers=None, **kwargs):
+    """
+    Fits every readout channel of every ResSweep acquisition of a power sweep in one batch.
+    dataList - list of dictionaries returned by ResSweep.acquire, one per power
+    powers - power of each acquisition, taken from data['power'] when not given
+    Returns a dictionary with 'power' (n_power,) and the fitHanger outputs reshaped to (n_power, n_ch)
+    """
+    dataList = [data['data'] if 'data' in data else data for data in dataList]
+    nCh = len(dataList[0]['f'])
+    f = np.concatenate([np.asarray(data['f'], dtype=float) for data in dataList])
+    S21 = np.concatenate([np.asarray(data['IArray']) + 1j * np.asarray(data['QArray']) for data in dataList])
+    fits = fitHanger(f, S21, **kwargs)
+
+    table = {key: value.reshape(len(dataList), nCh) for key, value in fits.items()}
+    if powers is None:
+        powers = [data.get('power', i) for i, data in enumerate(dataList)]
+    table['power'] = np.asarray(powers)
+    return table
+
+
+def printPowerSweep(table):
+    for ch in range(table['f0'].shape[1]):
+        print('Resonator {0}'.format(ch))
+        print('{0:>8} {1:>16} {2:>12} {3:>12} {4:>12}'.format('power', 'f0 [MHz]', 'Qi', 'Qi_err', 'Qc'))
+        for p in range(table['f0'].shape[0]):
+            print('{0:>8} {1:>16.6f} {2:>12.4e} {3:>12.2e} {4:>12.4e}'.format(
+                str(table['power'][p]), table['f0'][p, ch], table['Qi'][p, ch], table['Qi_err'][p, ch],
+                table['Qc'][p, ch]))
+
+
+# synthetic power sweep for checking the fits, with noise relative to the off resonant amplitude
+def simulatePowerSweep(nPowers=10, nCh=4, nPoints=451, noise=0.01, seed=0, tau=0.05):
+    rng = np.random.default_rng(seed)
+    K = nPowers * nCh
+    f0 = np.repeat([[6147.7, 6581.3, 7000.2, 7500.4]], nPowers, axis=0).ravel()[:K] if nCh == 4 else \
+        rng.uniform(6000, 7500, K)
+    Qi = rng.uniform(2e5, 2e6, K)
+    Qc = rng.uniform(2e5, 1e6, K)
+    phi = rng.uniform(-0.3, 0.3, K)
+    Q = 1 / (1 / Qi + np.cos(phi) / Qc)
+    span = 8 * f0 / Q
+    f = f0[:, None] + span[:, None] * np.linspace(-0.5, 0.5, nPoints) + rng.normal(0, 0.05, K)[:, None] * span[:, None]
+    params = np.stack([f0, Q, Qc, phi, rng.uniform(0.5, 2, K), rng.uniform(-np.pi, np.pi, K), np.full(K, tau)],
+                      axis=-1)
+    S21 = hangerS21(f, params)
+    S21 += noise * params[:, 4, None] * (rng.normal(size=S21.shape) + 1j * rng.normal(size=S21.shape))
+    return f, S21, params, Qi
+
+
+# compares the batch fit against one dB magnitude curve_fit per trace, as ResSweep.display did. The batch fit is not
+# told the delay, it estimates it like the measurement scripts do
+def benchmark(nPowers=10, nCh=4, workers=1, tau=0.05):
+    from scipy.optimize import curve_fit
+
+    def hangerFitDB(xData, freq0, QInt, Qc, asymm, offset):
+        Q0 = 1 / ((1 / QInt) + (1 / Qc))
+        return 20 * np.log10(np.abs(1 - ((Q0 / Qc) - 2j * Q0 * asymm / (2 * np.pi * freq0)) / (
+                1 + 2j * Q0 * (xData - freq0) / freq0))) + offset
+
+    f, S21, params, Qi = simulatePowerSweep(nPowers=nPowers, nCh=nCh, tau=tau)
+
+    start = time.time()
+    QiSerial = np.zeros(len(Qi))
+    for i in range(len(Qi)):
+        ampLog = 20 * np.log10(np.abs(S21[i]))
+        centerF = f[i][ampLog.argmin()]
+        try:
+            pOpt, pCov = curve_fit(hangerFitDB, f[i] * 10 ** 6, ampLog, p0=[centerF * 10 ** 6, 1e6, 1e6, 0, 0],
+                                   maxfev=100000)
+            QiSerial[i] = abs(pOpt[1])
+        except RuntimeError:
+            QiSerial[i] = np.nan
+    serialTime = time.time() - start
+
+    start = time.time()
+    fits = fitHanger(f, S21, workers=workers)
+    batchTime = time.time() - start
+
+    print('{0} traces'.format(len(Qi)))
+    print('serial dB curve_fit: {0:0.3f} s, median |Qi error| {1:0.2f} %'.format(
+        serialTime, 100 * np.nanmedian(np.abs(QiSerial / Qi - 1))))
+    print('batch complex fit: {0:0.3f} s, median |Qi error| {1:0.2f} %, max |f0 error| {2:0.3e} MHz, '
+          'max |tau error| {3:0.2e} us'.format(batchTime, 100 * np.median(np.abs(fits['Qi'] / Qi - 1)),
+                                              np.max(np.abs(fits['f0'] - params[:, 0])),
+                                              np.max(np.abs(np.where(fits['conjugated'], -1, 1) * fits['tau'] - tau))))
+    return serialTime, batchTime
+
+
+if __name__ == '__main__':
+    benchmark()
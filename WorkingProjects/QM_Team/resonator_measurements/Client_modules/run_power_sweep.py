@@ -1,5 +1,6 @@
 from getInputDicts import *
 import mResSweepDouble
+from resonatorFit import fitResSweep, fitPowerSweep, printPowerSweep
 import tqdm
 from PythonDrivers.control_atten import setatten
 from PythonDrivers.ldausbcli import CLI_Vaunix_Attn
@@ -27,19 +28,15 @@ def run_power_sweep(soc,soccfg,chipDict,dBm_lookup_file,channel_number=1):
                 with redirect_stderr(f):
                     data = mResSweepDouble.ResSweep.acquire(Instance)
         
-        pOpt, pCov = mResSweepDouble.ResSweep.display(Instance, data,fit=True)            
-        if len(inputDict['res_f']) == 2:
-            inputDict['res_f'] = [pOpt[0][0] / 1e6,
-              pOpt[1][0] / 1e6]
-            lw1 = pOpt[0][0] * ((1 / pOpt[0][1]) + (1 / pOpt[0][2])) / 1e6
-            lw2 = pOpt[1][0] * ((1 / pOpt[1][1]) + (1 / pOpt[1][2])) / 1e6
-            inputDict['span_f'] = [8. * lw1, 8. * lw2]
-        else:
-            inputDict['res_f'] = [pOpt[0][0] / 1e6]
-            lw1 = pOpt[0][0] * ((1 / pOpt[0][1]) + (1 / pOpt[0][2])) / 1e6
-            inputDict['span_f'] = [8. * lw1]
+        mResSweepDouble.ResSweep.display(Instance, data, fit=False)
+        # complex hanger fits of all resonators at once, the linewidth f0/Q sets the span of the power sweep. The cable
+        # delay is estimated from the traces unless inputDict['cable_delay'] gives it in us
+        fits = fitResSweep(data, tau=inputDict.get('cable_delay'))
+        inputDict['res_f'] = list(fits['f0'])
+        inputDict['span_f'] = list(8. * fits['f0'] / fits['Q'])
 
         # Run power sweep with updated parameters
+        dataList = []
         for i, atten in enumerate(inputDict['attenList']):
 
             if atten == 20:
@@ -71,4 +68,11 @@ def run_power_sweep(soc,soccfg,chipDict,dBm_lookup_file,channel_number=1):
                 with redirect_stderr(f):
                     data = mResSweepDouble.ResSweep.acquire(Instance)
             mResSweepDouble.ResSweep.display(Instance, data, fit=False)
-            mResSweepDouble.ResSweep.save_data(Instance, data)
\ No newline at end of file
+            mResSweepDouble.ResSweep.save_data(Instance, data)
+            dataList.append(data)
+
+        # fit all resonators at all powers together
+        fitTable = fitPowerSweep(dataList, powers=[inputDict['base_powers'] - atten for atten in inputDict['attenList']],
+                                 tau=inputDict.get('cable_delay'))
+        printPowerSweep(fitTable)
+        np.savez(os.path.join(inputDict['save_path'], 'powerSweepFits.npz'), **fitTable)
\ No newline at end of file
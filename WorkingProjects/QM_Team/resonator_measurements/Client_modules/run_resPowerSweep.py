@@ -1,4 +1,5 @@
 from mResSweep import *
+from resonatorFit import fitPowerSweep, printPowerSweep
 from socProxy import makeProxy
 import h5py
 from PythonDrivers.control_atten import setatten
@@ -47,6 +48,7 @@ input['n_expts'] = 451  # number of points along the frequency axis
 input['ring_up_time'] = 500  # time waiting for the resonator to ring up at the start of each sweep
 input['ring_between_time'] = 50  # time waiting for the resonator to ring up at the start of each sweep
 input['adc_trig_offset'] = 0.1  # time after the DAC starts the final steady pulse before the ADC starts it's read
+input['cable_delay'] = None  # cable delay in us for the fits, estimated from the traces if None
 
 # power
 input['basePower'] = 0
@@ -66,7 +68,8 @@ input['n_roundsList'] = [2]  # number of times to sweep along the frequency axis
 input['n_repsList'] = [100] # number of repetitions to take at each frequency point
 
 
-# Acquire
+# Acquire. The fits are done for the whole power sweep at the end
+dataList = []
 for i, atten in enumerate(input['attenList']):
     # update per power parameters
     input['power'] = input['basePower']-atten
@@ -82,5 +85,11 @@ for i, atten in enumerate(input['attenList']):
     # run a frequency sweep
     Instance = ResSweep(path=savePath, prefix='data_p'+str(input['power']), input=input, soc=soc, soccfg=soccfg)
     data = ResSweep.acquire(Instance)
-    ResSweep.display(Instance, data)
+    ResSweep.display(Instance, data, fit=False)
     ResSweep.save_data(Instance, data)
+    dataList.append(data)
+
+# fit all resonators at all powers together
+fitTable = fitPowerSweep(dataList, tau=input['cable_delay'])
+printPowerSweep(fitTable)
+np.savez(os.path.join(savePath, 'powerSweepFits.npz'), **fitTable)
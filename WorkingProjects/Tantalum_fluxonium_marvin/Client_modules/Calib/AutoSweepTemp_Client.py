@@ -14,12 +14,13 @@ from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Experiments.mSpecS
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Experiments.mSingleShotProgram import SingleShotProgram
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Experiments.mSingleShotTemp_sse import SingleShotSSE
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Experiments.mQubit_ef_spectroscopy import Qubit_ef_spectroscopy
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.PeakTracker import PeakTracker
 
 from matplotlib import pyplot as plt
 import datetime
 
 # setting up computer chit-chat hotline
-import socket
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Calib.Networked_SweepTemp import run_client
 import csv
 
 # Print the start time
@@ -76,179 +77,190 @@ outerFolder = "Z:\\TantalumFluxonium\\Data\\2023_10_31_BF2_cooldown_6\\TF4\\ Tem
 #####################################################################
 HOST = 'escher-pc'
 PORT = 4000
-
-tempr_list = [0, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75]
-
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.connect((HOST, PORT))
-    print('Connected.')
-
-    isRunning = 1
-    while isRunning:
-        print('Waiting to reach temperature setpoint...')
-        indx_tempr = int(s.recv(1024).decode())
-        print('Temperature setpoint = ' + str(tempr_list[indx_tempr]) + " reached")
-        s.sendall("Roger.".encode())
-
-        ### TITLE: Find the qubit ge frequency
-        print('finding the qubit g-e frequency: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-
-        # Defining the config for the spec slice experiment
-        UpdateConfig_spec = {
-            # Qubit Tone
-            'qubit_gain': 600,
-
-            # Define spec slice experiment parameters
-            "qubit_freq_start": 2000,
-            "qubit_freq_stop": 2500,
-            "SpecNumPoints": 501,  # Number of points
-
-            # Experiment type
-            'spec_reps': 1000,  # Number of repetition
-            "relax_delay": 10,  # [us] Delay post one experiment
-        }
-        config_spec = config | UpdateConfig_spec
-
-        Instance_specSlice = SpecSlice_bkg_sub(path="dataTestSpecSlice_temp_" + str(tempr_list[indx_tempr]),
-                                               cfg=config_spec,
-                                               soc=soc, soccfg=soccfg, outerFolder=outerFolder)
-        data_specSlice = SpecSlice_bkg_sub.acquire(Instance_specSlice)
-        SpecSlice_bkg_sub.save_data(Instance_specSlice, data_specSlice)
-        SpecSlice_bkg_sub.display(Instance_specSlice, data_specSlice, plotDisp=False)
-
-        # Get the qubit frequency
-        qubitFreq = data_specSlice["data"]["f_reqd"]
-        print("qubit_frequency = " + str(qubitFreq) + " MHz")
-        config["qubit_ge_freq"] = qubitFreq
-
-        ### TITLE: Find the qubit e-f frequency
-        print('finding the qubit e-f frequency: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-
-        # Defining the config for the three tone spec slice experiment
-        UpdateConfig_ef_spec = {
-            # g-e parameters
-            "qubit_ge_gain": 600,  # Gain for pi pulse in DAC units
-
-            # e-f spec parameter
-            "qubit_ef_freq_start": 2060,
-            "qubit_ef_freq_step": 0.5,
-            'qubit_ef_gain': 5000,
-            "SpecNumPoints": 80,
-
-            # Experiment details
-            "relax_delay": 500,
-            "reps": 1000,
-
-        }
-        config_ef_spec = config | UpdateConfig_ef_spec
-
-        Instance_Qubit_ef_spectroscopy = Qubit_ef_spectroscopy(path="dataQubit_ef_spectroscopy",
-                                                               outerFolder=outerFolder, cfg=config_ef_spec, soc=soc,
-                                                               soccfg=soccfg, progress=True)
-        data_Qubit_ef_spectroscopy = Qubit_ef_spectroscopy.acquire(Instance_Qubit_ef_spectroscopy)
-        Qubit_ef_spectroscopy.save_data(Instance_Qubit_ef_spectroscopy, data_Qubit_ef_spectroscopy)
-        Qubit_ef_spectroscopy.save_config(Instance_Qubit_ef_spectroscopy)
-        Qubit_ef_spectroscopy.display(Instance_Qubit_ef_spectroscopy, data_Qubit_ef_spectroscopy, plotDisp=False)
-
-        # Get the qubit ef frequency
-        qubitFreq_ef = data_Qubit_ef_spectroscopy["data"]["f_reqd"]
-        print("qubit_frequency ef = " + str(qubitFreq_ef) + " MHz")
-        config["qubit_ef_freq"] = qubitFreq_ef
-
-        ### TITLE: Run the T1 scan
-        print('starting T1 scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-        Update_config_T1 = {
-            # qubit parameters
-            "qubit_pulse_style": "arb",
-            "sigma": 0.100,
-            "qubit_ge_gain": 250,
-            "qubit_ef_gain": 8000,
-            "relax_delay": 1500,
-
-            # define shots
-            "shots": 40000,
-
-            # define the wait times
-            "wait_start": 0,
-            "wait_stop": 1200,
-            "wait_num": 101,
-        }
-
-        config_T1 = config | Update_config_T1
-        scan_time = (np.sum(np.linspace(config_T1["wait_start"], config_T1["wait_stop"], config_T1["wait_num"])) +
-                     config_T1["relax_delay"]) * config_T1["shots"] * 1e-6 / 60
-
-        print('estimated time: ' + str(round(scan_time, 2)) + ' minutes')
-
-        Instance_T1_PS = T1_PS(path="dataTestT1_PS_temp_" + str(tempr_list[indx_tempr]), outerFolder=outerFolder,
-                               cfg=config_T1,
-                               soc=soc, soccfg=soccfg)
-        data_T1_PS = T1_PS.acquire(Instance_T1_PS)
-        T1_PS.save_data(Instance_T1_PS, data_T1_PS)
-        T1_PS.save_config(Instance_T1_PS)
-        print('end of scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-        # T1_PS.process_data(Instance_T1_PS, data_T1_PS)
-
-        ### TITLE: Run single shot scan for finding the temp
-        Update_config_ss = {
-            # qubit parameters
-            "qubit_pulse_style": "arb",
-            "sigma": 0.100,
-            "qubit_ge_gain": 250,
-            "qubit_ef_gain": 8000,
-
-            # Experiment parameters
-            'shots' : 1000000,
-            'relax_delay' : 4000,
-            'initialize_pulse' : True,
-        }
-        config_ss = config | Update_config_ss
-
-        scan_time = (config_ss["relax_delay"] * config_ss["shots"] * 2) * 1e-6 / 60
-        print('estimated time: ' + str(round(scan_time, 2)) + ' minutes')
-        Instance_SingleShotSSE = SingleShotSSE(path="dataSingleShot_TempCalc_temp_" + str(tempr_list[indx_tempr]),
-                                               outerFolder=outerFolder,
-                                               cfg=config_ss,
-                                               soc=soc, soccfg=soccfg)
-        data_SingleShotSSE = SingleShotSSE.acquire(Instance_SingleShotSSE)
-        # SingleShotSSE.display(Instance_SingleShotSSE, data_SingleShotSSE, plotDisp=False, save_fig=True)
-        SingleShotSSE.save_data(Instance_SingleShotSSE, data_SingleShotSSE)
-        SingleShotSSE.save_config(Instance_SingleShotSSE)
-
-        #######################
-        # Saving the filenames to a csv file for post-processing
-        path_csv = []
-        path_csv.append(tempr_list[indx_tempr])
-        path_csv.append(config["yokoVoltage"])
-        path_csv.append(Instance_specSlice.fname)
-        path_csv.append(Instance_T1_PS.fname)
-        path_csv.append(Instance_SingleShotSSE.fname)
-        path_csv.append(Instance_Qubit_ef_spectroscopy.fname)
-
-        # Saving to a csv file
-        loc = "Z:\\TantalumFluxonium\\Data\\2023_10_31_BF2_cooldown_6\\TF4\\TempChecks\\summary\\"
-        fname = "TF4_cooldown6_pathtodata.csv"
-
-        # Open the existing CSV file in append mode
-        with open(loc + fname, mode='a', newline='') as file:
-            # Create a CSV writer object
-            writer = csv.writer(file)
-
-            # Write the list to the CSV file
-            writer.writerow(path_csv)
-
-        # Close the open csv
-        file.close()
-
-        print("Message sent:Client Ready")
-        s.sendall("Client Ready".encode())
-
-        message = s.recv(1024).decode()
-        print("Message received:" + message)
-        if message != "Server Ready":
-            print("Communication error :(, was expecting \"Server Ready\"!")
-            exit
-        new_tempr_indx = int(s.recv(1024).decode())
-
-        if new_tempr_indx >= len(tempr_list):
-            isRunning = 0
+CLIENT_NAME = 'marvin'
+
+#### the qubit g-e frequency is tracked over the temperatures instead of found from a full slice every time, the
+#### posterior of the last temperature broadened by the expected drift (MHz) is the prior of the next one.
+#### made on the first temperature from the spec slice parameters
+QubitTracker = None
+
+
+#### measures at one temperature of the sweep, called for every setpoint the server sends
+def MeasureAtTemp(setpoint):
+    global QubitTracker
+    tempr = setpoint['temperature']
+
+    ### TITLE: Find the qubit ge frequency
+    print('finding the qubit g-e frequency: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+
+    # Defining the config for the spec slice experiment
+    UpdateConfig_spec = {
+        # Qubit Tone
+        'qubit_gain': 600,
+
+        # Define spec slice experiment parameters
+        "qubit_freq_start": 2000,
+        "qubit_freq_stop": 2500,
+        "SpecNumPoints": 501,  # Number of points
+
+        # Experiment type
+        'spec_reps': 1000,  # Number of repetition
+        "relax_delay": 10,  # [us] Delay post one experiment
+    }
+    config_spec = config | UpdateConfig_spec
+
+    Instance_specSlice = SpecSlice_bkg_sub(path="dataTestSpecSlice_temp_" + str(tempr),
+                                           cfg=config_spec,
+                                           soc=soc, soccfg=soccfg, outerFolder=outerFolder)
+
+    def measure_probes(probe_freqs):
+        #### background subtracted amplitude over an evenly spaced comb of probe frequencies
+        Instance_specSlice.cfg = config_spec | {"qubit_freq_start": probe_freqs[0],
+                                               "qubit_freq_stop": probe_freqs[-1],
+                                               "SpecNumPoints": len(probe_freqs)}
+        return SpecSlice_bkg_sub.acquire(Instance_specSlice)["data"]["amp"]
+
+    if QubitTracker is None:
+        QubitTracker = PeakTracker(np.linspace(config_spec["qubit_freq_start"], config_spec["qubit_freq_stop"],
+                                               config_spec["SpecNumPoints"]),
+                                   width=2.0, sign=1, drift=5.0, target_std=0.5, probes=10)
+    QubitTracker.predict()
+    qubitFreq, qubitFreq_std = QubitTracker.track(measure_probes)
+
+    #### save the probes and the posterior in place of the full slice
+    data_specSlice = {'config': config_spec,
+                      'data': {'x_pts': QubitTracker.probe_freqs, 'amp': QubitTracker.values,
+                               'posterior_freqs': QubitTracker.freqs, 'posterior': QubitTracker.weights,
+                               'f_reqd': qubitFreq, 'f_std': qubitFreq_std}}
+    SpecSlice_bkg_sub.save_data(Instance_specSlice, data_specSlice)
+
+    # Get the qubit frequency
+    print("qubit_frequency = " + str(round(qubitFreq, 3)) + " +/- " + str(round(qubitFreq_std, 3)) + " MHz from "
+          + str(len(QubitTracker.values)) + " probes")
+    config["qubit_ge_freq"] = qubitFreq
+
+    ### TITLE: Find the qubit e-f frequency
+    print('finding the qubit e-f frequency: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+
+    # Defining the config for the three tone spec slice experiment
+    UpdateConfig_ef_spec = {
+        # g-e parameters
+        "qubit_ge_gain": 600,  # Gain for pi pulse in DAC units
+
+        # e-f spec parameter
+        "qubit_ef_freq_start": 2060,
+        "qubit_ef_freq_step": 0.5,
+        'qubit_ef_gain': 5000,
+        "SpecNumPoints": 80,
+
+        # Experiment details
+        "relax_delay": 500,
+        "reps": 1000,
+
+    }
+    config_ef_spec = config | UpdateConfig_ef_spec
+
+    Instance_Qubit_ef_spectroscopy = Qubit_ef_spectroscopy(path="dataQubit_ef_spectroscopy",
+                                                           outerFolder=outerFolder, cfg=config_ef_spec, soc=soc,
+                                                           soccfg=soccfg, progress=True)
+    data_Qubit_ef_spectroscopy = Qubit_ef_spectroscopy.acquire(Instance_Qubit_ef_spectroscopy)
+    Qubit_ef_spectroscopy.save_data(Instance_Qubit_ef_spectroscopy, data_Qubit_ef_spectroscopy)
+    Qubit_ef_spectroscopy.save_config(Instance_Qubit_ef_spectroscopy)
+    Qubit_ef_spectroscopy.display(Instance_Qubit_ef_spectroscopy, data_Qubit_ef_spectroscopy, plotDisp=False)
+
+    # Get the qubit ef frequency
+    qubitFreq_ef = data_Qubit_ef_spectroscopy["data"]["f_reqd"]
+    print("qubit_frequency ef = " + str(qubitFreq_ef) + " MHz")
+    config["qubit_ef_freq"] = qubitFreq_ef
+
+    ### TITLE: Run the T1 scan
+    print('starting T1 scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    Update_config_T1 = {
+        # qubit parameters
+        "qubit_pulse_style": "arb",
+        "sigma": 0.100,
+        "qubit_ge_gain": 250,
+        "qubit_ef_gain": 8000,
+        "relax_delay": 1500,
+
+        # define shots
+        "shots": 40000,
+
+        # define the wait times
+        "wait_start": 0,
+        "wait_stop": 1200,
+        "wait_num": 101,
+    }
+
+    config_T1 = config | Update_config_T1
+    scan_time = (np.sum(np.linspace(config_T1["wait_start"], config_T1["wait_stop"], config_T1["wait_num"])) +
+                 config_T1["relax_delay"]) * config_T1["shots"] * 1e-6 / 60
+
+    print('estimated time: ' + str(round(scan_time, 2)) + ' minutes')
+
+    Instance_T1_PS = T1_PS(path="dataTestT1_PS_temp_" + str(tempr), outerFolder=outerFolder,
+                           cfg=config_T1,
+                           soc=soc, soccfg=soccfg)
+    data_T1_PS = T1_PS.acquire(Instance_T1_PS)
+    T1_PS.save_data(Instance_T1_PS, data_T1_PS)
+    T1_PS.save_config(Instance_T1_PS)
+    print('end of scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    # T1_PS.process_data(Instance_T1_PS, data_T1_PS)
+
+    ### TITLE: Run single shot scan for finding the temp
+    Update_config_ss = {
+        # qubit parameters
+        "qubit_pulse_style": "arb",
+        "sigma": 0.100,
+        "qubit_ge_gain": 250,
+        "qubit_ef_gain": 8000,
+
+        # Experiment parameters
+        'shots' : 1000000,
+        'relax_delay' : 4000,
+        'initialize_pulse' : True,
+    }
+    config_ss = config | Update_config_ss
+
+    scan_time = (config_ss["relax_delay"] * config_ss["shots"] * 2) * 1e-6 / 60
+    print('estimated time: ' + str(round(scan_time, 2)) + ' minutes')
+    Instance_SingleShotSSE = SingleShotSSE(path="dataSingleShot_TempCalc_temp_" + str(tempr),
+                                           outerFolder=outerFolder,
+                                           cfg=config_ss,
+                                           soc=soc, soccfg=soccfg)
+    data_SingleShotSSE = SingleShotSSE.acquire(Instance_SingleShotSSE)
+    # SingleShotSSE.display(Instance_SingleShotSSE, data_SingleShotSSE, plotDisp=False, save_fig=True)
+    SingleShotSSE.save_data(Instance_SingleShotSSE, data_SingleShotSSE)
+    SingleShotSSE.save_config(Instance_SingleShotSSE)
+
+    #######################
+    # Saving the filenames to a csv file for post-processing
+    path_csv = []
+    path_csv.append(tempr)
+    path_csv.append(config["yokoVoltage"])
+    path_csv.append(Instance_specSlice.fname)
+    path_csv.append(Instance_T1_PS.fname)
+    path_csv.append(Instance_SingleShotSSE.fname)
+    path_csv.append(Instance_Qubit_ef_spectroscopy.fname)
+
+    # Saving to a csv file
+    loc = "Z:\\TantalumFluxonium\\Data\\2023_10_31_BF2_cooldown_6\\TF4\\TempChecks\\summary\\"
+    fname = "TF4_cooldown6_pathtodata.csv"
+
+    # Open the existing CSV file in append mode
+    with open(loc + fname, mode='a', newline='') as file:
+        # Create a CSV writer object
+        writer = csv.writer(file)
+
+        # Write the list to the CSV file
+        writer.writerow(path_csv)
+
+    # Close the open csv
+    file.close()
+
+    return {'qubit_ge_freq': qubitFreq, 'qubit_ef_freq': qubitFreq_ef, 'files': path_csv[2:]}
+
+
+#### acks every setpoint, measures and reports done until the server says the sweep is complete
+results = run_client(HOST, PORT, CLIENT_NAME, MeasureAtTemp)
+print('sweep complete, measured ' + str(len(results)) + ' temperatures')
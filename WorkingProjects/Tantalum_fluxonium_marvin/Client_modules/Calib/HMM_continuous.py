@@ -4,11 +4,11 @@ import numpy as np
 os.environ["OMP_NUM_THREADS"] = '1'
 import datetime
 import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
 path = os.getcwd()
 os.add_dll_directory(os.path.dirname(path) + '\\PythonDrivers')
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Calib.initialize import *
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Experiments.mSingleShotProgram_hmm import SingleShotProgramHMM
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.StreamingHMM import StreamingHMM
 
 #### define the switch config
 SwitchConfig = {
@@ -64,7 +64,7 @@ UpdateConfig = {
     # "qubit_gain": 0,  # [in DAC Units]
     # "sigma": 0.005,  # [in us]
     ## define experiment parameters
-    "shots": int(1e7),
+    "shots": int(1e6), ### shots per block, num_blocks blocks below
     "use_switch": False,
     "relax_delay": 0.01,
 }
@@ -76,55 +76,44 @@ time_required = config_hmm["shots"] * (config_hmm["relax_delay"] + config_hmm['r
 # Set up the initial plot
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize = (14,8))
 
+#### the record is taken in num_blocks blocks of shots, each block goes through the HMM and is written to the data
+#### file as soon as it is acquired, only the latest block is kept in memory
+num_blocks = 10
+time_required = time_required * num_blocks
+hmm = StreamingHMM(n_states=2, dt=config_hmm["read_length"] + config_hmm["relax_delay"] + 0.01)
+
+line1 = ax1.plot([], [], 'r-', label='I')[0]
+path1 = ax1.plot([], [], 'k-', label='viterbi state')[0]
+line2 = ax2.plot([], [], 'r-')[0]
+ax1.legend()
+
+def show_block(idx_block, i_arr, q_arr, result):
+    #### last block with its state path, scaled onto the blobs
+    x = np.arange(i_arr.size)
+    summary = hmm.summary()
+    line1.set_data(x, i_arr)
+    path1.set_data(x, summary['means'][result['path'], 0])
+    line2.set_data(x, q_arr)
+    for ax in (ax1, ax2):
+        ax.relim()
+        ax.autoscale_view()
+    ax1.set_title('block ' + str(idx_block + 1) + '/' + str(num_blocks) + ', lifetimes (us): '
+                  + str(np.round(summary['lifetimes'], 1)) + ', occupation: ' + str(np.round(summary['occupation'], 3)))
+    plt.pause(0.01)
+
 print("SingleShot for HMM : Total time estimate is ", time_required, " mins")
 print('starting scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 Instance_SingleShotProgram_HMM = SingleShotProgramHMM(path="SingleShot_NoDelay_" + str(config_hmm["fridge_temp"]),
                                                       outerFolder=outerFolder, cfg=config_hmm,
                                                       soc=soc, soccfg=soccfg)
-data_SingleShot_HMM = Instance_SingleShotProgram_HMM.acquire()
+data_SingleShot_HMM = Instance_SingleShotProgram_HMM.acquire_stream(num_blocks, hmm=hmm, callback=show_block)
 Instance_SingleShotProgram_HMM.save_data(data_SingleShot_HMM)
 Instance_SingleShotProgram_HMM.save_config()
 print('end of scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
-i_arr = data_SingleShot_HMM['data']['i_arr']
-q_arr = data_SingleShot_HMM['data']['q_arr']
-x = np.arange(i_arr.size)
-
-# Initial plot setup
-line1 = ax1.plot(x, i_arr, 'r-')[0]
-line2 = ax2.plot(x, q_arr, 'r-')[0]
-
-data = {'i_arr': i_arr, 'q_arr': q_arr}
-
-def update(frame):
-    print("SingleShot for HMM : Total time estimate is ", time_required, " mins")
-    print('starting scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-    Instance_SingleShotProgram_HMM = SingleShotProgramHMM(path="SingleShot_NoDelay_" + str(config_hmm["fridge_temp"]),
-                                                          outerFolder=outerFolder, cfg=config_hmm,
-                                                          soc=soc, soccfg=soccfg)
-    data_SingleShot_HMM = Instance_SingleShotProgram_HMM.acquire()
-    Instance_SingleShotProgram_HMM.save_data(data_SingleShot_HMM)
-    Instance_SingleShotProgram_HMM.save_config()
-    print('end of scan: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-
-    data['i_arr'] = np.append(data['i_arr'],data_SingleShot_HMM['data']['i_arr'])
-    data['q_arr'] = np.append(data['q_arr'],data_SingleShot_HMM['data']['q_arr'])
-    x = np.arange(data['i_arr'].size)
-
-    line1.set_data(x, data['i_arr'])
-    line2.set_data(x, data['q_arr'])
-
-    ax1.relim()
-    ax1.autoscale_view()
-    ax2.relim()
-    ax2.autoscale_view()
-
-    # time.sleep(3600)
-
-    return line1, line2
-
-# Use lambda to pass additional arguments to update
-global ani
-max_iteration = 10
-ani = FuncAnimation(fig, update, blit=False, frames= max_iteration-1, interval=1, cache_frame_data=False, repeat=False)
+summary = hmm.summary()
+print('transition matrix per shot:\n' + str(summary['trans']))
+print('jump rates (1/us):\n' + str(summary['rates']))
+print('counted jumps:\n' + str(summary['jumps']))
+print('mean dwell times (us): ' + str(summary['mean_dwell']))
 plt.show()
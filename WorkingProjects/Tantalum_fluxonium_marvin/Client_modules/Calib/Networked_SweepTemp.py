@@ -0,0 +1,405 @@
+#### message protocol between the temperature controller (Server_SweepTemp) and the measurement clients
+#### (AutoSweepTemp_Client) of a temperature sweep.
+#### every message is one line of json with a type and an id, so a message can not be cut or merged with the next one
+#### like the bare strings of recv(1024). every message but ack and heartbeat is acknowledged and sent again if the ack
+#### does not come, the receiver drops repeated ids. both ends send heartbeats and drop a peer that has been silent
+#### for heartbeat_timeout, so a dead client never stalls the sweep. any number of clients can subscribe to one server.
+####
+#### a sweep:  client -> hello {name}          server -> welcome
+####           server -> setpoint {index, temperature, fridge_temp}   (to every client)
+####           client -> done {index, result}                          (when it finished measuring)
+####           ... next setpoint once every client is done ...
+####           server -> complete
+
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+
+import numpy as np
+
+#### message types
+HELLO = 'hello'
+WELCOME = 'welcome'
+SETPOINT = 'setpoint'
+DONE = 'done'
+COMPLETE = 'complete'
+ACK = 'ack'
+HEARTBEAT = 'heartbeat'
+
+MAX_LINE = 2 ** 20 ### longest message in bytes
+
+
+def _json_default(obj):
+    """ Ensure json dump can handle np arrays """
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(str(type(obj)) + ' is not JSON serializable')
+
+
+def encode(msg):
+    return (json.dumps(msg, default=_json_default) + '\n').encode()
+
+
+def decode(line):
+    return json.loads(line.decode())
+
+
+class Connection:
+    """
+    One end of a connection. A reader task acknowledges and unpacks the incoming messages into inbox (None once the
+    connection is closed), a heartbeat task keeps the connection alive and closes it when the peer goes silent.
+    """
+    def __init__(self, reader, writer, ack_timeout=10, retries=3, heartbeat_interval=5, heartbeat_timeout=30):
+        self.reader = reader
+        self.writer = writer
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.inbox = asyncio.Queue()
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self._ids = itertools.count()
+        self._acks = {} ### id -> future, resolved when the ack comes
+        self._seen = set() ### ids already received, a message sent again is dropped
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._read()), asyncio.ensure_future(self._heartbeat())]
+
+    async def send(self, msg_type, **fields):
+        """ send a message without waiting for the ack """
+        msg = dict(fields, type=msg_type, id=next(self._ids))
+        await self._write(msg)
+        return msg['id']
+
+    async def request(self, msg_type, **fields):
+        """ send a message and wait for the ack, it is sent again up to retries times """
+        msg = dict(fields, type=msg_type, id=next(self._ids))
+        future = asyncio.get_running_loop().create_future()
+        self._acks[msg['id']] = future
+        try:
+            for attempt in range(self.retries + 1):
+                await self._write(msg)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), self.ack_timeout)
+                except asyncio.TimeoutError:
+                    if self.closed:
+                        break
+            raise ConnectionError('no ack for ' + msg_type + ' ' + str(msg['id']))
+        finally:
+            self._acks.pop(msg['id'], None)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        for future in self._acks.values():
+            if not future.done():
+                future.set_exception(ConnectionError('connection closed'))
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+        self.inbox.put_nowait(None)
+
+    async def _write(self, msg):
+        if self.closed:
+            raise ConnectionError('connection closed')
+        self.writer.write(encode(msg))
+        await self.writer.drain()
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                self.last_seen = time.monotonic()
+                msg = decode(line)
+                if msg['type'] == HEARTBEAT:
+                    continue
+                if msg['type'] == ACK:
+                    future = self._acks.get(msg['ack'])
+                    if future is not None and not future.done():
+                        future.set_result(msg)
+                    continue
+                await self._write({'type': ACK, 'id': next(self._ids), 'ack': msg['id']})
+                if msg['id'] in self._seen:
+                    continue
+                self._seen.add(msg['id'])
+                await self.inbox.put(msg)
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError) as e:
+            print('connection error: ' + str(e))
+        finally:
+            await self.close()
+
+    async def _heartbeat(self):
+        try:
+            while not self.closed:
+                await asyncio.sleep(self.heartbeat_interval)
+                if time.monotonic() - self.last_seen > self.heartbeat_timeout:
+                    print('peer silent for ' + str(self.heartbeat_timeout) + ' s, closing the connection')
+                    break
+                await self._write({'type': HEARTBEAT, 'id': next(self._ids)})
+        except ConnectionError:
+            pass
+        finally:
+            await self.close()
+
+
+class TempServer:
+    """
+    Temperature controller end of the protocol, the clients that said hello are in clients by name.
+    A client that connects while a setpoint is being measured gets that setpoint.
+    """
+    def __init__(self, host, port, **connection_kwargs):
+        self.host = host
+        self.port = port
+        self.connection_kwargs = connection_kwargs
+        self.clients = {} ### name -> Connection
+        self.results = {} ### index -> {name: result}
+        self.current = None ### fields of the setpoint being measured
+        self.server = None
+        self.changed = None ### notified on every done, connect and disconnect
+
+    async def start(self):
+        self.changed = asyncio.Condition()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_LINE)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        conn = Connection(reader, writer, **self.connection_kwargs)
+        conn.start()
+        name = None
+        try:
+            hello = await conn.inbox.get()
+            if hello is None or hello['type'] != HELLO:
+                return
+            name = hello['name']
+            if name in self.clients:
+                await self.clients[name].close()
+            self.clients[name] = conn
+            print('client ' + name + ' connected')
+            await conn.request(WELCOME)
+            if self.current is not None and name not in self.results.get(self.current['index'], {}):
+                await conn.request(SETPOINT, **self.current)
+            await self._notify()
+
+            while True:
+                msg = await conn.inbox.get()
+                if msg is None:
+                    break
+                if msg['type'] == DONE:
+                    self.results.setdefault(msg['index'], {})[name] = msg.get('result')
+                    await self._notify()
+        except ConnectionError as e:
+            print('client ' + str(name) + ': ' + str(e))
+        finally:
+            await conn.close()
+            if name is not None and self.clients.get(name) is conn:
+                del self.clients[name]
+                print('client ' + name + ' disconnected')
+                await self._notify()
+
+    async def _notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def wait_for_clients(self, num_clients, timeout=None):
+        async with self.changed:
+            await asyncio.wait_for(self.changed.wait_for(lambda: len(self.clients) >= num_clients), timeout)
+
+    async def setpoint(self, index, temperature, fridge_temp=None):
+        """ tell every client to measure at this setpoint, a client that does not ack it is dropped """
+        self.current = {'index': index, 'temperature': temperature, 'fridge_temp': fridge_temp}
+        clients = list(self.clients.items())
+        replies = await asyncio.gather(*[conn.request(SETPOINT, **self.current) for name, conn in clients],
+                                       return_exceptions=True)
+        for (name, conn), reply in zip(clients, replies):
+            if isinstance(reply, Exception):
+                print('client ' + name + ' did not get setpoint ' + str(index) + ': ' + str(reply))
+                await conn.close()
+
+    async def wait_done(self, index, timeout=None):
+        """
+        wait until every connected client finished measuring at index, a client that disconnects is not waited for
+        returns {name: result}
+        """
+        def all_done():
+            return all(name in self.results.get(index, {}) for name in self.clients)
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(all_done), timeout)
+            except asyncio.TimeoutError:
+                missing = [name for name in self.clients if name not in self.results.get(index, {})]
+                print('not waiting any longer for ' + str(missing))
+        return self.results.get(index, {})
+
+    async def finish(self):
+        self.current = None
+        await asyncio.gather(*[conn.request(COMPLETE) for conn in self.clients.values()], return_exceptions=True)
+        for conn in list(self.clients.values()):
+            await conn.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class SweepTempServer:
+    """
+    Blocking front of TempServer for the sweep scripts, the event loop runs on its own thread so the connections are
+    served (acks, heartbeats, new clients) while the script talks to the Lakeshore or the RFSoC.
+    """
+    def __init__(self, host, port, **connection_kwargs):
+        self.server = TempServer(host, port, **connection_kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self._call(self.server.start())
+
+    @property
+    def port(self):
+        return self.server.port
+
+    @property
+    def clients(self):
+        return list(self.server.clients)
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def wait_for_clients(self, num_clients=1, timeout=None):
+        self._call(self.server.wait_for_clients(num_clients, timeout))
+
+    def setpoint(self, index, temperature, fridge_temp=None):
+        self._call(self.server.setpoint(index, temperature, fridge_temp))
+
+    def wait_done(self, index, timeout=None):
+        return self._call(self.server.wait_done(index, timeout))
+
+    def finish(self):
+        self._call(self.server.finish())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class TempClient:
+    """
+    Measurement end of the protocol. measure(setpoint) is called for every setpoint, with the setpoint message
+    (index, temperature, fridge_temp), on a worker thread so heartbeats go on during a long measurement. What it
+    returns is sent back with done. The client reconnects if the connection is lost and does not measure a setpoint
+    twice.
+    """
+    def __init__(self, host, port, name, measure, reconnect_interval=5, max_reconnects=100, **connection_kwargs):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.measure = measure
+        self.reconnect_interval = reconnect_interval
+        self.max_reconnects = max_reconnects
+        self.connection_kwargs = connection_kwargs
+        self.results = {} ### index -> result of measure
+
+    async def run(self):
+        """ returns {index: result} once the server says the sweep is complete """
+        reconnects = 0
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=MAX_LINE)
+            except OSError as e:
+                reconnects += 1
+                if reconnects > self.max_reconnects:
+                    raise
+                print('could not connect (' + str(e) + '), trying again in ' + str(self.reconnect_interval) + ' s')
+                await asyncio.sleep(self.reconnect_interval)
+                continue
+
+            conn = Connection(reader, writer, **self.connection_kwargs)
+            conn.start()
+            try:
+                if await self._serve(conn):
+                    return self.results
+            except ConnectionError as e:
+                print('connection lost: ' + str(e))
+            finally:
+                await conn.close()
+
+            reconnects += 1
+            if reconnects > self.max_reconnects:
+                raise ConnectionError('gave up after ' + str(self.max_reconnects) + ' reconnects')
+            await asyncio.sleep(self.reconnect_interval)
+
+    async def _serve(self, conn):
+        #### True when the sweep is complete, False when the connection was lost
+        await conn.request(HELLO, name=self.name)
+        while True:
+            msg = await conn.inbox.get()
+            if msg is None:
+                return False
+            if msg['type'] == COMPLETE:
+                return True
+            if msg['type'] != SETPOINT:
+                continue
+            index = msg['index']
+            if index not in self.results:
+                print('Temperature setpoint = ' + str(msg['temperature']) + ' reached')
+                self.results[index] = await asyncio.get_running_loop().run_in_executor(None, self.measure, msg)
+            await conn.request(DONE, index=index, result=self.results[index])
+
+
+def run_client(host, port, name, measure, **kwargs):
+    """ blocking, measures every setpoint the server sends until the sweep is complete """
+    return asyncio.run(TempClient(host, port, name, measure, **kwargs).run())
+
+
+def loopback_test(num_clients=3, temps=(10, 20, 30, 40), measure_time=0.2):
+    """
+    a sweep on localhost with num_clients clients and one more that says hello and then goes silent without closing
+    its socket. the server should drop the silent one and keep going with the others.
+    """
+    import socket
+    kwargs = {'ack_timeout': 0.2, 'retries': 2, 'heartbeat_interval': 0.1, 'heartbeat_timeout': 0.5}
+    server = SweepTempServer('127.0.0.1', 0, **kwargs)
+    results = {}
+
+    def client(name):
+        def measure(setpoint):
+            time.sleep(measure_time * random.random())
+            return {'client': name, 'temperature': setpoint['temperature']}
+        results[name] = run_client('127.0.0.1', server.port, name, measure, **kwargs)
+
+    threads = [threading.Thread(target=client, args=('client' + str(idx),), daemon=True) for idx in range(num_clients)]
+    for thread in threads:
+        thread.start()
+    silent = socket.create_connection(('127.0.0.1', server.port))
+    silent.sendall(encode({'type': HELLO, 'id': 0, 'name': 'silent'}))
+    server.wait_for_clients(num_clients + 1, timeout=5)
+
+    start = time.time()
+    for idx, temperature in enumerate(temps):
+        server.setpoint(idx, temperature, fridge_temp=temperature * 1e-3)
+        done = server.wait_done(idx, timeout=10)
+        print('setpoint ' + str(idx) + ': done by ' + str(sorted(done)) + ', clients ' + str(sorted(server.clients)))
+    server.finish()
+    for thread in threads:
+        thread.join(timeout=5)
+    silent.close()
+    print('sweep took ' + str(round(time.time() - start, 2)) + ' s')
+    for name in sorted(results):
+        print(name + ': ' + str(sorted(results[name])))
+    return results
+
+
+if __name__ == '__main__':
+    loopback_test()
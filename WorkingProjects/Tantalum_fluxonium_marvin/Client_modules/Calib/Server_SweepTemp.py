@@ -15,13 +15,15 @@ from scipy.optimize import curve_fit
 from Tantalum_fluxonium.Client_modules.PythonDrivers.LS370 import *
 
 #### setting up computer chit-chat hotline
-import socket
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Calib.Networked_SweepTemp import SweepTempServer
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.PeakTracker import PeakTracker
 
 # Escher is 192.168.1.123, this is actually escher-pc
 # BF2 measurement computer 192.168.1.149 this is actually Marvin
 
 HOST = 'Marvin'
 PORT = 4000
+NUM_CLIENTS = 1 ### clients to wait for before starting, more can join during the sweep
 
 #########
 
@@ -263,7 +265,10 @@ rm = pyvisa.ResourceManager()
 
 LS370_connection = rm.open_resource('GPIB0::12::INSTR')
 
-Lakeshore = Lakeshore370(LS370_connection)
+#### the temperature is read every 2 s and counts as settled once the last 60 s of reads sit within 1 mK of the
+#### setpoint without drifting, instead of waiting fixed times
+Lakeshore = Lakeshore370(LS370_connection, stabilizer=TempStabilizer(poll_interval=2, window=60, tolerance=1e-3,
+                                                                     timeout=900))
 
 ################################## code for running qubit spec on repeat
 UpdateConfig = {
@@ -317,117 +322,123 @@ pops_mat = []
 temp_vec_int = []
 temp_vec_fin = []
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((HOST, PORT))
-    s.listen()
-    conn, addr = s.accept()
-    with conn:
-
-        print(f"Connected by {addr}")
-        # while True:
-        #     data = conn.recv(1024)
-        #     if not data:
-        #         break
-        #     print(data)
-        #     conn.sendall(data)
-
-        ##### start the loop over temperatures
-        for idx_temp in range(len(temp_vec)):
-
-            ### set the lakeshore temperature
-            Lakeshore.set_temp(temp_vec[idx_temp])
-            # ### wait for 1 minutes
-            time.sleep(60)
-
-            curr_temp = Lakeshore.get_temp(7)
-            conn.sendall( curr_temp.encode() )
-            temp_vec_int.append(curr_temp)
-
-            message = conn.recv(1024).decode()
-            if message != "Roger.":
-                print(message)
-                print("communication error :(")
-            print("Dont call me Roger!")
-
-            #### find the qubit frequency
-            Instance_specSlice = SpecSlice(path="dataTestSpecSlice", cfg=config,soc=soc,soccfg=soccfg, outerFolder = outerFolder)
-            data_specSlice = SpecSlice.acquire(Instance_specSlice)
-            # SpecSlice.save_data(Instance_specSlice, data_specSlice)
-            # SpecSlice.display(Instance_specSlice, data_specSlice, plotDisp=True)
-
-            ### find the qubit frequency
-            # peak_loc = np.argmax(data_specSlice['data']['avgq'])  # Maximum location
-            peak_loc = np.argmin(data_specSlice['data']['avgq'])  # Maximum location
-            qubitFreq = data_specSlice['data']['x_pts'][peak_loc]
-            print("qubit_frequency = " + str(qubitFreq) + " MHz")
-
-            config["qubit_freq"] = qubitFreq
-
-            print('starting T1 measurement: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-            Instance_T1_PS = T1_PS(path="dataTempSweeps_T1_PS", outerFolder=outerFolder, cfg=config,
-                                                           soc=soc, soccfg=soccfg)
-            data_T1_PS = T1_PS.acquire(Instance_T1_PS)
-            # T1_PS.display(Instance_T1_PS, data_T1_PS, plotDisp=True, save_fig=True)
-            T1_PS.save_data(Instance_T1_PS, data_T1_PS)
-            T1_PS.save_config(Instance_T1_PS)
-            print('finished T1 measurement: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-
-            #### process the data
-            data = data_T1_PS['data']
-            i_0_arr = data['i_0_arr'][:]
-            q_0_arr = data['q_0_arr'][:]
-
-            i_1_arr = data['i_1_arr'][:]
-            q_1_arr = data['q_1_arr'][:]
-
-            t_arr = data['wait_vec'][:]
-
-            #### Cluster the raw data
-            I = i_0_arr[0]
-            Q = q_0_arr[0]
-
-            #### sort data into clusters
-            if idx_temp == 0:
-                #### if it is the first round create the cluster
-                kmeans, Centers, blobNums, blobs, dists = ClusterData(I, Q, cen_num = cen_num)
-
-            #### use first round kmeans to sort new data
-            I0 = i_0_arr
-            Q0 = q_0_arr
-
-            I1 = i_1_arr
-            Q1 = q_1_arr
-
-            pops_arr = SortData(I0, Q0, I1, Q1, kmeans, dists)
-
-            pops_mat.append(pops_arr)
-
-            ##### save the processed data
-            # np.save(processed_name, pops_mat)
-            np.savez(processed_name,
-                     temp_vec = temp_vec, pops_mat = pops_mat,
-                     temp_vec_int = temp_vec_int, temp_vec_fin = temp_vec_fin)
-
-            #### communicate with other PC for when the scan finishes
-            print("Waiting for Lev PC to finish scan...")
-
-            #### save the final temperature
-            curr_temp = Lakeshore.get_temp(7)
-            conn.sendall(curr_temp.encode())
-            temp_vec_fin.append(curr_temp)
-
-            message = conn.recv(1024).decode()
-            if message != "Done measuring.":
-                print(message)
-                print("communication error :(")
-
-            print("Lev PC finished scan, repeat loop!")
-
-            if idx_temp != (len(temp_vec) - 1):
-                conn.sendall("continue measurement".encode())
-            else:
-                conn.sendall("measurement complete".encode())
-
+#### spec slices taken while the fridge settles, they follow the qubit frequency through the temperature change
+spec_wait_idx = []
+spec_wait_temp = []
+spec_wait_freq = []
+settle_times = []
+
+#### the qubit frequency is tracked instead of found from a full slice every time: the posterior of the last
+#### measurement, broadened by the expected drift, is the prior of the next one and only a few combs of probe
+#### frequencies around it are measured until the frequency is known to target_std (MHz)
+QubitTracker = PeakTracker(np.linspace(config["qubit_freq_start"], config["qubit_freq_stop"], config["SpecNumPoints"]),
+                           width=1.0, sign=-1, drift=1.0, target_std=0.2, probes=8)
+
+def SpecProbes(probe_freqs):
+    #### avgq of a spec slice over an evenly spaced comb of probe frequencies
+    config_probes = config | {"qubit_freq_start": probe_freqs[0], "qubit_freq_stop": probe_freqs[-1],
+                              "SpecNumPoints": len(probe_freqs)}
+    Instance_specSlice = SpecSlice(path="dataTestSpecSlice", cfg=config_probes, soc=soc, soccfg=soccfg,
+                                   outerFolder=outerFolder)
+    data_specSlice = SpecSlice.acquire(Instance_specSlice)
+    return np.ravel(data_specSlice['data']['avgq'])
+
+def FindQubitFreq():
+    QubitTracker.predict()
+    qubitFreq, qubitFreq_std = QubitTracker.track(SpecProbes)
+    print("qubit_frequency = " + str(round(qubitFreq, 3)) + " +/- " + str(round(qubitFreq_std, 3)) + " MHz from "
+          + str(len(QubitTracker.values)) + " probes")
+    return qubitFreq
+
+def SpecWhileWaiting():
+    qubitFreq = FindQubitFreq()
+    return float(Lakeshore.get_temp(7)), qubitFreq
+
+#### the measurement clients subscribe to this temperature controller, wait for NUM_CLIENTS of them to start
+server = SweepTempServer(HOST, PORT)
+server.wait_for_clients(NUM_CLIENTS)
+print("Connected to " + str(server.clients))
+
+##### start the loop over temperatures
+for idx_temp in range(len(temp_vec)):
+
+    ### set the lakeshore temperature, returns once it has settled and takes spec slices until then
+    settle = Lakeshore.set_temp(temp_vec[idx_temp], while_waiting=SpecWhileWaiting)
+    settle_times.append(settle['elapsed'])
+    for temp_wait, freq_wait in settle['results']:
+        spec_wait_idx.append(idx_temp)
+        spec_wait_temp.append(temp_wait)
+        spec_wait_freq.append(freq_wait)
+
+    curr_temp = Lakeshore.get_temp(7)
+    temp_vec_int.append(curr_temp)
+
+    #### every client acks the setpoint and starts measuring
+    server.setpoint(idx_temp, temp_vec[idx_temp], fridge_temp=float(curr_temp))
+
+    #### find the qubit frequency, the dip in avgq, tracked from the last measurement
+    qubitFreq = FindQubitFreq()
+
+    config["qubit_freq"] = qubitFreq
+
+    print('starting T1 measurement: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+    Instance_T1_PS = T1_PS(path="dataTempSweeps_T1_PS", outerFolder=outerFolder, cfg=config,
+                                                   soc=soc, soccfg=soccfg)
+    data_T1_PS = T1_PS.acquire(Instance_T1_PS)
+    # T1_PS.display(Instance_T1_PS, data_T1_PS, plotDisp=True, save_fig=True)
+    T1_PS.save_data(Instance_T1_PS, data_T1_PS)
+    T1_PS.save_config(Instance_T1_PS)
+    print('finished T1 measurement: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+
+    #### process the data
+    data = data_T1_PS['data']
+    i_0_arr = data['i_0_arr'][:]
+    q_0_arr = data['q_0_arr'][:]
+
+    i_1_arr = data['i_1_arr'][:]
+    q_1_arr = data['q_1_arr'][:]
+
+    t_arr = data['wait_vec'][:]
+
+    #### Cluster the raw data
+    I = i_0_arr[0]
+    Q = q_0_arr[0]
+
+    #### sort data into clusters
+    if idx_temp == 0:
+        #### if it is the first round create the cluster
+        kmeans, Centers, blobNums, blobs, dists = ClusterData(I, Q, cen_num = cen_num)
+
+    #### use first round kmeans to sort new data
+    I0 = i_0_arr
+    Q0 = q_0_arr
+
+    I1 = i_1_arr
+    Q1 = q_1_arr
+
+    pops_arr = SortData(I0, Q0, I1, Q1, kmeans, dists)
+
+    pops_mat.append(pops_arr)
+
+    ##### save the processed data
+    # np.save(processed_name, pops_mat)
+    np.savez(processed_name,
+             temp_vec = temp_vec, pops_mat = pops_mat,
+             temp_vec_int = temp_vec_int, temp_vec_fin = temp_vec_fin, settle_times = settle_times,
+             spec_wait_idx = spec_wait_idx, spec_wait_temp = spec_wait_temp, spec_wait_freq = spec_wait_freq)
+
+    #### communicate with other PC for when the scan finishes
+    print("Waiting for the clients " + str(server.clients) + " to finish scan...")
+    server.wait_done(idx_temp)
+
+    #### save the final temperature
+    curr_temp = Lakeshore.get_temp(7)
+    temp_vec_fin.append(curr_temp)
+
+    print("Clients finished scan, repeat loop!")
+
+#### tells the clients the sweep is complete
+server.finish()
 
 ### when finished turn off the lakeshore
 Lakeshore.set_setpoint(9)
@@ -3,6 +3,7 @@ import json
 import numpy as np
 import h5py
 import datetime
+import time
 from pathlib import Path
 
 class MakeFile(h5py.File):
@@ -28,13 +29,35 @@ class MakeFile(h5py.File):
             self.create_dataset(key, shape=data.shape,
                                 maxshape=tuple([None] * len(data.shape)),
                                 dtype=str(data.astype(np.float64).dtype))
-        except RuntimeError:
+        except (RuntimeError, ValueError):  #### the key exists, e.g. a static vector written by open_stream. older h5py raise RuntimeError
             del self[key]
             self.create_dataset(key, shape=data.shape,
                                 maxshape=tuple([None] * len(data.shape)),
                                 dtype=str(data.astype(np.float64).dtype))
         self[key][...] = data
 
+    def add_stream(self, key, row_shape=(), dtype=np.float64, nrows=0, chunk_rows=1):
+        """ pre-allocates a chunked dataset of nrows rows that can keep growing along its first axis
+            @param row_shape - shape of a single row (one yoko/gain/wait point)
+            @param dtype - dtype the rows are stored with, kept as is (int32 shots stay int32)
+            @param nrows - number of rows to pre-allocate, unwritten float rows read back as nan
+            @param chunk_rows - number of rows per hdf5 chunk
+        """
+        row_shape = tuple(row_shape)
+        dtype = np.dtype(dtype)
+        fillvalue = np.nan if dtype.kind in 'fc' else 0
+        return self.create_dataset(key, shape=(nrows,) + row_shape,
+                                   maxshape=(None,) + row_shape,
+                                   chunks=(max(chunk_rows, 1),) + tuple(max(n, 1) for n in row_shape),
+                                   dtype=dtype, fillvalue=fillvalue)
+
+    def write_row(self, key, idx, row):
+        """ writes a single row of a dataset made with add_stream, growing it if idx is past the end """
+        dset = self[key]
+        if idx >= dset.shape[0]:
+            dset.resize(idx + 1, axis=0)
+        dset[idx] = row
+
 class NpEncoder(json.JSONEncoder):
     """ Ensure json dump can handle np arrays """
     def default(self, obj):
@@ -46,6 +69,53 @@ class NpEncoder(json.JSONEncoder):
             return obj.tolist()
         return super(NpEncoder, self).default(obj)
 
+class SweepTimer:
+    """ per point timing of a sweep and the estimate of when it is done """
+
+    def __init__(self, npoints):
+        self.npoints = npoints
+        self.durations = []
+        self.start_time = datetime.datetime.now()
+        self._t0 = None
+
+    @property
+    def points_done(self):
+        return len(self.durations)
+
+    def start_point(self):
+        self._t0 = time.time()
+
+    def stop_point(self):
+        self.durations.append(time.time() - self._t0)
+        return self.durations[-1]
+
+    def remaining(self):
+        #### median of the last points, so a slow first point (compiling, ramping) doesn't dominate
+        if not self.durations:
+            return np.nan
+        return np.median(self.durations[-20:]) * max(self.npoints - self.points_done, 0)
+
+    def report(self):
+        end_time = datetime.datetime.now() + datetime.timedelta(seconds=self.remaining())
+        print('point ' + str(self.points_done) + '/' + str(self.npoints) + ', last point took '
+              + str(round(self.durations[-1], 2)) + ' s, estimated end: ' + end_time.strftime("%Y/%m/%d %H:%M:%S"))
+
+    def stats(self):
+        durations = np.array(self.durations)
+        return {'points': len(durations), 'total': np.sum(durations), 'mean': np.mean(durations),
+                'median': np.median(durations), 'std': np.std(durations),
+                'min': np.min(durations), 'max': np.max(durations)}
+
+    def summary(self):
+        if not self.durations:
+            return 'no points taken'
+        stats = self.stats()
+        return ('sweep done: ' + str(stats['points']) + ' points in ' + str(round(stats['total'] / 60, 2))
+                + ' min, per point ' + str(round(stats['median'], 2)) + ' s median, '
+                + str(round(stats['mean'], 2)) + ' +/- ' + str(round(stats['std'], 2)) + ' s mean, '
+                + str(round(stats['max'], 2)) + ' s max')
+
+
 class ExperimentClass:
     """Base class for all experiments"""
 
@@ -72,6 +142,8 @@ class ExperimentClass:
         self.cfg = cfg
         self.soc = soc
         self.soccfg = soccfg
+        self.stream_file = None
+        self.streamed_keys = set()
         if config_file is not None:
             self.config_file = os.path.join(path, config_file)
         else:
@@ -132,7 +204,10 @@ class ExperimentClass:
         if data_file ==None:
             data_file = self.fname
 
-        f = MakeFile(data_file, 'a')
+        if swmr:
+            f = MakeFile(data_file, 'a', libver='latest')
+        else:
+            f = MakeFile(data_file, 'a')
         #     if swmr==True:
     #         f = SlabFile(data_file, 'w', libver='latest')
     #     elif swmr==False:
@@ -170,12 +245,153 @@ class ExperimentClass:
     def display(self, data=None, **kwargs):
         pass
 
+    def open_stream(self, layout=None, nrows=0, static=None, swmr=False, chunk_rows=1, resume=None):
+        """ opens the data file so rows can be written while the experiment is still running
+            @param layout - dict of key: (row_shape, dtype) for the datasets that grow during the sweep,
+                            keys that are not declared are created on their first stream_rows call
+            @param nrows - number of rows (sweep points) to pre-allocate
+            @param static - dict of arrays known before the sweep starts (frequency/voltage vectors)
+            @param swmr - put the file in single-writer/multiple-reader mode once the layout is created, other
+                          processes can then watch it grow with h5py.File(fname, 'r', libver='latest', swmr=True).
+                          In this mode every streamed key has to be in layout
+            @param resume - data file of an unfinished run of the same sweep, it is reopened and the layout keys
+                            it already has are kept. The static arrays have to match
+        """
+        self.close_stream()
+        self.streamed_keys = set()  #### keys of an earlier acquire on this instance are not in this file
+        if resume is not None:
+            self.fname = resume
+            self.iname = resume[:-3] + '.png'
+            self.cname = resume[:-3] + '.json'
+        self.stream_file = self.datafile(swmr=swmr)
+        self.stream_nrows = nrows
+        self.stream_chunk_rows = chunk_rows
+        if static is not None:
+            for k, d in static.items():
+                if resume is not None and k in self.stream_file:
+                    if not np.array_equal(self.stream_file[k][()], d):
+                        self.close_stream()
+                        raise ValueError(k + " in " + resume + " is not the same as in this sweep")
+                    continue
+                self.stream_file.add(k, np.array(d))
+        if layout is not None:
+            for k, (row_shape, dtype) in layout.items():
+                if k in self.stream_file:
+                    if resume is not None and self.stream_file[k].shape[1:] == tuple(row_shape):
+                        self.streamed_keys.add(k)
+                        continue
+                    del self.stream_file[k]
+                self.stream_file.add_stream(k, row_shape, dtype, nrows=nrows, chunk_rows=chunk_rows)
+                self.streamed_keys.add(k)
+        if swmr:
+            self.stream_file.swmr_mode = True
+        self.stream_file.flush()
+        return self.stream_file
+
+    def stream_rows(self, idx, rows):
+        """ writes row idx of every key in rows and flushes, so whatever was taken survives a crash """
+        if self.stream_file is None:
+            self.open_stream()
+        f = self.stream_file
+        for k, d in rows.items():
+            d = np.asarray(d)
+            if k not in self.streamed_keys:
+                if k in f:
+                    del f[k]
+                f.add_stream(k, d.shape, d.dtype, nrows=self.stream_nrows, chunk_rows=self.stream_chunk_rows)
+                self.streamed_keys.add(k)
+            f.write_row(k, idx, d)
+        f.flush()
+
+    def close_stream(self):
+        if self.stream_file is not None:
+            if self.stream_file.id.valid:
+                self.stream_file.close()
+            self.stream_file = None
+
+    def run_sweep(self, axes, point, data, keys, static=None, resume=None, retries=0, retry_wait=10,
+                  report_every=10, swmr=False, order=None, expected=None, rows_only=False):
+        """ runs point over every combination of the outer axes (last axis fastest), streaming the results
+            to the data file after each point so a crashed sweep can be picked up again with resume
+            @param axes - dict name: vector of the outer axes
+            @param point - function(idx, values) taking one point, idx is the tuple of axis indices and values
+                           the dict name: value. It fills data[key][idx] for every key in keys
+            @param data - dict holding the arrays of keys, shaped (outer axes) + (row shape)
+            @param keys - keys of data streamed after every point, stored with the outer axes flattened
+            @param static - dict of arrays saved once next to the axes
+            @param resume - data file of an unfinished run of the same sweep, the points it has are put in
+                            data and skipped
+            @param retries - number of times a point is tried again after an exception (lost Pyro connection)
+            @param retry_wait - seconds to wait before trying again
+            @param report_every - print the time to completion estimate every this many points
+            @param order - function(done) giving the flat indices of the points to take, in order, in place of
+                           all the missing ones. it can be a generator that looks at data as it fills up (adaptive
+                           sampling), done is the mask of points already in the file. points it leaves out stay
+                           marked 0 in sweep_done
+            @param expected - total number of points order is expected to take, for the time estimate
+            @param rows_only - data[key] only holds the row of the current point, point overwrites it. The sweep
+                               is then never held in memory, the rows taken so far are in self.stream_file
+            returns the SweepTimer with the per point timing. the data file is closed when the sweep ends
+        """
+        shape = tuple(len(v) for v in axes.values())
+        npoints = int(np.prod(shape))
+        layout = {k: (np.shape(data[k])[0 if rows_only else len(shape):], np.asarray(data[k]).dtype) for k in keys}
+        layout['sweep_done'] = ((), np.int8)  #### progress marker, 1 for every point that is in the file
+        static = dict(axes, **(static or {}))
+        self.open_stream(layout=layout, nrows=npoints, static=static, swmr=swmr, resume=resume)
+
+        done = np.zeros(npoints, dtype=bool)
+        if resume is not None:
+            done = self.stream_file['sweep_done'][()] > 0
+            #### indexed by the unraveled indices, a reshape of a non contiguous array would only fill a copy
+            done_idx = np.unravel_index(np.flatnonzero(done), shape)
+            for k in keys if not rows_only else []:
+                stored = self.stream_file[k][()]
+                data[k][done_idx] = stored[done]
+            print('resuming ' + resume + ': ' + str(np.sum(done)) + ' of ' + str(npoints) + ' points already taken')
+
+        self.sweep_done = done.reshape(shape)
+        timer = SweepTimer((npoints if expected is None else expected) - int(np.sum(done)))
+        self.sweep_timer = timer
+        for flat in (np.flatnonzero(~done) if order is None else order(done.copy())):
+            if done[flat]:
+                continue
+            idx = tuple(int(i) for i in np.unravel_index(flat, shape))
+            values = {name: vec[i] for (name, vec), i in zip(axes.items(), idx)}
+            self.sweep_first = timer.points_done == 0
+            for attempt in range(retries + 1):
+                timer.start_point()
+                try:
+                    point(idx, values)
+                    break
+                except Exception as e:
+                    if attempt == retries:
+                        self.close_stream()
+                        print('sweep stopped at point ' + str(idx) + ', resume with resume=r"' + self.fname + '"')
+                        raise
+                    print('point ' + str(idx) + ' failed (' + repr(e) + '), trying again in ' + str(retry_wait) + ' s')
+                    time.sleep(retry_wait)
+            timer.stop_point()
+            done[flat] = True
+
+            self.stream_rows(flat, dict({k: data[k] if rows_only else data[k][idx] for k in keys}, sweep_done=1))
+            if timer.points_done == 1 or timer.points_done % report_every == 0:
+                timer.report()
+
+        self.close_stream()
+        print(timer.summary())
+        return timer
+
     def save_data(self, data=None):  #do I want to try to make this a very general function to save a dictionary containing arrays and variables?
         if data is None:
             data=self.data
 
+        #### rows that were streamed during acquire are already on disk with their own dtype
+        self.close_stream()
         with self.datafile() as f:
             for k, d in data.items():
+                if k in self.streamed_keys:
+                    continue
                 f.add(k, np.array(d))
 
     def load_data(self, f):
@@ -0,0 +1,278 @@
+#### connection manager for the QickSoc Pyro4 server used by socProxy.makeProxy
+#### - the nameserver lookup and the QickConfig are done once per server and cached
+#### - every thread gets its own proxy from a pool (Pyro4 proxies can not be shared between threads)
+#### - the connection is (re)opened before a call is sent, a call that fails after it was sent is only sent again
+####   when it is marked idempotent, so an acquire or a DAC write never runs twice
+#### - numpy arrays can be sent as raw bytes (optionally zlib compressed blocks) instead of generic pickle
+#### - LocalSocServer is a stand in server on localhost so the transfer speed can be measured offline
+
+import threading
+import time
+import zlib
+import numpy as np
+import Pyro4
+import Pyro4.errors
+
+#### errors that mean the connection is gone rather than the remote call failing
+_CONNECTION_ERRORS = (Pyro4.errors.ConnectionClosedError, Pyro4.errors.CommunicationError)
+
+#### calls that only read from the server, safe to send again when the connection drops in the middle of them
+IDEMPOTENT_METHODS = frozenset(['get_cfg', 'ping'])
+
+_ARRAY_KEY = '__ndarray__'
+
+
+def configure_pyro(pickle_protocol=4):
+    """ pickle serializer for the QickSoc server, set before any proxy is made """
+    Pyro4.config.SERIALIZER = "pickle"
+    Pyro4.config.PICKLE_PROTOCOL_VERSION = pickle_protocol
+
+
+def pack_array(arr, compress=False, level=1, block_size=1 << 22):
+    """
+    numpy array to a dict of raw bytes, dtype and shape, no per element pickling
+    compress: zlib compress the buffer in blocks of block_size bytes
+    """
+    arr = np.ascontiguousarray(arr)
+    buf = arr.tobytes()
+    if compress:
+        blocks = [zlib.compress(buf[idx:idx + block_size], level) for idx in range(0, len(buf), block_size)]
+    else:
+        blocks = [buf]
+    return {_ARRAY_KEY: True, 'dtype': arr.dtype.str, 'shape': arr.shape, 'compressed': compress, 'blocks': blocks}
+
+
+def unpack_array(packed):
+    """ inverse of pack_array, the array is writeable """
+    blocks = packed['blocks']
+    if packed['compressed']:
+        blocks = [zlib.decompress(block) for block in blocks]
+    #### frombuffer of bytes gives a read only array, joining into a bytearray is the one copy that makes it writeable
+    buf = bytearray().join(blocks)
+    return np.frombuffer(buf, dtype=np.dtype(packed['dtype'])).reshape(packed['shape'])
+
+
+def unpack_result(result):
+    """ replace every packed array in a result (also inside lists, tuples and dicts) by the numpy array """
+    if isinstance(result, dict):
+        if result.get(_ARRAY_KEY, False):
+            return unpack_array(result)
+        return {key: unpack_result(val) for key, val in result.items()}
+    if isinstance(result, (list, tuple)):
+        return type(result)(unpack_result(val) for val in result)
+    return result
+
+
+class PooledProxy:
+    """
+    stands in for the Pyro4 proxy of the soc, attribute access and calls go to the proxy of the calling thread
+    and packed arrays in the results are unpacked
+    """
+    def __init__(self, manager):
+        self._manager = manager
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = self._manager._call(lambda proxy: getattr(proxy, name), idempotent=True)
+        if not callable(attr):
+            return attr
+
+        idempotent = name in self._manager.idempotent
+
+        def remote_method(*args, **kwargs):
+            return unpack_result(self._manager._call(lambda proxy: getattr(proxy, name)(*args, **kwargs),
+                                                     idempotent=idempotent))
+        remote_method.__name__ = name
+        return remote_method
+
+    def __repr__(self):
+        return '<PooledProxy ' + str(self._manager.uri) + '>'
+
+
+class ProxyManager:
+    """
+    ns_host, ns_port, server_name: where to find the QickSoc server, same as makeProxy used to hard code
+    uri: skip the nameserver and connect to this uri directly (used for LocalSocServer)
+    retries: number of times the connection is opened again, and an idempotent call sent again, after it dropped
+    idempotent: names of further server methods that are safe to send twice, added to IDEMPOTENT_METHODS
+    """
+    def __init__(self, ns_host="192.168.1.99", ns_port=8888, server_name="myqick", uri=None,
+                 retries=1, pickle_protocol=4, verbose=False, idempotent=()):
+        self.ns_host = ns_host
+        self.ns_port = ns_port
+        self.server_name = server_name
+        self.retries = retries
+        self.idempotent = IDEMPOTENT_METHODS | frozenset(idempotent)
+        self.pickle_protocol = pickle_protocol
+        self.verbose = verbose
+        self.uri = uri
+        self._soccfg = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._proxies = [] ### every proxy handed out, so they can all be released
+
+    def lookup(self, refresh=False):
+        #### one nameserver lookup per manager, unless asked to refresh e.g. after the server restarted
+        with self._lock:
+            if self.uri is None or refresh:
+                ns = Pyro4.locateNS(host=self.ns_host, port=self.ns_port)
+                if self.verbose:
+                    # print the nameserver entries: you should see the QickSoc proxy
+                    for k, v in ns.list().items():
+                        print(k, v)
+                self.uri = ns.lookup(self.server_name)
+            return self.uri
+
+    def proxy(self):
+        #### the raw Pyro4 proxy of the calling thread, created on first use
+        proxy = getattr(self._local, 'proxy', None)
+        if proxy is None:
+            configure_pyro(self.pickle_protocol)
+            proxy = Pyro4.Proxy(self.lookup())
+            self._local.proxy = proxy
+            with self._lock:
+                self._proxies.append(proxy)
+        return proxy
+
+    def soc(self):
+        return PooledProxy(self)
+
+    def soccfg(self, refresh=False):
+        #### the QickConfig only has to be pulled from the board once
+        if self._soccfg is None or refresh:
+            from qick import QickConfig
+            self._soccfg = QickConfig(self.proxy().get_cfg())
+        return self._soccfg
+
+    def connect(self):
+        #### open the connection of the proxy of the calling thread if it is not open (Pyro4 drops it after a failed
+        #### call), looks the server up again if the uri is no longer valid. nothing of a call is sent here
+        proxy = self.proxy()
+        if proxy._pyroConnection is not None:
+            return proxy
+        try:
+            proxy._pyroBind()
+        except _CONNECTION_ERRORS:
+            proxy._pyroUri = Pyro4.core.URI(self.lookup(refresh=True))
+            proxy._pyroReconnect(tries=3)
+        return proxy
+
+    def close(self):
+        with self._lock:
+            for proxy in self._proxies:
+                proxy._pyroRelease()
+            self._proxies = []
+        self._local = threading.local()
+
+    def _call(self, func, idempotent=False):
+        #### a failure while connecting is always retried, the call was not sent yet. once it was sent it may have
+        #### run on the server even if the connection dropped before the reply, so only idempotent calls are resent
+        for attempt in range(self.retries + 1):
+            try:
+                proxy = self.connect()
+            except _CONNECTION_ERRORS:
+                if attempt == self.retries:
+                    raise
+                continue
+            try:
+                return func(proxy)
+            except _CONNECTION_ERRORS:
+                if not idempotent or attempt == self.retries:
+                    raise
+                if self.verbose:
+                    print('connection to ' + str(self.uri) + ' lost, reconnecting')
+                proxy._pyroRelease()
+
+
+#### managers already made by get_manager, one per server
+_managers = {}
+
+
+def get_manager(ns_host="192.168.1.99", ns_port=8888, server_name="myqick", **kwargs):
+    key = (ns_host, ns_port, server_name)
+    if key not in _managers:
+        _managers[key] = ProxyManager(ns_host=ns_host, ns_port=ns_port, server_name=server_name, **kwargs)
+    return _managers[key]
+
+
+#### stand in for the QickSoc server, only used to measure latency and throughput offline
+@Pyro4.expose
+class LocalSoc:
+    def __init__(self, cfg=None):
+        self.cfg = cfg if cfg is not None else {}
+
+    def get_cfg(self):
+        return self.cfg
+
+    def ping(self):
+        return True
+
+    def get_shots(self, num_shots, mode='array', compress=False):
+        #### shot data like a readout returns it, mode: 'array' (pickled numpy), 'list' or 'packed' (raw bytes)
+        shots = np.random.default_rng(0).normal(size=(2, num_shots)).astype(np.float64)
+        if compress:
+            shots = np.round(shots * 100) / 100 ### realistic resolution, otherwise noise does not compress
+        if mode == 'list':
+            return shots.tolist()
+        if mode == 'packed':
+            return pack_array(shots, compress=compress)
+        return shots
+
+
+#### read only calls of LocalSoc on top of IDEMPOTENT_METHODS, the real QickSoc has no get_shots
+LOCAL_SOC_IDEMPOTENT = ('get_shots',)
+
+
+class LocalSocServer:
+    """
+    runs LocalSoc in a Pyro4 daemon on a background thread
+        with LocalSocServer() as server:
+            manager = ProxyManager(uri=server.uri, idempotent=LOCAL_SOC_IDEMPOTENT)
+    """
+    def __init__(self, cfg=None, host='localhost', pickle_protocol=4):
+        configure_pyro(pickle_protocol)
+        Pyro4.config.SERIALIZERS_ACCEPTED = set(Pyro4.config.SERIALIZERS_ACCEPTED) | {'pickle'}
+        self.daemon = Pyro4.Daemon(host=host)
+        self.uri = str(self.daemon.register(LocalSoc(cfg), objectId='myqick'))
+        self._thread = threading.Thread(target=self.daemon.requestLoop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.daemon.shutdown()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def benchmark(shot_nums=(10000, 100000, 1000000), repeats=5):
+    """ latency of an empty call and throughput of shot arrays for each way of sending them """
+    with LocalSocServer() as server:
+        manager = ProxyManager(uri=server.uri, idempotent=LOCAL_SOC_IDEMPOTENT)
+        soc = manager.soc()
+        soc.ping()
+
+        start = time.time()
+        for idx in range(100):
+            soc.ping()
+        print('latency: ' + str(round((time.time() - start) / 100 * 1e3, 3)) + ' ms')
+
+        for num_shots in shot_nums:
+            mbytes = 2 * num_shots * 8 / 1e6
+            line = str(num_shots) + ' shots (' + str(round(mbytes, 1)) + ' MB):'
+            for mode, compress in [('list', False), ('array', False), ('packed', False), ('packed', True)]:
+                start = time.time()
+                for idx in range(repeats):
+                    shots = soc.get_shots(num_shots, mode, compress)
+                t_call = (time.time() - start) / repeats
+                line += ' ' + mode + ('+zlib' if compress else '') + ' ' + str(round(mbytes / t_call, 1)) + ' MB/s,'
+            print(line)
+        manager.close()
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,23 +1,21 @@
-import Pyro4
-from qick import QickConfig
-
-def makeProxy():
-    Pyro4.config.SERIALIZER = "pickle"
-    Pyro4.config.PICKLE_PROTOCOL_VERSION=4
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.CoreLib.ProxyManager import get_manager
 
+def makeProxy(verbose=False, refresh=False):
+    #### the nameserver lookup and QickConfig are cached by the manager, so calling this again (every script
+    #### in Calib does, on top of the call below) reuses the connection instead of making a new one
+    #### verbose: print the nameserver entries, refresh: look the server up again and reload the QickConfig
     ns_host = "192.168.1.99"
     ns_port = 8888
     server_name = "myqick"
 
-    ns = Pyro4.locateNS(host=ns_host, port=ns_port)
-
-    # print the nameserver entries: you should see the QickSoc proxy
-    for k,v in ns.list().items():
-        print(k,v)
+    manager = get_manager(ns_host=ns_host, ns_port=ns_port, server_name=server_name, verbose=verbose)
+    if refresh:
+        manager.close()
+    manager.lookup(refresh=refresh)
 
-    soc = Pyro4.Proxy(ns.lookup(server_name))
-    soccfg = QickConfig(soc.get_cfg())
+    soc = manager.soc()
+    soccfg = manager.soccfg(refresh=refresh)
     return(soc, soccfg)
 
 soc, soccfg = makeProxy()
-# print("debug")
\ No newline at end of file
+# print("debug")
@@ -4,6 +4,7 @@ from qick import *
 import matplotlib.pyplot as plt
 import numpy as np
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.CoreLib.Experiment import ExperimentClass
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.PeakTracker import PeakTracker
 from tqdm.notebook import tqdm
 import time
 import datetime
@@ -20,7 +21,12 @@ class TwoQubitFluxDrift(ExperimentClass):
     def __init__(self, soc=None, soccfg=None, path='', outerFolder='', prefix='data', cfg=None, config_file=None, progress=None):
         super().__init__(soc=soc, soccfg=soccfg, path=path, outerFolder=outerFolder, prefix=prefix, cfg=cfg, config_file=config_file, progress=progress)
 
-    def acquire(self, progress=False, debug=False, plotDisp = True, figNum = 1):
+    #### resume is the data file of a run that stopped, the repetitions it has are kept and it carries on from there
+    #### track1 / track2: dicts of PeakTracker settings (width, drift, target_std, ...) for qubit 1 / 2. instead of the
+    #### full band every repetition only combs of probe frequencies are measured until the peak in track_signal is
+    #### found again, starting from the last repetition. only the probed points of the rows are filled in
+    def acquire(self, progress=False, debug=False, plotDisp = True, figNum = 1, resume = None,
+                track1 = None, track2 = None, track_signal = 'avgq'):
         ### define frequencies to sweep over
         expt_cfg = {
             ### qubit 1 parameters
@@ -47,7 +53,7 @@ class TwoQubitFluxDrift(ExperimentClass):
 
         self.time_reps = np.arange(0, expt_cfg["repetitions"])
 
-        self.time_stamps = []
+        self.time_stamps = np.full(expt_cfg["repetitions"], np.nan)
 
         #### define the plotting X and Y and data holders Z
         X1 = self.qubit1_freqs/1e3 ### put into units of GHz
@@ -76,66 +82,78 @@ class TwoQubitFluxDrift(ExperimentClass):
                      }
         }
 
+        self.trackers = {}
+        for num, track in [(1, track1), (2, track2)]:
+            if track is not None:
+                self.trackers[num] = PeakTracker(getattr(self, 'qubit' + str(num) + '_freqs'), **track)
+                self.data['data']['peak_freq' + str(num)] = np.full(expt_cfg["repetitions"], np.nan)
+                self.data['data']['peak_std' + str(num)] = np.full(expt_cfg["repetitions"], np.nan)
+
         ### create the figure and subplots that data will be plotted on
         while plt.fignum_exists(num = figNum):
             figNum += 1
         fig, axs = plt.subplots(4,2, figsize = (12,12), num = figNum)
 
-        #### start a timer for estimating the time for the scan
-        startTime = datetime.datetime.now()
         print('') ### print empty row for spacing
-        print('starting date time: ' + startTime.strftime("%Y/%m/%d %H:%M:%S"))
-        start = time.time()
+        print('starting date time: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+
+        def fill_plot_rows(j):
+            #### amplitude and phase of a repetition that is already in self.data (resumed run)
+            sig1 = Z1_avgi[j] + 1j * Z1_avgq[j]
+            Z1_amp[j, :] = np.abs(sig1)
+            Z1_phase[j, :] = np.angle(sig1, deg=True)
+            sig2 = Z2_avgi[j] + 1j * Z2_avgq[j]
+            Z2_amp[j, :] = np.abs(sig2)
+            Z2_phase[j, :] = np.angle(sig2, deg=True)
+
+        ax_plot_00 = ax_plot_01 = ax_plot_10 = ax_plot_11 = ax_plot_20 = ax_plot_21 = ax_plot_30 = ax_plot_31 = None
+        cbar00 = cbar01 = cbar10 = cbar11 = cbar20 = cbar21 = cbar30 = cbar31 = None
+
+        ### one repetition, run_sweep takes care of streaming to disk, resuming and the timing
+        def take_point(index, values):
+            nonlocal ax_plot_00, ax_plot_01, ax_plot_10, ax_plot_11, ax_plot_20, ax_plot_21, ax_plot_30, ax_plot_31, cbar00, cbar01, cbar10, cbar11, cbar20, cbar21, cbar30, cbar31
+            idx = index[0]
+            if self.sweep_first:
+                for j in range(idx):
+                    fill_plot_rows(j)
 
-        ### start the loop over repetitions
-        for idx in range(len(Y)):
             ### store the time of the measurement
-            self.time_stamps.append(time.time())
-            #### set new qubit frequency and aquire data
-            self.cfg["qubit1_freq"] = self.qubit1_freqs[0]
-            prog = LoopbackQubit1Spec(self.soccfg, self.cfg)
-
-            x_pts, avgi1, avgq1 = prog.acquire(self.soc, threshold=None, angle=None, load_pulses=True,
-                                             readouts_per_experiment=1, save_experiments=None,
-                                             start_src="internal", progress=False, debug=False)
-
-            self.cfg["qubit2_freq"] = self.qubit2_freqs[0]
-            prog = LoopbackQubit2Spec(self.soccfg, self.cfg)
-
-            x_pts, avgi2, avgq2 = prog.acquire(self.soc, threshold=None, angle=None, load_pulses=True,
-                                               readouts_per_experiment=1, save_experiments=None,
-                                               start_src="internal", progress=False, debug=False)
+            self.time_stamps[idx] = time.time()
+            #### set new qubit frequency and aquire data, a tracked qubit only takes the probes its tracker asks for
+            for num, prog_class, Z_avgi, Z_avgq in [(1, LoopbackQubit1Spec, Z1_avgi, Z1_avgq),
+                                                    (2, LoopbackQubit2Spec, Z2_avgi, Z2_avgq)]:
+                if num in self.trackers:
+                    peak_freq, peak_std = self._trackPeak(num, prog_class, idx, Z_avgi, Z_avgq, track_signal)
+                    self.data['data']['peak_freq' + str(num)][idx] = peak_freq
+                    self.data['data']['peak_std' + str(num)][idx] = peak_std
+                    print('qubit ' + str(num) + ', repetition ' + str(idx) + ': peak at ' + str(round(peak_freq, 3))
+                          + ' +/- ' + str(round(peak_std, 3)) + ' MHz from '
+                          + str(len(self.trackers[num].values)) + ' probes')
+                    continue
+                self.cfg["qubit" + str(num) + "_freq"] = getattr(self, 'qubit' + str(num) + '_freqs')[0]
+                prog = prog_class(self.soccfg, self.cfg)
+
+                x_pts, avgi, avgq = prog.acquire(self.soc, threshold=None, angle=None, load_pulses=True,
+                                                 readouts_per_experiment=1, save_experiments=None,
+                                                 start_src="internal", progress=False, debug=False)
+                Z_avgi[idx, :] = avgi[0][0]
+                Z_avgq[idx, :] = avgq[0][0]
 
             ###### qubit 1 values
-            Z1_avgi[idx, :] = avgi1[0][0]
-            self.data['data']['avgi_mat1'][idx, :] = avgi1[0][0]
-
-            Z1_avgq[idx, :] = avgq1[0][0]
-            self.data['data']['avgq_mat1'][idx, :] = avgq1[0][0]
-
-            sig1 = avgi1[0][0] + 1j * avgq1[0][0]
+            sig1 = Z1_avgi[idx] + 1j * Z1_avgq[idx]
             Z1_amp[idx, :] = np.abs(sig1)
             Z1_phase[idx, :] = np.angle(sig1, deg=True)
 
             ##### qubit 2 values
-            Z2_avgi[idx, :] = avgi2[0][0]
-            self.data['data']['avgi_mat2'][idx, :] = avgi2[0][0]
-
-            Z2_avgq[idx, :] = avgq2[0][0]
-            self.data['data']['avgq_mat2'][idx, :] = avgq2[0][0]
-
-            sig2 = avgi2[0][0] + 1j * avgq2[0][0]
+            sig2 = Z2_avgi[idx] + 1j * Z2_avgq[idx]
             Z2_amp[idx, :] = np.abs(sig2)
             Z2_phase[idx, :] = np.angle(sig2, deg=True)
 
-            ### save the time stamp data
-            self.data['data']['time_stamps'] = self.time_stamps
-
 
             ####### plotting data
 
             ###### plot the I for both qubits
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 #### plotting
                 ax_plot_00 = axs[0, 0].imshow(
                     Z1_avgi,
@@ -162,7 +180,7 @@ class TwoQubitFluxDrift(ExperimentClass):
             axs[0, 0].set_title("spec sweep: avgi")
 
             ####### qubit 2 I
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 #### plotting
                 ax_plot_01 = axs[0, 1].imshow(
                     Z2_avgi,
@@ -189,7 +207,7 @@ class TwoQubitFluxDrift(ExperimentClass):
             axs[0, 1].set_title("spec sweep: avgi")
 
             #### plot the q for qubit 1
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 #### plot the q
                 ax_plot_10 = axs[1, 0].imshow(
                     Z1_avgq,
@@ -214,7 +232,7 @@ class TwoQubitFluxDrift(ExperimentClass):
             axs[1, 0].set_title("spec sweep: avgq")
 
             #### plot the q for qubit 2
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 #### plot the q
                 ax_plot_11 = axs[1, 1].imshow(
                     Z2_avgq,
@@ -239,7 +257,7 @@ class TwoQubitFluxDrift(ExperimentClass):
             axs[1, 1].set_title("spec sweep: avgq")
 
             #### plot the amp for qubit 1
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 ax_plot_20 = axs[2, 0].imshow(
                     Z1_amp,
                     aspect='auto',
@@ -263,7 +281,7 @@ class TwoQubitFluxDrift(ExperimentClass):
             axs[2, 0].set_title("spec sweep: amp")
 
             #### plot the amp for qubit 2
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 ax_plot_21 = axs[2, 1].imshow(
                     Z2_amp,
                     aspect='auto',
@@ -287,7 +305,7 @@ class TwoQubitFluxDrift(ExperimentClass):
             axs[2, 1].set_title("spec sweep: amp")
 
             #### plot the phase for qubit 1
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 ax_plot_30 = axs[3, 0].imshow(
                     Z1_phase,
                     aspect='auto',
@@ -311,7 +329,7 @@ class TwoQubitFluxDrift(ExperimentClass):
             axs[3, 0].set_title("spec sweep: phase")
 
             #### plot the phase for qubit 2
-            if idx == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 ax_plot_31 = axs[3, 1].imshow(
                     Z2_phase,
                     aspect='auto',
@@ -338,18 +356,16 @@ class TwoQubitFluxDrift(ExperimentClass):
                 plt.show(block=False)
                 plt.pause(0.1)
 
-            if idx == 0:  ### during the first run create a time estimate for the data aqcuisition
-                t_delta = time.time() - start  ### time for single full row in seconds
-                timeEst = (t_delta + self.cfg["delay"]) * len(Y)
-                StopTime = startTime + datetime.timedelta(seconds=timeEst)
-                print('Time for 1 sweep: ' + str(round( (t_delta + self.cfg["delay"] )/ 60 , 2)) + ' min')
-                print('estimated total time: ' + str(round(timeEst / 60, 2)) + ' min')
-                print('estimated end: ' + StopTime.strftime("%Y/%m/%d %H:%M:%S"))
-
             plt.tight_layout()
 
             #self.save_data(self.data)
             time.sleep(self.cfg["delay"])
+
+        self.run_sweep({'time_reps': self.time_reps}, take_point, self.data['data'],
+                       ['avgi_mat1', 'avgq_mat1', 'avgi_mat2', 'avgq_mat2', 'time_stamps']
+                       + [key + str(num) for num in self.trackers for key in ['peak_freq', 'peak_std']],
+                       static={'qubit1_freqs': self.qubit1_freqs, 'qubit2_freqs': self.qubit2_freqs},
+                       resume=resume)
         print('actual end: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
         ##### plot the data with date time stamps
@@ -413,6 +429,26 @@ class TwoQubitFluxDrift(ExperimentClass):
 
         return data
 
+    def _trackPeak(self, num, prog_class, idx, Z_avgi, Z_avgq, signal):
+        #### finds the peak of qubit num in repetition idx with its tracker, the probed points are filled into row idx
+        qubit = 'qubit' + str(num)
+        freqs = getattr(self, qubit + '_freqs')
+
+        def measure(probe_freqs):
+            cfg = self.cfg | {qubit + "_freq_start": probe_freqs[0], qubit + "_freq_stop": probe_freqs[-1],
+                              "SpecNumPoints" + str(num): len(probe_freqs), qubit + "_freq": probe_freqs[0]}
+            prog = prog_class(self.soccfg, cfg)
+            x_pts, avgi, avgq = prog.acquire(self.soc, threshold=None, angle=None, load_pulses=True,
+                                             readouts_per_experiment=1, save_experiments=None,
+                                             start_src="internal", progress=False, debug=False)
+            cols = np.searchsorted(freqs, probe_freqs)
+            Z_avgi[idx, cols] = avgi[0][0]
+            Z_avgq[idx, cols] = avgq[0][0]
+            return {'avgi': avgi[0][0], 'avgq': avgq[0][0], 'amp': np.abs(avgi[0][0] + 1j * avgq[0][0])}[signal]
+
+        self.trackers[num].predict()
+        return self.trackers[num].track(measure)
+
     def save_data(self, data=None):
         print(f'Saving {self.fname}')
         super().save_data(data=data['data'])
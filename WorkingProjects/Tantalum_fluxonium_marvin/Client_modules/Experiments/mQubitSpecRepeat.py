@@ -4,6 +4,7 @@ from qick import *
 import matplotlib.pyplot as plt
 import numpy as np
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.CoreLib.Experiment import ExperimentClass
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.PeakTracker import PeakTracker
 from tqdm.notebook import tqdm
 import time
 import datetime
@@ -22,7 +23,10 @@ class QubitSpecRepeat(ExperimentClass):
     def __init__(self, soc=None, soccfg=None, path='', outerFolder='', prefix='data', cfg=None, config_file=None, progress=None):
         super().__init__(soc=soc, soccfg=soccfg, path=path, outerFolder=outerFolder, prefix=prefix, cfg=cfg, config_file=config_file, progress=progress)
 
-    def acquire(self, progress=False, debug=False, plotDisp = True, figNum = 1):
+    #### track: dict of PeakTracker settings (width, drift, target_std, ...). instead of the full band every repetition
+    #### only combs of probe frequencies are measured until the peak in track_signal is found again, the posterior of
+    #### the last repetition broadened by the drift is the starting point. only the probed points are filled in
+    def acquire(self, progress=False, debug=False, plotDisp = True, figNum = 1, track = None, track_signal = 'avgq'):
         ### define frequencies to sweep over
         expt_cfg = {
             ### qubit parameters
@@ -60,6 +64,13 @@ class QubitSpecRepeat(ExperimentClass):
                      }
         }
 
+        self.tracker = None
+        if track is not None:
+            self.tracker = PeakTracker(self.qubit_freqs, **track)
+            self.data['data']['peak_freqs'] = np.full(len(Y), np.nan)
+            self.data['data']['peak_stds'] = np.full(len(Y), np.nan)
+            self.data['data']['num_probes'] = np.zeros(len(Y), dtype=int)
+
         ### create the figure and subplots that data will be plotted on
         while plt.fignum_exists(num = figNum):
             figNum += 1
@@ -75,20 +86,28 @@ class QubitSpecRepeat(ExperimentClass):
         for idx in range(len(Y)):
             ### store the time of the measurement
             self.time_stamps.append(time.time())
-            #### set new qubit frequency and aquire data
-            self.cfg["qubit_freq"] = self.qubit_freqs[0]
-            prog = LoopbackProgramTwoToneFreqSweep(self.soccfg, self.cfg)
+            if self.tracker is not None:
+                peak_freq, peak_std = self._trackPeak(idx, Z_avgi, Z_avgq, track_signal)
+                self.data['data']['peak_freqs'][idx] = peak_freq
+                self.data['data']['peak_stds'][idx] = peak_std
+                self.data['data']['num_probes'][idx] = len(self.tracker.values)
+                print('repetition ' + str(idx) + ': peak at ' + str(round(peak_freq, 3)) + ' +/- '
+                      + str(round(peak_std, 3)) + ' MHz from ' + str(len(self.tracker.values)) + ' probes')
+            else:
+                #### set new qubit frequency and aquire data
+                self.cfg["qubit_freq"] = self.qubit_freqs[0]
+                prog = LoopbackProgramTwoToneFreqSweep(self.soccfg, self.cfg)
 
-            x_pts, avgi, avgq = prog.acquire(self.soc, threshold=None, angle=None, load_pulses=True,
-                                             readouts_per_experiment=1, save_experiments=None,
-                                             start_src="internal", progress=False, debug=False)
-            Z_avgi[idx, :] = avgi[0][0]
-            self.data['data']['avgi_mat'][idx, :] = avgi[0][0]
+                x_pts, avgi, avgq = prog.acquire(self.soc, threshold=None, angle=None, load_pulses=True,
+                                                 readouts_per_experiment=1, save_experiments=None,
+                                                 start_src="internal", progress=False, debug=False)
+                Z_avgi[idx, :] = avgi[0][0]
+                self.data['data']['avgi_mat'][idx, :] = avgi[0][0]
 
-            Z_avgq[idx, :] = avgq[0][0]
-            self.data['data']['avgq_mat'][idx, :] = avgq[0][0]
+                Z_avgq[idx, :] = avgq[0][0]
+                self.data['data']['avgq_mat'][idx, :] = avgq[0][0]
 
-            sig = avgi[0][0] + 1j * avgq[0][0]
+            sig = Z_avgi[idx] + 1j * Z_avgq[idx]
             Z_amp[idx, :] = np.abs(sig)
             Z_phase[idx, :] = np.angle(sig, deg=True)
 
@@ -256,6 +275,23 @@ class QubitSpecRepeat(ExperimentClass):
 
         return data
 
+    def _trackPeak(self, idx, Z_avgi, Z_avgq, signal):
+        #### finds the peak of repetition idx with self.tracker, the probed points are filled into row idx
+        def measure(probe_freqs):
+            cfg = self.cfg | {"qubit_freq_start": probe_freqs[0], "qubit_freq_stop": probe_freqs[-1],
+                              "SpecNumPoints": len(probe_freqs), "qubit_freq": probe_freqs[0]}
+            prog = LoopbackProgramTwoToneFreqSweep(self.soccfg, cfg)
+            x_pts, avgi, avgq = prog.acquire(self.soc, threshold=None, angle=None, load_pulses=True,
+                                             readouts_per_experiment=1, save_experiments=None,
+                                             start_src="internal", progress=False, debug=False)
+            cols = np.searchsorted(self.qubit_freqs, probe_freqs)
+            Z_avgi[idx, cols] = avgi[0][0]
+            Z_avgq[idx, cols] = avgq[0][0]
+            return {'avgi': avgi[0][0], 'avgq': avgq[0][0], 'amp': np.abs(avgi[0][0] + 1j * avgq[0][0])}[signal]
+
+        self.tracker.predict()
+        return self.tracker.track(measure)
+
     def save_data(self, data=None):
         print(f'Saving {self.fname}')
         super().save_data(data=data['data'])
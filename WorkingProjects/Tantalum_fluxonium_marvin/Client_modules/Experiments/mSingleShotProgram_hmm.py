@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.CoreLib.Experiment import ExperimentClass
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.hist_analysis import *
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.StreamingHMM import StreamingHMM
 from tqdm.notebook import tqdm
 import time
 
@@ -157,6 +158,32 @@ class SingleShotProgramHMM(ExperimentClass):
         return data
 
 
+    def acquire_stream(self, num_blocks, hmm=None, callback=None):
+        """
+        Continuous record of num_blocks blocks of cfg["shots"] shots each, fed to a StreamingHMM as they come in.
+        Every block is written to the data file as row idx_block of i_arr, q_arr and path as soon as it is
+        processed, only the latest block is held in memory. callback(idx_block, i_arr, q_arr, result) is called
+        after every block, result being the output of StreamingHMM.process. The program is compiled and loaded once.
+        """
+        if hmm is None:
+            hmm = StreamingHMM(n_states=2, dt=self.cfg["read_length"] + self.cfg["relax_delay"] + 0.01)
+        self.hmm = hmm
+
+        prog = LoopbackProgramSingleShotHMM(self.soccfg, self.cfg)
+        self.open_stream(nrows=num_blocks)
+        for idx_block in range(num_blocks):
+            i_arr, q_arr = prog.acquire(self.soc, load_pulses=(idx_block == 0))
+            result = hmm.process(i_arr, q_arr)
+            self.stream_rows(idx_block, {'i_arr': i_arr, 'q_arr': q_arr, 'path': result['path']})
+            if callback is not None:
+                callback(idx_block, i_arr, q_arr, result)
+
+        data = {'config': self.cfg, 'data': {'i_arr': i_arr, 'q_arr': q_arr, 'path': result['path']}}
+        for key, value in hmm.summary().items():
+            data['data']['hmm_' + key] = value
+        self.data = data
+        return data
+
     def display(self, data=None, plotDisp = False, figNum = 1, save_fig = True, ran=None, **kwargs):
         if data is None:
             data = self.data
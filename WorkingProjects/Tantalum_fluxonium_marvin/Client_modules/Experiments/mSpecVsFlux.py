@@ -9,6 +9,7 @@ import datetime
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.PythonDrivers.YOKOGS200 import *
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Experiments.mSpecSlice_SaraTest import LoopbackProgramSpecSlice
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Experiments.mTransmission_SaraTest import LoopbackProgramTrans
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.AdaptiveSampling import AdaptiveGrid
 
 # class LoopbackProgramTrans(AveragerProgram):
 #     def __init__(self, soccfg, cfg):
@@ -146,7 +147,13 @@ class SpecVsFlux(ExperimentClass):
         super().__init__(soc=soc, soccfg=soccfg, path=path, prefix=prefix,outerFolder=outerFolder, cfg=cfg, config_file=config_file, progress=progress)
 
     #### during the aquire function here the data is plotted while it comes in if plotDisp is true
-    def acquire(self, progress=False, debug=False, plotDisp = True, plotSave = True, figNum = 1):
+    #### every finished yoko row is written to the data file right away, swmr lets other processes open the
+    #### file and watch it grow. resume is the data file of a sweep that stopped, it carries on from there
+    #### adaptive only takes the yoko voltages of a coarse grid and then refines where the spectrum changes the most
+    #### from one voltage to the next, budget is the number (or fraction if <= 1) of voltages taken, coarse the
+    #### spacing of the starting grid. the voltages that are not taken are interpolated for the plots
+    def acquire(self, progress=False, debug=False, plotDisp = True, plotSave = True, figNum = 1,
+                swmr = False, resume = None, adaptive = False, budget = 0.3, coarse = 4):
         expt_cfg = {
             ### define the yoko parameters
             "yokoVoltageStart": self.cfg["yokoVoltageStart"],
@@ -182,49 +189,76 @@ class SpecVsFlux(ExperimentClass):
         X_spec_step = X_spec[1] - X_spec[0]
         Y = voltVec
         Y_step = Y[1] - Y[0]
-        Z_trans = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["TransNumPoints"]), np.nan)
-        Z_specamp = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan)
-        Z_specphase = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan)
-        Z_specI = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan)
-        Z_specQ = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan)
-
-        ### create an initial data dictionary that will be filled with data as it is taken during sweeps
-        self.trans_Imat = np.zeros((expt_cfg["yokoVoltageNumPoints"], expt_cfg["TransNumPoints"]))
-        self.trans_Qmat = np.zeros((expt_cfg["yokoVoltageNumPoints"], expt_cfg["TransNumPoints"]))
-        self.spec_Imat = np.zeros((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]))
-        self.spec_Qmat = np.zeros((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]))
+        #### display buffers for the plots, single precision is plenty for an image
+        Z_trans = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["TransNumPoints"]), np.nan, dtype=np.float32)
+        Z_specamp = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan, dtype=np.float32)
+        Z_specphase = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan, dtype=np.float32)
+        Z_specI = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan, dtype=np.float32)
+        Z_specQ = np.full((expt_cfg["yokoVoltageNumPoints"], expt_cfg["SpecNumPoints"]), np.nan, dtype=np.float32)
+
+        ### create an initial data dictionary. the I/Q matrices only hold the row of the current yoko voltage, every
+        ### row goes to the trans_Imat ... spec_Qmat datasets of the data file as soon as it is taken
         self.data= {
             'config': self.cfg,
-            'data': {'trans_Imat': self.trans_Imat, 'trans_Qmat': self.trans_Qmat, 'trans_fpts':self.trans_fpts,
-                        'spec_Imat': self.spec_Imat, 'spec_Qmat': self.spec_Qmat, 'spec_fpts': self.spec_fpts,
-                        'voltVec': voltVec
+            'data': {'trans_Imat': np.zeros(expt_cfg["TransNumPoints"]),
+                     'trans_Qmat': np.zeros(expt_cfg["TransNumPoints"]), 'trans_fpts':self.trans_fpts,
+                     'spec_Imat': np.zeros(expt_cfg["SpecNumPoints"]),
+                     'spec_Qmat': np.zeros(expt_cfg["SpecNumPoints"]), 'spec_fpts': self.spec_fpts,
+                     'voltVec': voltVec
                      }
         }
 
-        #### start a timer for estimating the time for the scan
-        startTime = datetime.datetime.now()
         print('') ### print empty row for spacing
-        print('starting date time: ' + startTime.strftime("%Y/%m/%d %H:%M:%S"))
-        start = time.time()
+        print('starting date time: ' + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+
+        #### sampler for the adaptive mode, it refines on the spec amplitude rows
+        sampler = AdaptiveGrid((len(voltVec),), coarse=coarse, budget=budget) if adaptive else None
+
+        def shown(Z):
+            #### what is plotted, the rows that were skipped are interpolated in adaptive mode
+            return sampler.interpolate(Z) if adaptive else Z
 
-        #### loop over the yoko vector
-        for i in range(expt_cfg["yokoVoltageNumPoints"]):
-            ### set the yoko voltage for the specific run
+        def fill_plot_rows(j):
+            #### plot rows of a yoko voltage that is already in the data file (resumed sweep)
+            f = self.stream_file
+            sig = f['trans_Imat'][j] + 1j * f['trans_Qmat'][j]
+            Z_trans[j, :] = np.abs(sig) - np.mean(np.abs(sig))
+            data_I, data_Q = f['spec_Imat'][j], f['spec_Qmat'][j]
+            sig = data_I + 1j * data_Q
+            Z_specamp[j, :] = np.abs(sig) - np.mean(np.abs(sig))
+            Z_specphase[j, :] = np.angle(sig, deg = True) - np.mean(np.angle(sig, deg = True))
+            Z_specI[j, :] = np.abs(data_I) - np.mean(np.abs(data_I))
+            Z_specQ[j, :] = np.abs(data_Q) - np.mean(np.abs(data_Q))
+
+        ax_plot_0 = ax_plot_1 = ax_plot_2 = ax_plot_3 = ax_plot_4 = None
+        cbar0 = cbar1 = cbar2 = cbar3 = cbar4 = None
+
+        #### one yoko voltage, run_sweep takes care of the order, streaming to disk, resuming and the timing
+        def take_point(idx, values):
+            nonlocal ax_plot_0, ax_plot_1, ax_plot_2, ax_plot_3, ax_plot_4, cbar0, cbar1, cbar2, cbar3, cbar4
+            i = idx[0]
+            if self.sweep_first:
+                for j in np.flatnonzero(self.sweep_done):
+                    fill_plot_rows(j)
+
+            ### set the yoko voltage for the specific run. usually the ramp was already started in the background at
+            ### the end of the previous run, this waits for it and is then a no-op. a retried point, a resumed sweep
+            ### that skips points or the adaptive order still end up at voltVec[i]
             yoko1.SetVoltage(voltVec[i])
 
             ### take the transmission data
             data_I, data_Q = self._aquireTransData()
-            self.data['data']['trans_Imat'][i,:] = data_I
-            self.data['data']['trans_Qmat'][i,:] = data_Q
+            self.data['data']['trans_Imat'][:] = data_I
+            self.data['data']['trans_Qmat'][:] = data_Q
 
             #### plot out the transmission data
             sig = data_I + 1j * data_Q
             avgamp0 = np.abs(sig) - np.mean(np.abs(sig))
             Z_trans[i, :] = avgamp0
 
-            if i ==0: #### if first sweep add a colorbar
+            if self.sweep_first: #### if first sweep add a colorbar
                 ax_plot_0 = axs['b'].imshow(
-                    Z_trans,
+                    shown(Z_trans),
                     aspect='auto',
                     extent=[np.min(X_trans) - X_trans_step / 2, np.max(X_trans) + X_trans_step / 2,
                             np.min(Y) - Y_step / 2, np.max(Y) + Y_step / 2],
@@ -234,7 +268,7 @@ class SpecVsFlux(ExperimentClass):
                 cbar0 = fig.colorbar(ax_plot_0, ax=axs['b'], extend='both')
                 cbar0.set_label('a.u.', rotation=90)
             else:
-                ax_plot_0.set_data(Z_trans)
+                ax_plot_0.set_data(shown(Z_trans))
                 ax_plot_0.set_clim(vmin=np.nanmin(Z_trans))
                 ax_plot_0.set_clim(vmax=np.nanmax(Z_trans))
                 cbar0.remove()
@@ -251,8 +285,12 @@ class SpecVsFlux(ExperimentClass):
 
             ### take the spec data
             data_I, data_Q = self._aquireSpecData()
-            self.data['data']['spec_Imat'][i,:] = data_I
-            self.data['data']['spec_Qmat'][i,:] = data_Q
+            self.data['data']['spec_Imat'][:] = data_I
+            self.data['data']['spec_Qmat'][:] = data_Q
+
+            ### all data for this voltage is in, start ramping to the next one while the plots are updated
+            if not adaptive and i + 1 < expt_cfg["yokoVoltageNumPoints"]:
+                yoko1.SetVoltageAsync(voltVec[i + 1])
 
             #### plot out the spec data
             sig = data_I + 1j * data_Q
@@ -263,9 +301,9 @@ class SpecVsFlux(ExperimentClass):
             ## Amplitude
             Z_specamp[i, :] = avgamp0
 
-            if i ==0: #### if first sweep add a colorbar
+            if self.sweep_first: #### if first sweep add a colorbar
                 ax_plot_1 = axs['a'].imshow(
-                    Z_specamp,
+                    shown(Z_specamp),
                     aspect='auto',
                     extent=[np.min(X_spec) - X_spec_step / 2, np.max(X_spec) + X_spec_step / 2, np.min(Y) - Y_step / 2,
                             np.max(Y) + Y_step / 2],
@@ -275,7 +313,7 @@ class SpecVsFlux(ExperimentClass):
                 cbar1 = fig.colorbar(ax_plot_1, ax=axs['a'], extend='both')
                 cbar1.set_label('a.u.', rotation=90)
             else:
-                ax_plot_1.set_data(Z_specamp)
+                ax_plot_1.set_data(shown(Z_specamp))
                 ax_plot_1.set_clim(vmin=np.nanmin(Z_specamp))
                 ax_plot_1.set_clim(vmax=np.nanmax(Z_specamp))
                 cbar1.remove()
@@ -289,9 +327,9 @@ class SpecVsFlux(ExperimentClass):
             ## Phase
             Z_specphase[i, :] = avgphase
 
-            if i == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 ax_plot_2 = axs['c'].imshow(
-                    Z_specphase,
+                    shown(Z_specphase),
                     aspect='auto',
                     extent=[np.min(X_spec) - X_spec_step / 2, np.max(X_spec) + X_spec_step / 2, np.min(Y) - Y_step / 2,
                             np.max(Y) + Y_step / 2],
@@ -301,7 +339,7 @@ class SpecVsFlux(ExperimentClass):
                 cbar2 = fig.colorbar(ax_plot_2, ax=axs['c'], extend='both')
                 cbar2.set_label('Phase', rotation=90)
             else:
-                ax_plot_2.set_data(Z_specphase)
+                ax_plot_2.set_data(shown(Z_specphase))
                 ax_plot_2.set_clim(vmin=np.nanmin(Z_specphase))
                 ax_plot_2.set_clim(vmax=np.nanmax(Z_specphase))
                 cbar2.remove()
@@ -315,9 +353,9 @@ class SpecVsFlux(ExperimentClass):
             ## I
             Z_specI[i, :] = avgI
 
-            if i == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 ax_plot_3 = axs['d'].imshow(
-                    Z_specI,
+                    shown(Z_specI),
                     aspect='auto',
                     extent=[np.min(X_spec) - X_spec_step / 2, np.max(X_spec) + X_spec_step / 2, np.min(Y) - Y_step / 2,
                             np.max(Y) + Y_step / 2],
@@ -327,7 +365,7 @@ class SpecVsFlux(ExperimentClass):
                 cbar3 = fig.colorbar(ax_plot_3, ax=axs['d'], extend='both')
                 cbar3.set_label('I', rotation=90)
             else:
-                ax_plot_3.set_data(Z_specI)
+                ax_plot_3.set_data(shown(Z_specI))
                 ax_plot_3.set_clim(vmin=np.nanmin(Z_specI))
                 ax_plot_3.set_clim(vmax=np.nanmax(Z_specI))
                 cbar3.remove()
@@ -341,9 +379,9 @@ class SpecVsFlux(ExperimentClass):
             ## Q
             Z_specQ[i, :] = avgQ
 
-            if i == 0:  #### if first sweep add a colorbar
+            if self.sweep_first:  #### if first sweep add a colorbar
                 ax_plot_4 = axs['e'].imshow(
-                    Z_specQ,
+                    shown(Z_specQ),
                     aspect='auto',
                     extent=[np.min(X_spec) - X_spec_step / 2, np.max(X_spec) + X_spec_step / 2, np.min(Y) - Y_step / 2,
                             np.max(Y) + Y_step / 2],
@@ -353,7 +391,7 @@ class SpecVsFlux(ExperimentClass):
                 cbar4 = fig.colorbar(ax_plot_4, ax=axs['e'], extend='both')
                 cbar4.set_label('Q', rotation=90)
             else:
-                ax_plot_4.set_data(Z_specQ)
+                ax_plot_4.set_data(shown(Z_specQ))
                 ax_plot_4.set_clim(vmin=np.nanmin(Z_specQ))
                 ax_plot_4.set_clim(vmax=np.nanmax(Z_specQ))
                 cbar4.remove()
@@ -369,15 +407,27 @@ class SpecVsFlux(ExperimentClass):
                 plt.show(block=False)
                 plt.pause(0.1)
 
-            if i ==0: ### during the first run create a time estimate for the data aqcuisition
-                t_delta = time.time() - start ### time for single full row in seconds
-                timeEst = t_delta*expt_cfg["yokoVoltageNumPoints"] ### estimate for full scan
-                StopTime = startTime + datetime.timedelta(seconds=timeEst)
-                print('Time for 1 sweep: ' + str(round(t_delta/60, 2)) + ' min')
-                print('estimated total time: ' + str(round(timeEst/60, 2)) + ' min')
-                print('estimated end: ' + StopTime.strftime("%Y/%m/%d %H:%M:%S"))
+        def adaptive_order(done):
+            #### the rows of a resumed sweep have to be in Z_specamp before the sampler scores them
+            for j in np.flatnonzero(done):
+                fill_plot_rows(j)
+            return sampler.points(Z_specamp, done=done)
+
+        self.run_sweep({'voltVec': voltVec}, take_point, self.data['data'],
+                       ['trans_Imat', 'trans_Qmat', 'spec_Imat', 'spec_Qmat'],
+                       static={'trans_fpts': self.trans_fpts, 'spec_fpts': self.spec_fpts},
+                       resume=resume, swmr=swmr,
+                       order=adaptive_order if adaptive else None, expected=sampler.budget if adaptive else None,
+                       rows_only=True)
+
+        if adaptive:
+            #### the voltages that were taken in the order they were taken, sweep_done in the file marks them too
+            self.data['data']['sample_order'] = np.array(sampler.order)
+            self.data['data']['sample_volts'] = sampler.coordinates(voltVec)[:, 0]
+            self.data['data']['spec_amp_interp'] = sampler.interpolate(Z_specamp)
 
         print('actual end: '+ datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+        yoko1.WaitForRamp()
 
         if plotSave:
             plt.savefig(self.iname) #### save the figure
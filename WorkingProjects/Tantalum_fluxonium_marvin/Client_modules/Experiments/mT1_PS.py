@@ -194,7 +194,7 @@ class T1_PS(ExperimentClass):
     def __init__(self, soc=None, soccfg=None, path='', outerFolder='', prefix='data', cfg=None, config_file=None, progress=None):
         super().__init__(soc=soc, soccfg=soccfg, path=path, outerFolder=outerFolder, prefix=prefix, cfg=cfg, config_file=config_file, progress=progress)
 
-    def acquire(self, progress=False, debug=False):
+    def acquire(self, progress=False, debug=False, streamSave=True, swmr=False):
 
         expt_cfg = {
             ### define the wait times
@@ -227,6 +227,17 @@ class T1_PS(ExperimentClass):
             q_0_arr[idx_wait, :] = q_0
             i_1_arr[idx_wait, :] = i_1
             q_1_arr[idx_wait, :] = q_1
+
+            #### the shot rows are streamed to disk as each wait time finishes. the layout is declared after the first
+            #### acquire so the rows keep the dtype the shots come back with, all keys are declared for swmr
+            if streamSave and idx_wait == 0:
+                self.open_stream(layout={key: ((int(self.cfg["shots"]),), np.asarray(shots).dtype) for key, shots
+                                         in [('i_0_arr', i_0), ('q_0_arr', q_0), ('i_1_arr', i_1), ('q_1_arr', q_1)]},
+                                 nrows=expt_cfg["wait_num"], static={"wait_vec": wait_vec}, swmr=swmr)
+            if streamSave:
+                self.stream_rows(idx_wait, {'i_0_arr': i_0, 'q_0_arr': q_0, 'i_1_arr': i_1, 'q_1_arr': q_1})
+
+        self.close_stream()
         #
         #     ####################################################
         #     cen_num = self.cfg["cen_num"]
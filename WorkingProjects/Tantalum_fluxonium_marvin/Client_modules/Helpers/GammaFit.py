@@ -7,6 +7,8 @@ from scipy.optimize import curve_fit
 plt.rcParams.update({'font.size': 10})
 
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers import SingleShot_ErrorCalc_2 as sse2
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.RateEquations import (
+    two_level_gammas, propagate, propagate_jacobian)
 
 # import SingleShot_ErrorCalc_2 as sse2
 
@@ -237,10 +239,32 @@ class GammaFit:
 
         return [dP0dt, dP1dt]
 
+    ##########
+    def _gammas(self, params):
+        try:
+            g01 = params['g01'].value
+            g10 = params['g10'].value
+
+        except KeyError:
+            g01, g10 = params
+
+        return two_level_gammas(g01, g10)
+
     ##########
     def g(self, t, pops_init, params):
         """
-        solution to the ODE with initial condition P_i[0] = pops_init[i]
+        solution to the ODE with initial condition P_i[0] = pops_init[i],
+        closed form through the matrix exponential of the rate matrix
+        """
+        t = np.asarray(t)
+        x = propagate(t - t[0], pops_init, self._gammas(params))
+
+        return x
+
+    ##########
+    def g_ode(self, t, pops_init, params):
+        """
+        numerical solution to the ODE, kept as a reference for g
         """
         x = odeint(self.Pops_ode, pops_init, t, args=(params,))
 
@@ -294,6 +318,30 @@ class GammaFit:
             P1_1_resid = ((P1_1_model - P1_1_data)/P1_1_data_err).ravel()
          
             return P0_0_resid, P0_1_resid, P1_0_resid, P1_1_resid
+
+        #### location of each fitted rate in the gammas matrix
+        rate_index = {'g01': (0, 1), 'g10': (1, 0)}
+
+        def jacobian(params, t, data, data_err):
+            """
+            analytic derivative of the residual with respect to the varying rates
+            """
+            pops_init = [
+                [params['P0_0_init'].value, params['P0_1_init'].value],
+                [params['P1_0_init'].value, params['P1_1_init'].value],
+                ]
+            #### indexed as jac[starting state][time][final state][i][j]
+            jac = propagate_jacobian(t - t[0], pops_init, self._gammas(params))
+            jac = np.moveaxis(jac, 1, 2)
+            errs = np.reshape(data_err, (2, 2, len(t)))
+
+            columns = []
+            for name in params:
+                if params[name].vary:
+                    i, j = rate_index[name]
+                    columns.append((jac[..., i, j] / errs).ravel())
+
+            return np.stack(columns, axis = 1)
         
         params = Parameters()
        
@@ -321,7 +369,7 @@ class GammaFit:
         params_update = result_shgo.params
         
         result = minimize(residual, params_update, args = (t_arr, data, data_err), 
-            method = 'leastsq')
+            method = 'leastsq', Dfun = jacobian)
        
         result.params.pretty_print(colwidth=11)
 
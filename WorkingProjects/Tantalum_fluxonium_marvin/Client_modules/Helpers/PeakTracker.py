@@ -0,0 +1,180 @@
+#### bayesian tracking of the qubit frequency from spec data taken at a few probe frequencies at a time.
+#### the posterior over the peak position f is kept on a frequency grid (the grid of the full spec slice).
+#### the signal is modeled as b + a * L(p - f), L a lorentzian of half width `width`. for every f, a and b are
+#### fitted to all the probes so far (a is kept between snr * noise and a few times the signal range, so an empty
+#### stretch that was probed rules the peak out there, and a far away peak can't be stretched to fit a slope),
+#### the unknown noise is integrated out which gives the likelihood RSS(f)^-(n-2)/2.
+#### the next probes are an evenly spaced comb (one RAveragerProgram sweep) chosen to maximize the information
+#### gain 1/2 logdet(1 + C / noise^2), C the covariance of the predicted signal at the comb under the posterior.
+#### between measurements the posterior is broadened by the expected drift and becomes the prior of the next one.
+
+import numpy as np
+
+
+class PeakTracker:
+    def __init__(self, freqs, width, sign=None, drift=0.0, target_std=None, probes=8, max_rounds=20, snr=5.0):
+        """
+        @param freqs - frequency grid of the peak positions and probes, usually the points of the full slice
+        @param width - half width at half maximum of the peak, in the units of freqs
+        @param sign - +1 for a peak, -1 for a dip, None for either
+        @param drift - standard deviation of the move of the peak between two measurements
+        @param target_std - tracking stops once the standard deviation of the posterior is below this,
+                            one grid step if None
+        @param probes - number of probe frequencies measured per round
+        @param max_rounds - most rounds per measurement
+        @param snr - smallest height of the peak in units of the noise, what an empty probed stretch has to beat
+        """
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.width = width
+        self.sign = sign
+        self.drift = drift
+        self.target_std = abs(self.freqs[1] - self.freqs[0]) if target_std is None else target_std
+        self.probes = min(probes, len(self.freqs))
+        self.max_rounds = max_rounds
+        self.snr = snr
+        self.history = []  #### (mean, std, number of probes) of every finished measurement
+        self.reset()
+
+    def reset(self):
+        #### flat prior over the whole grid, forgets all measurements
+        self.log_prior = np.zeros(len(self.freqs))
+        self.clear()
+
+    def clear(self):
+        #### drop the probes of the current measurement, the prior is kept
+        self.probe_freqs = np.zeros(0)
+        self.values = np.zeros(0)
+        self.noise_diffs = []
+        self._update()
+
+    def _shape(self, probe_freqs):
+        #### lorentzian of every peak position (rows) at every probe (columns)
+        return 1 / (1 + ((probe_freqs[np.newaxis, :] - self.freqs[:, np.newaxis]) / self.width) ** 2)
+
+    @property
+    def noise(self):
+        #### noise of the probe values from the steps between neighbouring probes of a comb, robust to the peak
+        if len(self.noise_diffs) < 2:
+            return np.nan
+        return np.median(np.abs(self.noise_diffs)) / (0.6745 * np.sqrt(2))
+
+    def _fit(self):
+        #### amplitude, offset and residual of the best fit of every peak position
+        y = self.values
+        n = len(y)
+        L = self._shape(self.probe_freqs)
+        Sl, Sll, Sly = L.sum(axis=1), (L ** 2).sum(axis=1), L @ y
+        Sy, Syy = y.sum(), y @ y
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a_free = (n * Sly - Sl * Sy) / (n * Sll - Sl ** 2)
+        a_free = np.nan_to_num(a_free)
+
+        a_lo = self.snr * self.noise if np.isfinite(self.noise) else 0.0
+        a_hi = max(3 * np.ptp(y), 2 * a_lo)
+        best = None
+        for sign in ([self.sign] if self.sign is not None else [1, -1]):
+            a = sign * np.clip(sign * a_free, a_lo, a_hi)
+            b = (Sy - a * Sl) / n
+            rss = Syy - 2 * b * Sy - 2 * a * Sly + n * b ** 2 + 2 * a * b * Sl + a ** 2 * Sll
+            rss = np.maximum(rss, 1e-12 * max(Syy, 1e-300))
+            if best is None:
+                best = (a, b, rss)
+            else:
+                better = rss < best[2]
+                best = tuple(np.where(better, new, old) for new, old in zip((a, b, rss), best))
+        return best
+
+    def _update(self):
+        log_post = self.log_prior.copy()
+        n = len(self.values)
+        if n > 2:
+            self.amp, self.offset, rss = self._fit()
+            log_post -= (n - 2) / 2 * np.log(rss)
+        else:
+            self.amp, self.offset = np.full(len(self.freqs), np.nan), np.full(len(self.freqs), np.nan)
+        log_post -= np.max(log_post)
+        self.weights = np.exp(log_post)
+        self.weights /= np.sum(self.weights)
+
+    def add(self, probe_freqs, values):
+        """ adds the values measured at probe_freqs (an evenly spaced comb) and updates the posterior """
+        probe_freqs = np.asarray(probe_freqs, dtype=float)
+        values = np.asarray(values, dtype=float)
+        self.probe_freqs = np.concatenate((self.probe_freqs, probe_freqs))
+        self.values = np.concatenate((self.values, values))
+        self.noise_diffs += list(np.diff(values))
+        self._update()
+
+    @property
+    def mean(self):
+        return np.sum(self.weights * self.freqs)
+
+    @property
+    def std(self):
+        return np.sqrt(np.sum(self.weights * (self.freqs - self.mean) ** 2))
+
+    @property
+    def map(self):
+        return self.freqs[np.argmax(self.weights)]
+
+    def predict(self, drift=None):
+        """ the posterior broadened by the drift becomes the prior of the next measurement """
+        drift = self.drift if drift is None else drift
+        weights = self.weights
+        if drift > 0:
+            kernel = np.exp(-(self.freqs[:, np.newaxis] - self.freqs[np.newaxis, :]) ** 2 / (2 * drift ** 2))
+            weights = kernel @ (weights / np.sum(kernel, axis=0))
+        #### a floor so a peak that jumped further than the drift can still be found
+        weights = weights / np.sum(weights) + 1e-6 / len(self.freqs)
+        self.log_prior = np.log(weights)
+        self.clear()
+
+    def next_probes(self):
+        """ evenly spaced comb of self.probes grid frequencies with the largest information gain """
+        num_freqs = len(self.freqs)
+        noise = self.noise if np.isfinite(self.noise) else 1.0
+        if len(self.values) > 2 and np.isfinite(self.noise):
+            amp = max(abs(self.amp[np.argmax(self.weights)]), self.snr * noise)
+        else:
+            amp = self.snr * noise
+
+        #### covariance of the predicted signal at all grid frequencies under the posterior
+        keep = self.weights > 1e-8 * np.max(self.weights)
+        mu = amp * self._shape(self.freqs)[keep]
+        w = self.weights[keep] / np.sum(self.weights[keep])
+        dev = np.sqrt(w)[:, np.newaxis] * (mu - w @ mu)
+        cov = dev.T @ dev / noise ** 2
+
+        k = self.probes
+        all_combs, all_gains = [], []
+        spacing = 1
+        while spacing == 1 or (k - 1) * spacing < num_freqs:
+            starts = np.arange(0, max(num_freqs - (k - 1) * spacing, 1))
+            combs = starts[:, np.newaxis] + spacing * np.arange(k)[np.newaxis, :]
+            sub = cov[combs[:, :, np.newaxis], combs[:, np.newaxis, :]]
+            all_combs += list(combs)
+            all_gains += list(0.5 * np.linalg.slogdet(np.eye(k) + sub)[1])
+            spacing *= 2
+
+        #### among (nearly) equal gains take the comb closest to the current estimate
+        all_combs, all_gains = np.array(all_combs), np.array(all_gains)
+        close = np.flatnonzero(all_gains >= np.max(all_gains) - 0.01 * abs(np.max(all_gains)))
+        dists = np.abs(self.freqs[all_combs[close]].mean(axis=1) - self.mean)
+        best_comb = all_combs[close[np.argmin(dists)]]
+        return self.freqs[best_comb]
+
+    def track(self, measure, target_std=None, max_rounds=None):
+        """
+        measures until the standard deviation of the posterior is below target_std
+        @param measure - function(probe_freqs) returning the signal at the evenly spaced probe_freqs
+        returns the mean and the standard deviation of the posterior
+        """
+        target_std = self.target_std if target_std is None else target_std
+        max_rounds = self.max_rounds if max_rounds is None else max_rounds
+        for idx_round in range(max_rounds):
+            if idx_round > 0 and len(self.values) > 2 and self.std <= target_std:
+                break
+            probe_freqs = self.next_probes()
+            self.add(probe_freqs, measure(probe_freqs))
+        self.history.append((self.mean, self.std, len(self.values)))
+        return self.mean, self.std
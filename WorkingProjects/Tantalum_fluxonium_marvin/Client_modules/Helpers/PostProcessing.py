@@ -1,21 +1,72 @@
+import os
+os.environ.setdefault("OMP_NUM_THREADS", '1') ### one thread per worker, the process pool does the parallel part
 import numpy as np
 import h5py
 from tqdm import tqdm
 import json
 import csv
+import hashlib
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers import SingleShotAnalysis, ShotClassification
 from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.SingleShotAnalysis import PS_Analysis
 
 # Get all the filenames from the csv
 pathdata_csv_filename = r"Z:\TantalumFluxonium\Data\2023_10_31_BF2_cooldown_6\WTF\TempChecks\Summary\WTF_cooldown6_pathtodata_all.csv"
 
-with open(pathdata_csv_filename, 'r') as file:
-    reader = csv.reader(file)
-    data = list(reader)
+# Summary table with one row per data file
+save_csv_path = r'Z:\TantalumFluxonium\Data\2023_10_31_BF2_cooldown_6\WTF\TempChecks\Summary\PostProcessed\WTF_cooldown6_tempData_postprocessed.csv'
 
-# Index for single shot data is 5
+#### results of every file are cached here, keyed by the file contents, the analysis parameters and the analysis
+#### code, so a rerun only analyses new or changed files. failed fits are not cached and are tried again
+cache_dir = r'Z:\TantalumFluxonium\Data\2023_10_31_BF2_cooldown_6\WTF\TempChecks\Summary\PostProcessed\cache'
 
-# Looping over all the rows
-for row in tqdm(data[1:]):
+num_workers = 8
+
+#### analysis parameters, changing any of them invalidates the cache
+AnalysisParams = {
+    'cen_num': 2,
+    'cluster_method': 'gmm',
+    'init_method': 'all',
+    'gauss_fit': True,
+    'wait_num': 0,
+    'confidence_selection': 0.0,
+    'bin_size': 51,
+}
+
+SummaryHeader = ['yoko_volt', 'qubit_freq', 'fridge_temp',
+                 'temp_mean', 'temp_std', 'temp_median', 'temp_95_low', 'temp_95_high',
+                 'PopState_0_mean', 'PopState_0_std', 'PopState_0_median', 'PopState_0_95_low', 'PopState_0_95_high',
+                 'PopState_1_mean', 'PopState_1_std', 'PopState_1_median', 'PopState_1_95_low', 'PopState_1_95_high']
+
+
+def file_hash(file_paths, chunk_size=2**20):
+    #### hash of the contents of all the files
+    hasher = hashlib.sha256()
+    for file_path in file_paths:
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+#### hash of the analysis code, a change to SingleShotAnalysis.py or to the GMM, classification and EM code it uses
+#### from ShotClassification.py invalidates the cache like a change of parameters
+AnalysisCodeHash = file_hash([SingleShotAnalysis.__file__, ShotClassification.__file__])
+
+
+def cache_key(file_loc, params):
+    #### key of one data file: the h5 and json contents together with the analysis parameters and code
+    hasher = hashlib.sha256()
+    hasher.update(file_hash([file_loc + '.h5', file_loc + '.json']).encode())
+    hasher.update(json.dumps(params, sort_keys=True).encode())
+    hasher.update(AnalysisCodeHash.encode())
+    return hasher.hexdigest()
+
+
+def analyze_row(row, params):
+    #### analyse the single shot data of one row of the path csv, returns the row of the summary table and whether
+    #### the fit worked. a failed fit gives zero estimates
 
     # Find the name for single shot data path and removing the .h5
     file_loc = row[6][:-3]
@@ -23,10 +74,7 @@ for row in tqdm(data[1:]):
     # Get the filename and the path
     path_split = file_loc.split('\\')
     path = '\\'.join(path_split[:-1])
-    print("Path is ",path)
     fname = path_split[-1]
-    print("Filename is ",fname)
-
 
     # try to extract the qubit frequency
     json_path = file_loc + '.json'
@@ -39,108 +87,127 @@ for row in tqdm(data[1:]):
             fridge_tempr = config["fridge_temp"]
         except:
             fridge_tempr = float(row[0])
-        json_file.close()
 
     if float(row[2]) - qubit_freq > 50 :
         qubit_freq = float(row[2])
 
-    print("qubit frequency " + str(qubit_freq))
-
-    # Loading the data
-    data_exp = h5py.File(file_loc + ".h5", 'r')
-    print(data_exp.keys())
-    # Creating the class object for analyzing post-selected data
-    cen_num = 2
-
     ### try to perform the fit and if it fails continue
+    fit_ok = True
     try:
-        SSData = PS_Analysis(
-            data=data_exp,
-            cen_num=cen_num,
-            cluster_method='gmm',
-            init_method='all',
-            data_name=fname,
-            outerFolder=path,
-            gauss_fit=True,
-        )
-
-        # Calculate the populations and temperatures
-        estimates_full = SSData.GaussFitMeasurement(
-            wait_num=0,
-            confidence_selection=0.0,
-            bin_size=51,
-            plot_title='Final_Meas_Fit',
-            save_estimates_name='Value_Estimates',
-            save_pop_results=True,
-            qubit_freq=qubit_freq
-        )
-    except:
+        # Loading the data
+        with h5py.File(file_loc + ".h5", 'r') as data_exp:
+            # Creating the class object for analyzing post-selected data
+            SSData = PS_Analysis(
+                data=data_exp,
+                cen_num=params['cen_num'],
+                cluster_method=params['cluster_method'],
+                init_method=params['init_method'],
+                data_name=fname,
+                outerFolder=path,
+                gauss_fit=params['gauss_fit'],
+            )
+
+            # Calculate the populations and temperatures
+            estimates_full = SSData.GaussFitMeasurement(
+                wait_num=params['wait_num'],
+                confidence_selection=params['confidence_selection'],
+                bin_size=params['bin_size'],
+                plot_title='Final_Meas_Fit',
+                save_estimates_name='Value_Estimates',
+                save_pop_results=True,
+                qubit_freq=qubit_freq
+            )
+    except Exception as e:
+        print('Fit failed for ' + fname + ': ' + repr(e))
+        fit_ok = False
         ### fill in empty estimates
-        estimates_full = {}
-        estimates_full['Starting_0'] = {}
-        estimates_full['Starting_0']['PopState_0_mean'] = 0.0
-        estimates_full['Starting_0']['PopState_0_std'] = 0.0
-        estimates_full['Starting_0']['PopState_0_median'] = 0.0
-        estimates_full['Starting_0']['PopState_0_median'] = 0.0
-        estimates_full['Starting_0']['PopState_0_95_low'] = 0.0
-        estimates_full['Starting_0']['PopState_0_95_high'] = 0.0
-
-        estimates_full['Starting_0']['PopState_1_mean'] = 0.0
-        estimates_full['Starting_0']['PopState_1_std'] = 0.0
-        estimates_full['Starting_0']['PopState_1_median'] = 0.0
-        estimates_full['Starting_0']['PopState_1_median'] = 0.0
-        estimates_full['Starting_0']['PopState_1_95_low'] = 0.0
-        estimates_full['Starting_0']['PopState_1_95_high'] = 0.0
-
-    # Create an empty list to collect all data to be stored in a csv
-    processed_data = []
+        estimates_full = {'Starting_0': {}}
+        for idx_cen in range(2):
+            for stat in ['mean', 'std', 'median', '95_low', '95_high']:
+                estimates_full['Starting_0']['PopState_' + str(idx_cen) + '_' + stat] = 0.0
+    finally:
+        plt.close('all')
 
     # Experiment information
-    processed_data.append(yoko_volt)
-    processed_data.append(qubit_freq)
-    try:
-        processed_data.append(fridge_tempr)
-    except:
-        processed_data.append('0')
-
+    processed_data = [yoko_volt, qubit_freq, fridge_tempr]
 
     # Procesesd information
     try:
-        processed_data.append(estimates_full['Starting_0']['temp_mean'])
-        processed_data.append(estimates_full['Starting_0']['temp_std'])
-        processed_data.append(estimates_full['Starting_0']['temp_median'])
-        processed_data.append(estimates_full['Starting_0']['temp_95_low'])
-        processed_data.append(estimates_full['Starting_0']['temp_95_high'])
-    except:
-        processed_data.append('0')
-        processed_data.append('0')
-        processed_data.append('0')
-        processed_data.append('0')
-        processed_data.append('0')
-
-    processed_data.append(estimates_full['Starting_0']['PopState_0_mean'])
-    processed_data.append(estimates_full['Starting_0']['PopState_0_std'])
-    processed_data.append(estimates_full['Starting_0']['PopState_0_median'])
-    processed_data.append(estimates_full['Starting_0']['PopState_0_95_low'])
-    processed_data.append(estimates_full['Starting_0']['PopState_0_95_high'])
-
-    processed_data.append(estimates_full['Starting_0']['PopState_1_mean'])
-    processed_data.append(estimates_full['Starting_0']['PopState_1_std'])
-    processed_data.append(estimates_full['Starting_0']['PopState_1_median'])
-    processed_data.append(estimates_full['Starting_0']['PopState_1_95_low'])
-    processed_data.append(estimates_full['Starting_0']['PopState_1_95_high'])
-
-    # Save it as a new row to a csv
-    save_csv_path = r'Z:\TantalumFluxonium\Data\2023_10_31_BF2_cooldown_6\WTF\TempChecks\Summary\PostProcessed\WTF_cooldown6_tempData_postprocessed.csv'
-
-    # Open the existing CSV file in append mode
-    with open(save_csv_path, mode='a', newline='') as file:
-        # Create a CSV writer object
+        processed_data += [estimates_full['Starting_0']['temp_' + stat]
+                           for stat in ['mean', 'std', 'median', '95_low', '95_high']]
+    except KeyError:
+        processed_data += ['0'] * 5
+
+    for idx_cen in range(2):
+        processed_data += [estimates_full['Starting_0']['PopState_' + str(idx_cen) + '_' + stat]
+                           for stat in ['mean', 'std', 'median', '95_low', '95_high']]
+
+    return [float(value) for value in processed_data], fit_ok
+
+
+def process_row(row, params, cache_dir):
+    #### analyse one row unless its result is already in the cache. Returns the summary row and whether it was cached
+    key = cache_key(row[6][:-3], params)
+    cache_file = os.path.join(cache_dir, key + '.json')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as file:
+            return json.load(file)['result'], True
+
+    result, fit_ok = analyze_row(row, params)
+    if not fit_ok:
+        return result, False
+    with open(cache_file + '.tmp', 'w') as file:
+        json.dump({'file': row[6], 'params': params, 'result': result}, file)
+    os.replace(cache_file + '.tmp', cache_file)
+    return result, False
+
+
+def _init_worker():
+    #### workers only save figures
+    plt.switch_backend('Agg')
+
+
+def run_batch(rows, params=AnalysisParams, cache_dir=cache_dir, num_workers=num_workers):
+    #### fan the rows out over a process pool, the results come back in the order of rows
+    #### rows that raise (e.g. missing files) are reported and left as None
+    os.makedirs(cache_dir, exist_ok=True)
+    results = [None] * len(rows)
+    num_cached = 0
+    failed = []
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker) as pool:
+        futures = {pool.submit(process_row, row, params, cache_dir): idx for idx, row in enumerate(rows)}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            idx = futures[future]
+            try:
+                results[idx], cached = future.result()
+                num_cached += cached
+            except Exception as e:
+                failed.append(idx)
+                print('Row ' + str(idx) + ' (' + rows[idx][6] + ') failed: ' + repr(e))
+
+    print(str(len(rows) - num_cached - len(failed)) + ' files analysed, ' + str(num_cached) + ' from cache, '
+          + str(len(failed)) + ' failed')
+    return results
+
+
+def save_summary(rows, results, save_path=save_csv_path):
+    #### write the whole summary table, rows that failed are left out
+    with open(save_path, mode='w', newline='') as file:
         writer = csv.writer(file)
-
-        # Write the list to the CSV file
-        writer.writerow(processed_data)
-
-    # Close the open csv
-    file.close()
-
+        writer.writerow(['data_path'] + SummaryHeader)
+        for row, result in zip(rows, results):
+            if result is not None:
+                writer.writerow([row[6]] + result)
+
+
+if __name__ == '__main__':
+    with open(pathdata_csv_filename, 'r') as file:
+        reader = csv.reader(file)
+        data = list(reader)
+
+    # Index for single shot data is 6
+    rows = data[1:]
+    results = run_batch(rows)
+    save_summary(rows, results)
+    print('Summary saved to ' + save_csv_path)
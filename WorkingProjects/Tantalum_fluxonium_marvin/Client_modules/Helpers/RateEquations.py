@@ -0,0 +1,100 @@
+#### closed form solution of the linear rate equations dP/dt = M P for N levels
+#### used by GammaFit in place of odeint, all wait times are evaluated in one
+#### call through the eigen decomposition of the rate matrix
+
+import numpy as np
+from scipy.linalg import expm
+
+
+def rate_matrix(gammas):
+    """
+    gammas: [N, N] array, gammas[i, j] is the rate from state i to state j,
+        the diagonal is ignored
+    returns: generator M with dP/dt = M @ P
+    """
+    G = np.array(gammas, dtype=float)
+    np.fill_diagonal(G, 0.0)
+    return G.T - np.diag(np.sum(G, axis=1))
+
+
+def two_level_gammas(g01, g10):
+    """ gammas matrix for the two level system of GammaFit.Pops_ode """
+    return np.array([[0.0, g01], [g10, 0.0]])
+
+
+def _eig(M):
+    lam, V = np.linalg.eig(M)
+    ### a defective matrix has no usable eigen basis
+    if np.linalg.cond(V) > 1e10:
+        return None
+    return lam, V, np.linalg.inv(V)
+
+
+def propagate(t, pops_init, gammas):
+    """
+    populations at every time in t starting from pops_init at t = 0
+    t: array of times, in the inverse units of gammas
+    pops_init: [N] or [K, N] initial populations
+    returns: [len(t), N] (or [K, len(t), N]), the same layout odeint uses
+    """
+    t = np.atleast_1d(np.asarray(t, dtype=float))
+    pops_init = np.asarray(pops_init, dtype=float)
+    M = rate_matrix(gammas)
+
+    decomp = _eig(M)
+    if decomp is None:
+        props = expm(M[None, :, :] * t[:, None, None])
+    else:
+        lam, V, Vinv = decomp
+        props = np.einsum('ia,ta,aj->tij', V, np.exp(np.outer(t, lam)), Vinv)
+
+    return np.real(np.einsum('tij,...j->...ti', props, pops_init))
+
+
+def _phi(lam, t):
+    """
+    divided differences of exp(lam t): phi[t, a, b] = (e^(lam_a t) - e^(lam_b t)) / (lam_a - lam_b),
+    t e^(lam_a t) when lam_a = lam_b
+    """
+    exp_lt = np.exp(np.outer(t, lam))
+    dlam = lam[:, None] - lam[None, :]
+    same = np.isclose(dlam, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        phi = (exp_lt[:, :, None] - exp_lt[:, None, :]) / np.where(same, 1.0, dlam)
+    return np.where(same, t[:, None, None] * exp_lt[:, :, None], phi)
+
+
+def propagate_jacobian(t, pops_init, gammas):
+    """
+    analytic derivative of propagate with respect to every rate
+    returns: jac[..., t, state, i, j] = dP_state(t) / dgammas[i, j], zero for i = j
+    """
+    t = np.atleast_1d(np.asarray(t, dtype=float))
+    pops_init = np.asarray(pops_init, dtype=float)
+    M = rate_matrix(gammas)
+    N = M.shape[0]
+
+    ### dM/dgammas[i, j]: feeds state j from state i and drains state i
+    dM = np.zeros([N, N, N, N])
+    for i in range(N):
+        for j in range(N):
+            if i != j:
+                dM[i, j, j, i] += 1.0
+                dM[i, j, i, i] -= 1.0
+
+    decomp = _eig(M)
+    if decomp is None:
+        #### fall back on the frechet derivative of expm, one time step at a time
+        from scipy.linalg import expm_frechet
+        dprops = np.zeros([len(t), N, N, N, N])
+        for idx_t, t_val in enumerate(t):
+            for i in range(N):
+                for j in range(N):
+                    if i != j:
+                        dprops[idx_t, :, :, i, j] = expm_frechet(M * t_val, dM[i, j] * t_val, compute_expm=False)
+    else:
+        lam, V, Vinv = decomp
+        dM_eig = np.einsum('ak,ijkl,lb->ijab', Vinv, dM, V)
+        dprops = np.einsum('ka,ijab,tab,bl->tklij', V, dM_eig, _phi(lam, t), Vinv)
+
+    return np.real(np.einsum('tklij,...l->...tkij', dprops, pops_init))
@@ -0,0 +1,278 @@
+#### whole-array shot classification used by PS_Analysis
+#### every function works on I and Q arrays of any shape, so a full T1_PS
+#### data set indexed as [wait step][shot] is classified in one call instead
+#### of looping over shots and clusters in python
+
+import time
+import numpy as np
+
+
+def center_distances(I, Q, Centers):
+    """
+    distance of every shot to every cluster center
+    I, Q: arrays of the same shape, e.g. [wait num, shot num]
+    Centers: array [cen_num, 2]
+    returns: array of shape I.shape + (cen_num,)
+    """
+    I = np.asarray(I, dtype=float)[..., np.newaxis]
+    Q = np.asarray(Q, dtype=float)[..., np.newaxis]
+    Centers = np.asarray(Centers, dtype=float)
+    return np.hypot(I - Centers[:, 0], Q - Centers[:, 1])
+
+
+def nearest_center(I, Q, Centers):
+    """
+    label of the closest center for every shot and the distance to it
+    returns: labels, dists both with the shape of I
+    """
+    dists = center_distances(I, Q, Centers)
+    labels = np.argmin(dists, axis=-1)
+    return labels, np.take_along_axis(dists, labels[..., np.newaxis], axis=-1)[..., 0]
+
+
+def cluster_sizes(I, Q, Centers, labels):
+    """
+    mean distance of the shots in each cluster to their own center,
+    nan for an empty cluster
+    """
+    labels = np.ravel(labels)
+    cen_num = len(Centers)
+    dists = center_distances(np.ravel(I), np.ravel(Q), Centers)[np.arange(labels.size), labels]
+    counts = np.bincount(labels, minlength=cen_num).astype(float)
+    sums = np.bincount(labels, weights=dists, minlength=cen_num)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def grid_index(grid, values):
+    """
+    index of the nearest point of a sorted grid for every value, same result
+    as np.argmin(np.abs(grid - value)) per value (ties go to the lower index)
+    """
+    grid = np.asarray(grid)
+    values = np.asarray(values)
+    if grid.size == 1:
+        return np.zeros(values.shape, dtype=int)
+    idx = np.clip(np.searchsorted(grid, values), 1, grid.size - 1)
+    go_left = (values - grid[idx - 1]) <= (grid[idx] - values)
+    return idx - go_left
+
+
+def pdf_lookup(I, Q, x_points, y_points, pdf):
+    """
+    probability of every shot to belong to each gaussian, read off the
+    pdf grids made by calcPDF at the nearest grid point
+    pdf: list or array [cen_num][x index, y index]
+    returns: array of shape (cen_num,) + I.shape
+    """
+    i_idx = grid_index(x_points, I)
+    q_idx = grid_index(y_points, Q)
+    return np.asarray(pdf)[:, i_idx, q_idx]
+
+
+def confidence_mask(probs, confidence_selection):
+    """ boolean mask of the shots whose probability is above the confidence selection """
+    return np.asarray(probs) > confidence_selection
+
+
+def radius_mask(I, Q, Centers, select_size):
+    """
+    membership mask [..., cen_num] of the shots within select_size of each
+    center, a shot can sit in more than one circle if they overlap
+    """
+    return center_distances(I, Q, Centers) <= select_size
+
+
+def transition_counts(mask_int, mask_fin):
+    """
+    number of shots that start in cluster a and end in cluster b
+    mask_int, mask_fin: boolean membership masks [..., shot num, cen_num]
+    returns: counts [..., cen_num (start), cen_num (stop)]
+    """
+    return np.einsum('...sa,...sb->...ab',
+                     np.asarray(mask_int, dtype=float),
+                     np.asarray(mask_fin, dtype=float))
+
+
+def normalize_rows(counts):
+    """ normalize a transition count matrix to populations for each starting cluster """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts / np.sum(counts, axis=-1, keepdims=True)
+
+
+def subsample(I, Q, max_shots, seed=0):
+    """
+    random subset of at most max_shots shots of I and Q (any shape)
+    returns: array [shot num, 2]
+    """
+    iqData = np.stack((np.ravel(I), np.ravel(Q)), axis=1)
+    if iqData.shape[0] <= max_shots:
+        return iqData
+    rng = np.random.default_rng(seed)
+    return iqData[rng.choice(iqData.shape[0], size=max_shots, replace=False)]
+
+
+def tied_gaussian_loglik(I, Q, means, covariance):
+    """
+    log density of every shot under each gaussian of a tied covariance mixture
+    means: array [cen_num, 2], covariance: array [2, 2]
+    returns: array of shape I.shape + (cen_num,)
+    """
+    #### whiten with the cholesky factor of the precision, the mahalanobis
+    #### distance is then the euclidean distance
+    whiten = np.linalg.cholesky(np.linalg.inv(covariance))
+    I_w = np.asarray(I, dtype=float) * whiten[0, 0] + np.asarray(Q, dtype=float) * whiten[1, 0]
+    Q_w = np.asarray(Q, dtype=float) * whiten[1, 1]
+    means_w = np.asarray(means, dtype=float) @ whiten
+    maha = center_distances(I_w, Q_w, means_w) ** 2
+    return -0.5 * maha - np.log(2 * np.pi) - 0.5 * np.linalg.slogdet(covariance)[1]
+
+
+def log_responsibilities(loglik, weights):
+    """ log probability of each gaussian for every shot, loglik [..., cen_num] and weights broadcastable to it """
+    with np.errstate(divide='ignore'):
+        weighted = loglik + np.log(weights)
+    peak = np.max(weighted, axis=-1, keepdims=True)
+    return weighted - peak - np.log(np.sum(np.exp(weighted - peak), axis=-1, keepdims=True))
+
+
+def weights_em(loglik, mask=None, weights=None, max_iter=1000, tol=1e-6):
+    """
+    EM on the mixture weights only, the gaussians stay fixed, for many sets
+    of shots at once
+    loglik: [..., shot num, cen_num] from tied_gaussian_loglik
+    mask: boolean [..., shot num] of the shots in each set, all shots if None.
+        loglik and mask are broadcast, e.g. loglik [time, 1, shot, cen] with
+        mask [time, start cluster, shot] gives weights [time, start, cen]
+    weights: initial weights [cen_num] or [..., cen_num], uniform if None
+    tol: largest change of any weight in the last step
+    returns: weights [..., cen_num], nan for a set without shots
+    """
+    loglik = np.asarray(loglik, dtype=float)
+    cen_num = loglik.shape[-1]
+    if mask is None:
+        mask = np.ones(loglik.shape[:-1], dtype=bool)
+    shape = np.broadcast_shapes(loglik.shape[:-1], np.shape(mask))
+    mask = np.broadcast_to(mask, shape).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mask = mask / np.sum(mask, axis=-1, keepdims=True)
+
+    #### the gaussians are fixed, so the likelihoods are computed once. Each
+    #### step is then w_k <- w_k * mean(L_k / sum_j w_j L_j) over the set
+    lik = np.exp(loglik - np.max(loglik, axis=-1, keepdims=True))
+
+    if weights is None:
+        weights = np.full(cen_num, 1.0 / cen_num)
+    weights = np.array(np.broadcast_to(weights, shape[:-1] + (cen_num,)), dtype=float)
+
+    for idx in range(max_iter):
+        total = (lik @ weights[..., np.newaxis])[..., 0]
+        weights_new = weights * ((mask / total)[..., np.newaxis, :] @ lik)[..., 0, :]
+        converged = np.nanmax(np.abs(weights_new - weights), initial=0.0) < tol
+        weights = weights_new
+        if converged:
+            break
+
+    return weights
+
+
+def benchmark(wait_num=20, num_shots=20000, cen_num=2, seed=0):
+    """
+    compares the per-shot loop that PS_Analysis.popCount used with the
+    whole-array version on a synthetic data set and prints the timings
+    """
+    rng = np.random.default_rng(seed)
+    Centers = rng.uniform(-5, 5, size=(cen_num, 2))
+    select_size = 1.0
+    starts = rng.integers(cen_num, size=(wait_num, num_shots))
+    stops = rng.integers(cen_num, size=(wait_num, num_shots))
+    i_0_arr = Centers[starts, 0] + rng.normal(0, 0.6, (wait_num, num_shots))
+    q_0_arr = Centers[starts, 1] + rng.normal(0, 0.6, (wait_num, num_shots))
+    i_1_arr = Centers[stops, 0] + rng.normal(0, 0.6, (wait_num, num_shots))
+    q_1_arr = Centers[stops, 1] + rng.normal(0, 0.6, (wait_num, num_shots))
+
+    #### reference loop over shots and clusters
+    start = time.time()
+    pops_loop = np.full([wait_num, cen_num, cen_num], 0.0)
+    for idx_t in range(wait_num):
+        for idx_shot in range(num_shots):
+            for idx_cen_int in range(cen_num):
+                dist_int = np.sqrt((Centers[idx_cen_int][0] - i_0_arr[idx_t][idx_shot])**2 +
+                                   (Centers[idx_cen_int][1] - q_0_arr[idx_t][idx_shot])**2)
+                if dist_int <= select_size:
+                    for idx_cen_fin in range(cen_num):
+                        dist_fin = np.sqrt((Centers[idx_cen_fin][0] - i_1_arr[idx_t][idx_shot])**2 +
+                                           (Centers[idx_cen_fin][1] - q_1_arr[idx_t][idx_shot])**2)
+                        if dist_fin <= select_size:
+                            pops_loop[idx_t][idx_cen_int][idx_cen_fin] += 1.0
+    pops_loop = normalize_rows(pops_loop)
+    t_loop = time.time() - start
+
+    #### whole-array version
+    start = time.time()
+    pops_vec = normalize_rows(transition_counts(
+        radius_mask(i_0_arr, q_0_arr, Centers, select_size),
+        radius_mask(i_1_arr, q_1_arr, Centers, select_size)))
+    t_vec = time.time() - start
+
+    print('shots: ' + str(wait_num) + ' x ' + str(num_shots))
+    print('loop: ' + str(round(t_loop, 3)) + ' s, vectorized: ' + str(round(t_vec, 4)) + ' s, speedup: '
+          + str(round(t_loop / t_vec, 1)))
+    print('max population difference: ' + str(np.nanmax(np.abs(pops_loop - pops_vec))))
+    return t_loop, t_vec
+
+
+def benchmark_gmm(wait_num=100, num_shots=20000, cen_num=2, seed=0):
+    """
+    compares one sklearn GMM refit per time step and starting cluster, as
+    PS_Analysis.popCount did, with weights_em over all steps at once
+    """
+    from sklearn.mixture import GaussianMixture as GMM
+
+    rng = np.random.default_rng(seed)
+    Centers = np.array([[-2.0, 0.0], [2.0, 0.5], [0.0, 3.0]])[:cen_num]
+    p_flip = np.linspace(0, 0.4, wait_num)[:, np.newaxis]
+    starts = (rng.random((wait_num, num_shots)) < 0.3).astype(int)
+    stops = np.where(rng.random((wait_num, num_shots)) < p_flip, 1 - starts, starts)
+    i_0_arr = Centers[starts, 0] + rng.normal(0, 0.6, (wait_num, num_shots))
+    q_0_arr = Centers[starts, 1] + rng.normal(0, 0.6, (wait_num, num_shots))
+    i_1_arr = Centers[stops, 0] + rng.normal(0, 0.6, (wait_num, num_shots))
+    q_1_arr = Centers[stops, 1] + rng.normal(0, 0.6, (wait_num, num_shots))
+
+    gmm = GMM(n_components=cen_num, covariance_type='tied', n_init=10).fit(
+        subsample(i_0_arr, q_0_arr, 100000, seed=seed))
+    prob_thresh = 0.999
+
+    #### reference, a new GMM for every time step and starting cluster
+    start = time.time()
+    pops_loop = np.full([wait_num, cen_num, cen_num], np.nan)
+    for idx_t in range(wait_num):
+        iqData_int = np.stack((i_0_arr[idx_t], q_0_arr[idx_t]), axis=1)
+        iqData_fin = np.stack((i_1_arr[idx_t], q_1_arr[idx_t]), axis=1)
+        probs = gmm.predict_proba(iqData_int)
+        for idx_cen_int in range(cen_num):
+            IQ_fin = iqData_fin[probs[:, idx_cen_int] > prob_thresh]
+            pops_loop[idx_t][idx_cen_int] = GMM(
+                n_components=cen_num, covariance_type='tied', means_init=gmm.means_,
+                precisions_init=gmm.precisions_, n_init=1).fit(IQ_fin).weights_
+    t_loop = time.time() - start
+
+    #### weights only EM on fixed gaussians, all steps at once
+    start = time.time()
+    probs_int = np.exp(log_responsibilities(
+        tied_gaussian_loglik(i_0_arr, q_0_arr, gmm.means_, gmm.covariances_), gmm.weights_))
+    mask = np.moveaxis(probs_int > prob_thresh, -1, -2)
+    loglik_fin = tied_gaussian_loglik(i_1_arr, q_1_arr, gmm.means_, gmm.covariances_)[:, np.newaxis]
+    pops_vec = weights_em(loglik_fin, mask, gmm.weights_)
+    t_vec = time.time() - start
+
+    print('shots: ' + str(wait_num) + ' x ' + str(num_shots))
+    print('GMM refits: ' + str(round(t_loop, 3)) + ' s, weights EM: ' + str(round(t_vec, 4)) + ' s, speedup: '
+          + str(round(t_loop / t_vec, 1)))
+    print('max population difference: ' + str(np.nanmax(np.abs(pops_loop - pops_vec))))
+    return t_loop, t_vec
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark_gmm()
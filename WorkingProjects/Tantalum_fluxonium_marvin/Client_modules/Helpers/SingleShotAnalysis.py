@@ -26,6 +26,10 @@ from lmfit import Model, Parameters, Minimizer, report_fit, conf_interval
 from lmfit.model import save_modelresult
 from lmfit.models import Gaussian2dModel
 
+from WorkingProjects.Tantalum_fluxonium_marvin.Client_modules.Helpers.ShotClassification import (
+    cluster_sizes, pdf_lookup, confidence_mask, radius_mask, transition_counts, normalize_rows,
+    subsample, tied_gaussian_loglik, log_responsibilities, weights_em)
+
 #from scipy.io import savemat
 
 ### define some constants
@@ -72,7 +76,8 @@ class PS_Analysis:
         init_method = 'all',
         outerFolder = None,
         data_name = None,
-        gauss_fit = False
+        gauss_fit = False,
+        fit_subsample = 100000,
     ):
         """
         data : 'h5' file containing all data
@@ -90,6 +95,8 @@ class PS_Analysis:
             set to None, a subfolder will be made in the current directory
         data_name: str, name of the data set, the stored files will 
             contain this name
+        fit_subsample: int, largest number of shots used to search for the
+            clusters, the result is then refined on all shots
         """
 
         ### define number of clusters used
@@ -99,6 +106,7 @@ class PS_Analysis:
         self.select_size = select_size
         self.cluster_method = cluster_method
         self.init_method = init_method
+        self.fit_subsample = fit_subsample
             
 
         #### create a subfolder for the figure and info storage
@@ -226,65 +234,35 @@ class PS_Analysis:
         iqData = np.stack((I, Q), axis = 1)
 
         if self.Centers is not None:
-            self.kmeans = KMeans(
-                n_clusters = self.cen_num,
-                n_init = 1,
-                max_iter = 1000, 
-                init = self.Centers
-                ).fit(iqData)
-            #### redefine centers
-            self.Centers = self.kmeans.cluster_centers_
+            Centers_init = self.Centers
         else:
-            ### if Centers was given, use as initial estimate, if not use normal
-            self.kmeans = KMeans(
+            ### search for the clusters on a subsample of the shots
+            Centers_init = KMeans(
                 n_clusters = self.cen_num,
                 n_init = 10,
                 max_iter = 1000, 
-                ).fit(iqData)
+                ).fit(subsample(I, Q, self.fit_subsample)).cluster_centers_
 
-            ### from kmeans extract out the centers and labels
-            self.Centers = self.kmeans.cluster_centers_
-
-        ### create a place holder for the centers
-        Centers_hold = np.copy(self.Centers)
-        #### find the size of each cluster
-        labels = self.kmeans.labels_
-        unique, counts = np.unique(labels, return_counts=True)
-        sizes = np.zeros(len(unique))
-        for idx in range(len(unique)):
-            sizes[unique[idx]] = counts[idx]
-        sizes_index = np.array(sizes).argsort().tolist()[::-1]
- 
-        ### reorganize the centers
-        for idx_cen in range(self.cen_num):
-            Centers_hold[idx_cen] = self.Centers[sizes_index[idx_cen]]
-
-        ### recenter the data
+        ### refine on all the shots
         self.kmeans = KMeans(
             n_clusters = self.cen_num,
             n_init = 1,
             max_iter = 1000, 
-            init = Centers_hold
+            init = Centers_init
             ).fit(iqData)
+
+        #### order the clusters from largest to smallest, this only relabels
+        #### the clusters so no refit is needed
+        sizes = np.bincount(self.kmeans.labels_, minlength = self.cen_num)
+        sizes_index = np.array(sizes).argsort()[::-1]
+        self.kmeans.cluster_centers_ = self.kmeans.cluster_centers_[sizes_index]
+        self.kmeans.labels_ = np.argsort(sizes_index)[self.kmeans.labels_]
         #### redefine centers
         self.Centers = self.kmeans.cluster_centers_
 
-        ### from kmeans, find the average size of each cluster
-        dists = np.full([self.cen_num, len(I)], np.nan)
-        blob_nums = self.kmeans.labels_
-        for idx_shot in range(len(I)):
-            for idx_cen in range(self.cen_num):
-                if blob_nums[idx_shot] == idx_cen:
-                    dists[idx_cen][idx_shot] = np.sqrt(
-                        (self.Centers[idx_cen][0] - I[idx_shot])**2 + 
-                        (self.Centers[idx_cen][1] - Q[idx_shot])**2
-                    )
-
         ### store the average size of each cluster
         if self.select_size is None:
-            cluster_size = np.full(self.cen_num, np.nan)
-            for idx_cen in range(self.cen_num):
-                cluster_size[idx_cen] = np.nanmean(dists[idx_cen])
+            cluster_size = cluster_sizes(I, Q, self.Centers, self.kmeans.labels_)
 
             self.select_size = np.mean(cluster_size)*1.25
             
@@ -301,29 +279,30 @@ class PS_Analysis:
                 covariance_type = 'tied', 
                 means_init = self.Centers
             ).fit(iqData)
-            #### redefine centers
-            self.Centers = self.gmm.means_
         else:
+            ### search for the clusters on a subsample of the shots
+            iqData_sub = subsample(I, Q, self.fit_subsample)
             self.gmm = GMM(
                 n_components=self.cen_num, 
                 covariance_type = 'tied', 
                 n_init = 10,
-            ).fit(iqData)
-            #### redefine centers
-            self.Centers = self.gmm.means_
+            ).fit(iqData_sub)
 
-        #### find which cluster is largest and recluster with ordered centers
-        Centers_hold = np.copy(self.Centers)
-        sizes = self.gmm.weights_ 
-        sizes_index = np.array(sizes).argsort().tolist()[::-1]
-        for idx_cen in range(self.cen_num):
-            Centers_hold[idx_cen] = self.Centers[sizes_index[idx_cen]]
+            ### refine on all the shots, warm started from the subsample fit
+            if len(iqData_sub) < len(iqData):
+                self.gmm = GMM(
+                    n_components=self.cen_num, 
+                    covariance_type = 'tied', 
+                    weights_init = self.gmm.weights_,
+                    means_init = self.gmm.means_,
+                    precisions_init = self.gmm.precisions_,
+                ).fit(iqData)
 
-        self.gmm = GMM(
-            n_components=self.cen_num, 
-            covariance_type = 'tied', 
-            means_init = Centers_hold,
-        ).fit(iqData)
+        #### order the clusters from largest to smallest weight, with a tied
+        #### covariance this only relabels the means and weights
+        sizes_index = np.array(self.gmm.weights_).argsort()[::-1]
+        self.gmm.weights_ = self.gmm.weights_[sizes_index]
+        self.gmm.means_ = self.gmm.means_[sizes_index]
         #### redefine centers
         self.Centers = self.gmm.means_
        
@@ -539,18 +518,10 @@ class PS_Analysis:
         ### create array for storing the blobs and distance of points to center
         ### blobs arr is indexed as:
         ### blobs[starting cluster num][meas num][I or Q][shot num]
-        blobs = np.full([self.cen_num, 2, 2, len(I)], np.nan)
-
-        ### loop over all shots and sort IQ data into arrays
-        for idx_shot in range(len(I)):
-            for idx_cen in range(self.cen_num):
-                if blobNums[idx_shot] == idx_cen:
-                    ### fill blobs array with data
-                    blobs[idx_cen][0][0][idx_shot] = I[idx_shot]
-                    blobs[idx_cen][0][1][idx_shot] = Q[idx_shot]
-
-                    blobs[idx_cen][1][0][idx_shot] = I1[idx_shot]
-                    blobs[idx_cen][1][1][idx_shot] = Q1[idx_shot]
+        ### shots that are not in the starting cluster are left as nan
+        iq_meas = np.array([[I, Q], [I1, Q1]], dtype=float)
+        in_blob = blobNums == np.arange(self.cen_num)[:, None, None, None]
+        blobs = np.where(in_blob, iq_meas[None], np.nan)
 
         return blobs
 
@@ -569,44 +540,20 @@ class PS_Analysis:
         full model to fit the data
         """
 
-        sorted_shots = []
-            
-        for idx in range(self.cen_num):
-            sorted_shots.append([])
-        
-            for idx_shot in range(len(I0)):
-                i_val = I0[idx_shot]
-                q_val = Q0[idx_shot]
-            
-                i_idx = np.argmin(np.abs(self.init_x_points - i_val))
-                q_idx = np.argmin(np.abs(self.init_y_points - q_val))
-            
-                sorted_shots[idx].append(self.pdf[idx][i_idx, q_idx])
-        
-        #### create lists to store the shots
-        i_int_shots = []
-        q_int_shots = []
-        
-        i_fin_shots = []
-        q_fin_shots = []
-        
+        I0, Q0 = np.asarray(I0), np.asarray(Q0)
+        I1, Q1 = np.asarray(I1), np.asarray(Q1)
+
+        #### probability of each shot to start in each gaussian, [cen num][shot num]
+        sorted_shots = pdf_lookup(
+            I0, Q0, self.init_x_points, self.init_y_points, self.pdf)
+        selected = confidence_mask(sorted_shots, confidence_selection)
+
         #### sort out the shots
-        for idx_cen in range(self.cen_num):
-            i_int_shots.append([])
-            q_int_shots.append([])
-            
-            i_fin_shots.append([])
-            q_fin_shots.append([])
-        
-            for idx_shot in range(len(sorted_shots[idx_cen])):
-            
-                if sorted_shots[idx_cen][idx_shot] > confidence_selection:
-            
-                    i_int_shots[idx_cen].append(I0[idx_shot])
-                    q_int_shots[idx_cen].append(Q0[idx_shot])
-            
-                    i_fin_shots[idx_cen].append(I1[idx_shot])
-                    q_fin_shots[idx_cen].append(Q1[idx_shot])
+        i_int_shots = [I0[selected[idx_cen]] for idx_cen in range(self.cen_num)]
+        q_int_shots = [Q0[selected[idx_cen]] for idx_cen in range(self.cen_num)]
+
+        i_fin_shots = [I1[selected[idx_cen]] for idx_cen in range(self.cen_num)]
+        q_fin_shots = [Q1[selected[idx_cen]] for idx_cen in range(self.cen_num)]
         
         ##### create a list to store the result objects
         results_list = []
@@ -773,104 +720,52 @@ class PS_Analysis:
         #### return the population estimates
         return estimates_full
 
-    ### create function to count final state populations for kmeans and none
+    ### create function to count final state populations
     def popCount(self, 
                 wait_num = 0,
                 ):
         ### wait_num: int, index for t_arr time slice
 
-        ### define array for storing the population info
-        pops = np.full([self.cen_num, self.cen_num], 0.0)
+        return self.popCountAll(wait_nums = [wait_num])[0]
         
-        if self.cluster_method in ['kmeans', 'None']:
-
-            for idx_shot in range(self.num_shots):
-                ### pull out the initial I and Q value
-                I_int = self.i_0_arr[wait_num][idx_shot]
-                Q_int = self.q_0_arr[wait_num][idx_shot]
-
-                ### pull out the final I and Q value
-                I_fin = self.i_1_arr[wait_num][idx_shot]
-                Q_fin = self.q_1_arr[wait_num][idx_shot]
-
-                for idx_cen_int in range(self.cen_num):
-
-                    ### determine initial distance
-                    dist_int = np.sqrt( 
-                        (self.Centers[idx_cen_int][0] - I_int)**2 +
-                        (self.Centers[idx_cen_int][1] - Q_int)**2
-                        )
-
-                    if dist_int<= self.select_size:
-
-                        for idx_cen_fin in range(self.cen_num):
-                            dist_fin = np.sqrt( 
-                                (self.Centers[idx_cen_fin][0] - I_fin)**2 +
-                                (self.Centers[idx_cen_fin][1] - Q_fin)**2
-                                )
-                            if dist_fin <= self.select_size:
-                                pops[idx_cen_int][idx_cen_fin] += 1.0
-
-
-            for idx_cen in range(self.cen_num):
-                pops[idx_cen] = pops[idx_cen] / np.sum(pops[idx_cen])
-
-            return pops
-        
-        ##### calculate probabilites for gmm
-        elif self.cluster_method == 'gmm':
-
-            I_int = self.i_0_arr[wait_num]
-            Q_int = self.q_0_arr[wait_num]
-            iqData_int = np.stack((I_int, Q_int), axis = 1)
-
-            I_fin = self.i_1_arr[wait_num]
-            Q_fin = self.q_1_arr[wait_num]
-            iqData_fin = np.stack((I_fin, Q_fin), axis = 1)
-
-            #### cluster the initial experiment
-            labels = self.gmm.predict(iqData_int)
-            probs = self.gmm.predict_proba(iqData_int)
-
-            ### find the locations where the probabilies are high
+    ### count the final state populations of several time steps at once
+    def popCountAll(self,
+                wait_nums = None,
+                ):
+        ### wait_nums: list of indices for t_arr, None for all time steps
+        ### returns: pops[time step][starting cluster][final cluster]
+        ### kmeans and None: a shot is counted in every cluster whose
+        ### select_size circle it falls in
+        ### gmm: shots start in a cluster if its probability is above 0.999,
+        ### the final populations are the weights of the fixed gaussians of
+        ### self.gmm, found with a weights only EM for all steps at once
+
+        if wait_nums is None:
+            wait_nums = np.arange(len(self.t_arr))
+
+        I_int = np.asarray(self.i_0_arr)[wait_nums]
+        Q_int = np.asarray(self.q_0_arr)[wait_nums]
+        I_fin = np.asarray(self.i_1_arr)[wait_nums]
+        Q_fin = np.asarray(self.q_1_arr)[wait_nums]
+
+        if self.cluster_method == 'gmm':
             prob_thresh = 0.999
+            probs_int = np.exp(log_responsibilities(
+                tied_gaussian_loglik(I_int, Q_int, self.gmm.means_, self.gmm.covariances_),
+                self.gmm.weights_))
+            ### mask[time step][starting cluster][shot]
+            mask = np.moveaxis(probs_int > prob_thresh, -1, -2)
+            loglik_fin = tied_gaussian_loglik(I_fin, Q_fin, self.gmm.means_, self.gmm.covariances_)
+
+            return weights_em(loglik_fin[:, np.newaxis], mask, self.gmm.weights_)
+
+        counts = transition_counts(
+            radius_mask(I_int, Q_int, self.Centers, self.select_size),
+            radius_mask(I_fin, Q_fin, self.Centers, self.select_size),
+            )
 
-            IQ_sorted_int = []
-            IQ_sorted_fin = []
-
-            ##### loop through the starting states and find the IQ distributions
-            for idx_cen_int in range(self.cen_num):
-                prob_locs = np.argwhere(probs[:,idx_cen_int] > prob_thresh)[:,0]
-
-                IQ_int = iqData_int[prob_locs]
-                IQ_fin = iqData_fin[prob_locs]
-
-                IQ_sorted_int.append(IQ_int)
-                IQ_sorted_fin.append(IQ_fin)
-
-            ### find the probabilites
-            for idx_cen_int in range(self.cen_num):
-                #### recluster the data to find the new weights
-
-                weights_new = GMM(
-                    n_components=self.cen_num, 
-                    covariance_type = 'tied', 
-                    means_init = self.gmm.means_,
-                    precisions_init = self.gmm.precisions_,
-                    n_init = 1,
-                ).fit(IQ_sorted_fin[idx_cen_int]).weights_
-
-                pops[idx_cen_int] = weights_new
+        return normalize_rows(counts)
 
-#                #### find probabilies for starting in state idx
-#                probs = self.gmm.predict_proba(IQ_sorted_fin[idx_cen_int])
-#                ### loop over final states
-#                for idx_cen_fin in range(self.cen_num):
-#                    pops[idx_cen_int][idx_cen_fin] = np.mean(
-#                        probs[:,idx_cen_fin])
-            
-            return pops
-        
     ### define function for finding the populations as a funciton of time
     def popVsTime(
         self,
@@ -884,6 +779,15 @@ class PS_Analysis:
         pop_vec = np.full([self.cen_num, self.cen_num, t_len], np.nan)
         pop_err_vec = np.full([self.cen_num, self.cen_num, t_len], np.nan)
 
+        ### without gaussian fits every time step is done at once
+        if not gaussFit and self.cluster_method in ['kmeans', 'None', 'gmm']:
+            pop_vec = np.moveaxis(self.popCountAll(), 0, -1)
+
+            self.pop_vec = pop_vec
+            self.pop_err_vec = pop_err_vec
+
+            return pop_vec
+
         ### loop over the times
         for idx_t in tqdm(range(t_len)):
             ### find the populations at each time step
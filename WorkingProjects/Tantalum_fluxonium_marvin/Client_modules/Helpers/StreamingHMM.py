@@ -0,0 +1,310 @@
+#### hidden markov model analysis of a continuous single shot record that is fed in blocks as they are acquired
+#### every shot is a gaussian blob in IQ for the hidden qubit state, the state jumps between shots with a transition
+#### matrix. a block is cut into chunks and each chunk is solved with vectorized scans (no python loop over shots):
+#### the forward and backward passes are prefix products of the per shot matrices A diag(b_t), done in log space,
+#### viterbi is the same in the max-plus semiring with a scan over the backpointer maps. the filtered state
+#### at the end of a chunk is carried into the next one, so nothing but the current block is held in memory.
+#### the emissions and transitions are learned online with stepwise EM from the statistics of every chunk.
+
+import time
+import numpy as np
+
+
+def _log_matmul(L1, L2):
+    #### log(exp(L1) @ exp(L2)), each factor is scaled by its largest entry so the product stays in range
+    m1 = np.max(L1, axis=(-2, -1), keepdims=True)
+    m2 = np.max(L2, axis=(-2, -1), keepdims=True)
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(L1 - m1) @ np.exp(L2 - m2)) + m1 + m2
+
+
+def _maxplus_matmul(L1, L2):
+    return np.max(L1[..., :, :, np.newaxis] + L2[..., np.newaxis, :, :], axis=-2)
+
+
+def _compose(a, b):
+    #### maps of states: (a o b)[x] = a[b[x]]
+    shape = np.broadcast_shapes(a.shape, b.shape)
+    return np.take_along_axis(np.broadcast_to(a, shape), np.broadcast_to(b, shape), axis=-1)
+
+
+def _scan(x, op, reverse=False, block=256):
+    """
+    inclusive scan along the first axis with an associative op(earlier, later).
+    reverse gives the suffix scan: out[t] = x[t] op x[t + 1] op ... op x[-1]
+    x is cut into blocks, the scan inside the blocks loops over the position in the block for all blocks at once,
+    then the total of the blocks before is put in front of every block, so there are about 2 * sqrt(len) vectorized
+    steps for any len.
+    """
+    if reverse:
+        return _scan(x[::-1], lambda a, b: op(b, a), block=block)[::-1]
+    T = len(x)
+    block = max(1, min(block, T))
+    num_blocks = -(-T // block)
+    #### pad the end with copies of the last element, their outputs are dropped
+    pad = num_blocks * block - T
+    y = np.concatenate([x, np.repeat(x[-1:], pad, axis=0)], axis=0) if pad else x.copy()
+    y = y.reshape((num_blocks, block) + x.shape[1:])
+
+    for idx in range(1, block):
+        y[:, idx] = op(y[:, idx - 1], y[:, idx])
+    if num_blocks > 1:
+        totals = y[:, -1].copy()
+        for idx in range(1, num_blocks - 1):
+            totals[idx] = op(totals[idx - 1][np.newaxis], totals[idx][np.newaxis])[0]
+        y[1:] = op(totals[:-1, np.newaxis], y[1:])
+    return y.reshape((num_blocks * block,) + x.shape[1:])[:T]
+
+
+def emission_loglik(I, Q, means, sigmas):
+    """
+    log density of every shot in every state, diagonal gaussians
+    I, Q: [T], means, sigmas: [K, 2]
+    returns: [T, K]
+    """
+    X = np.stack([I, Q], axis=-1)[:, np.newaxis, :]
+    z = (X - means) / sigmas
+    return -0.5 * np.sum(z ** 2, axis=-1) - np.sum(np.log(sigmas), axis=-1) - np.log(2 * np.pi)
+
+
+def forward_backward(logA, logb, log_alpha0):
+    """
+    logA: [K, K], logb: [T, K] emission log likelihoods, log_alpha0: [K] log state distribution before the first shot
+    returns: gamma [T, K] posterior state probabilities, xi [K, K] expected transition counts in the chunk,
+             log_alpha_end [K] normalized filtered distribution after the last shot, loglik of the chunk
+    """
+    M = logA[np.newaxis, :, :] + logb[:, np.newaxis, :] ### [T, K, K]
+    P = _scan(M, _log_matmul)
+    log_alpha = np.logaddexp.reduce(log_alpha0[np.newaxis, :, np.newaxis] + P, axis=1) ### [T, K]
+
+    #### beta_t[i] = log sum over the rest of the chunk, 0 after the last shot
+    log_beta = np.zeros_like(log_alpha)
+    if len(M) > 1:
+        S = _scan(M[1:], _log_matmul, reverse=True)
+        log_beta[:-1] = np.logaddexp.reduce(S, axis=2)
+
+    loglik = np.logaddexp.reduce(log_alpha[-1])
+    gamma = np.exp(log_alpha + log_beta - loglik)
+
+    #### xi summed over the chunk, including the step from the carried state into the first shot
+    log_prev = np.concatenate([log_alpha0[np.newaxis, :], log_alpha[:-1]], axis=0)
+    log_xi = log_prev[:, :, np.newaxis] + M + log_beta[:, np.newaxis, :] - loglik
+    xi = np.sum(np.exp(log_xi), axis=0)
+
+    return gamma, xi, log_alpha[-1] - loglik, loglik
+
+
+def viterbi(logA, logb, log_delta0):
+    """
+    most likely state path of the chunk given the carried scores log_delta0 [K]
+    returns: path [T], log_delta_end [K] scores after the last shot (shifted to max 0)
+    """
+    M = logA[np.newaxis, :, :] + logb[:, np.newaxis, :]
+    P = _scan(M, _maxplus_matmul)
+    log_delta = np.max(log_delta0[np.newaxis, :, np.newaxis] + P, axis=1) ### [T, K]
+
+    #### backpointers: psi_t[j] = best state before shot t when in j at t
+    log_prev = np.concatenate([log_delta0[np.newaxis, :], log_delta[:-1]], axis=0)
+    psi = np.argmax(log_prev[:, :, np.newaxis] + logA[np.newaxis, :, :], axis=1) ### [T, K]
+
+    #### state at t - 1 = (psi_t o psi_t+1 o ... o psi_T)(state at T), all at once with a suffix scan
+    last = np.argmax(log_delta[-1])
+    path = np.empty(len(logb), dtype=int)
+    path[-1] = last
+    if len(logb) > 1:
+        C = _scan(psi[1:], _compose, reverse=True)
+        path[:-1] = C[:, last]
+    return path, log_delta[-1] - np.max(log_delta[-1])
+
+
+class StreamingHMM:
+    """
+    Online gaussian HMM for a continuous single shot record.
+    n_states: number of qubit states, dt: time between shots (us), used for the rates
+    chunk_size: shots solved at once, the scans hold a few [chunk_size, K, K] arrays
+    learn: update the emissions and transitions with stepwise EM, with step (chunks seen + 2)^-step_power
+    The model is initialized from the first block unless means, sigmas and trans are given.
+    """
+    def __init__(self, n_states=2, dt=1.0, chunk_size=2 ** 16, learn=True, step_power=0.6,
+                 means=None, sigmas=None, trans=None):
+        self.n_states = n_states
+        self.dt = dt
+        self.chunk_size = chunk_size
+        self.learn = learn
+        self.step_power = step_power
+        self.means = None if means is None else np.asarray(means, dtype=float)
+        self.sigmas = None if sigmas is None else np.asarray(sigmas, dtype=float)
+        self.trans = None if trans is None else np.asarray(trans, dtype=float)
+
+        self.log_alpha = np.full(n_states, -np.log(n_states)) ### filtered state carried between chunks
+        self.log_delta = np.zeros(n_states) ### viterbi scores carried between chunks
+        self.stats = None ### running sufficient statistics, per shot
+        self.num_chunks = 0
+        self.num_shots = 0
+        self.loglik = 0.0
+
+        #### quantum jump statistics of the viterbi path
+        self.occupation = np.zeros(n_states)
+        self.jumps = np.zeros((n_states, n_states), dtype=int)
+        self.dwell_hist = [np.zeros(0, dtype=int) for i in range(n_states)] ### [state][dwell length in shots]
+        self.current_state = None
+        self.current_dwell = 0
+
+    def initialize(self, I, Q):
+        #### blobs from a 1d k-means along the principal axis of the IQ cloud
+        X = np.stack([I, Q], axis=-1)
+        center = np.mean(X, axis=0)
+        axis = np.linalg.svd(X - center, full_matrices=False)[2][0]
+        proj = (X - center) @ axis
+        levels = np.quantile(proj, (np.arange(self.n_states) + 0.5) / self.n_states)
+        for iteration in range(20):
+            labels = np.argmin(np.abs(proj[:, np.newaxis] - levels), axis=1)
+            levels = np.array([np.mean(proj[labels == k]) if np.any(labels == k) else levels[k]
+                               for k in range(self.n_states)])
+        #### state 0 is the most occupied blob
+        order = np.argsort(-np.bincount(labels, minlength=self.n_states), kind='stable')
+        labels = np.argsort(order)[labels]
+        if self.means is None:
+            self.means = np.array([np.mean(X[labels == k], axis=0) for k in range(self.n_states)])
+        if self.sigmas is None:
+            self.sigmas = np.array([np.std(X[labels == k], axis=0) + 1e-12 for k in range(self.n_states)])
+        if self.trans is None:
+            self.trans = np.full((self.n_states, self.n_states), 0.01 / max(1, self.n_states - 1))
+            np.fill_diagonal(self.trans, 0.99)
+
+    def process(self, I, Q):
+        """
+        add one block of shots, returns the viterbi path and posterior occupation of the block
+        """
+        I = np.ravel(np.asarray(I, dtype=float))
+        Q = np.ravel(np.asarray(Q, dtype=float))
+        if self.means is None or self.sigmas is None or self.trans is None:
+            self.initialize(I, Q)
+
+        paths = []
+        gamma_sum = np.zeros(self.n_states)
+        for start in range(0, len(I), self.chunk_size):
+            path, gamma = self._process_chunk(I[start:start + self.chunk_size], Q[start:start + self.chunk_size])
+            paths.append(path)
+            gamma_sum += np.sum(gamma, axis=0)
+        path = np.concatenate(paths) if paths else np.zeros(0, dtype=int)
+        return {'path': path, 'occupation': gamma_sum / max(1, len(I))}
+
+    def _process_chunk(self, I, Q):
+        logA = np.log(self.trans)
+        logb = emission_loglik(I, Q, self.means, self.sigmas)
+
+        gamma, xi, self.log_alpha, loglik = forward_backward(logA, logb, self.log_alpha)
+        path, self.log_delta = viterbi(logA, logb, self.log_delta)
+        self.loglik += loglik
+        self.num_shots += len(I)
+        self._count_jumps(path)
+
+        if self.learn:
+            self._em_step(I, Q, gamma, xi)
+        return path, gamma
+
+    def _em_step(self, I, Q, gamma, xi):
+        #### statistics of the chunk per shot, mixed into the running ones with a decreasing step
+        n = len(I)
+        X = np.stack([I, Q], axis=-1)
+        chunk = {'n': np.sum(gamma, axis=0) / n,
+                 'x': gamma.T @ X / n,
+                 'xx': gamma.T @ X ** 2 / n,
+                 'xi': xi / n}
+        step = (self.num_chunks + 2) ** -self.step_power
+        if self.stats is None:
+            self.stats = chunk
+        else:
+            self.stats = {key: (1 - step) * self.stats[key] + step * chunk[key] for key in self.stats}
+        self.num_chunks += 1
+
+        occupied = self.stats['n'] > 1e-9
+        means = self.stats['x'][occupied] / self.stats['n'][occupied, np.newaxis]
+        var = self.stats['xx'][occupied] / self.stats['n'][occupied, np.newaxis] - means ** 2
+        self.means[occupied] = means
+        self.sigmas[occupied] = np.sqrt(np.maximum(var, 1e-12))
+        rows = np.sum(self.stats['xi'], axis=1, keepdims=True)
+        trans = np.where(rows > 0, self.stats['xi'] / np.where(rows > 0, rows, 1), self.trans)
+        self.trans = np.maximum(trans, 1e-12)
+        self.trans /= np.sum(self.trans, axis=1, keepdims=True)
+
+    def _count_jumps(self, path):
+        #### jumps and dwell times of the path, a dwell that runs over the chunk edge is carried on
+        self.occupation += np.bincount(path, minlength=self.n_states)
+        if self.current_state is not None:
+            path = np.concatenate([[self.current_state], path])
+            self.current_dwell -= 1 ### the carried shot was already counted
+        edges = np.flatnonzero(np.diff(path)) + 1
+        np.add.at(self.jumps, (path[edges - 1], path[edges]), 1)
+
+        starts = np.concatenate([[0], edges])
+        lengths = np.diff(np.concatenate([starts, [len(path)]]))
+        lengths[0] += self.current_dwell
+        for state, length in zip(path[starts[:-1]], lengths[:-1]):
+            hist = self.dwell_hist[state]
+            if length >= len(hist):
+                hist = np.concatenate([hist, np.zeros(length + 1 - len(hist), dtype=int)])
+            hist[length] += 1
+            self.dwell_hist[state] = hist
+        self.current_state = path[-1]
+        self.current_dwell = lengths[-1]
+
+    def summary(self):
+        """
+        rates[i][j]: rate (1/us) of jumps from i to j from the learned transitions, lifetimes (us) of every state,
+        jump_rates from the counted viterbi jumps, mean_dwell (us) over the finished dwells
+        """
+        rates = self.trans / self.dt
+        np.fill_diagonal(rates, 0)
+        counted = self.jumps / np.maximum(self.occupation[:, np.newaxis], 1) / self.dt
+        mean_dwell = np.array([np.sum(np.arange(len(h)) * h) / np.sum(h) if np.sum(h) > 0 else np.nan
+                               for h in self.dwell_hist]) * self.dt
+        return {'means': self.means.copy(), 'sigmas': self.sigmas.copy(), 'trans': self.trans.copy(),
+                'rates': rates, 'lifetimes': self.dt / (1 - np.diag(self.trans)),
+                'jump_rates': counted, 'jumps': self.jumps.copy(), 'mean_dwell': mean_dwell,
+                'occupation': self.occupation / max(1, self.num_shots), 'num_shots': self.num_shots,
+                'loglik_per_shot': self.loglik / max(1, self.num_shots)}
+
+
+def simulate_record(num_shots, trans, means, sigmas, seed=None, state0=0):
+    """ a telegraph record: markov chain of states with gaussian IQ blobs, returns I, Q, states """
+    rng = np.random.default_rng(seed)
+    trans = np.asarray(trans, dtype=float)
+    cum = np.cumsum(trans, axis=1)
+    u = rng.random(num_shots)
+    states = np.empty(num_shots, dtype=int)
+    state = state0
+    for idx in range(num_shots):
+        state = min(np.searchsorted(cum[state], u[idx], side='right'), len(trans) - 1)
+        states[idx] = state
+    means = np.asarray(means, dtype=float)[states]
+    sigmas = np.asarray(sigmas, dtype=float)[states]
+    X = means + sigmas * rng.standard_normal((num_shots, 2))
+    return X[:, 0], X[:, 1], states
+
+
+def benchmark(num_shots=10 ** 6, block=2 ** 18, seed=0):
+    """ learn a two state record block by block from a wrong start and compare with the truth """
+    trans = np.array([[0.998, 0.002], [0.005, 0.995]])
+    means = np.array([[0.0, 0.0], [3.0, 1.0]])
+    sigmas = np.array([[1.0, 1.0], [1.1, 0.9]])
+    I, Q, states = simulate_record(num_shots, trans, means, sigmas, seed=seed)
+
+    hmm = StreamingHMM(n_states=2, dt=1.0)
+    start = time.time()
+    errors = 0
+    for idx in range(0, num_shots, block):
+        result = hmm.process(I[idx:idx + block], Q[idx:idx + block])
+        errors += np.sum(result['path'] != states[idx:idx + block])
+    t_total = time.time() - start
+    summary = hmm.summary()
+    print(str(num_shots) + ' shots in ' + str(round(t_total, 2)) + ' s, ' + str(round(num_shots / t_total / 1e6, 2))
+          + ' M shots/s, viterbi error ' + str(errors / num_shots))
+    print('transitions\n' + str(np.round(summary['trans'], 4)) + '\ntrue\n' + str(trans))
+    print('means\n' + str(np.round(summary['means'], 3)))
+    return summary
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -12,9 +12,16 @@ import numpy as np
 
 class Lakeshore370:
     ### class for controlling the lakeshore 370 model
-    def __init__(self, connect_address):
+    def __init__(self, connect_address, retry_interval=0.1, stabilizer=None):
         ### set the lakeshore object
         self.LS370 = connect_address
+        self.id_string = None
+        self.retry_interval = retry_interval ### wait before retrying a query that failed or returned the identity
+
+        #### decides when the temperature has settled in set_temp, see TempStabilizer
+        if stabilizer is None:
+            stabilizer = TempStabilizer()
+        self.stabilizer = stabilizer
 
         self.LS370.timeout = 50000
 
@@ -41,6 +48,26 @@ class Lakeshore370:
               str(self.get_temp(7)) + ' K, \n'
               )
 
+    def _query(self, command):
+        #### the 370 sometimes answers a query with its identity string or times out, ask again until it answers
+        while (True):
+            try:
+                answer = self.LS370.query(command).rstrip()
+
+                if answer != self.id_string:
+                    return answer
+            except:
+                pass
+            time.sleep(self.retry_interval)
+
+    def _write(self, command):
+        while (True):
+            try:
+                self.LS370.write(command)
+                return
+            except:
+                time.sleep(self.retry_interval)
+
     def clear_interface(self):
         """ Clears the interface -- does NOT reset the instrument"""
         self.LS370.write('CLS')
@@ -55,17 +82,7 @@ class Lakeshore370:
         2 is zone tuning
         3 is open loop
         4 is off """
-        while (True):
-            try:
-                mode = self.LS370.query('CMODE?').rstrip()
-
-                if mode != self.id_string:
-                    return mode
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query('CMODE?')
 
     def set_temp_control_mode(self, n):
         """Sets the temperature control mode of the instrument.
@@ -80,17 +97,7 @@ class Lakeshore370:
 
     def get_heater_output(self):
         """Returns the heater output in percent."""
-        while (True):
-            try:
-                output = self.LS370.query('HTR?').rstrip()
-
-                if output != self.id_string:
-                    return output
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query('HTR?')
 
     def get_heater_range(self):
         """Returns the range of the heater.
@@ -103,17 +110,7 @@ class Lakeshore370:
         6 is 10 mA
         7 is 31.6 mA
         8 is 100 mA."""
-        while (True):
-            try:
-                heater_range = self.LS370.query('HTRRNG?').rstrip()
-
-                if heater_range != self.id_string:
-                    return heater_range
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query('HTRRNG?')
 
     def set_heater_range(self, n):
         """Sets the range of the heater.
@@ -130,12 +127,7 @@ class Lakeshore370:
             print('n must be 0, 1, 2, 3, 4, 5, 6, 7, or 8.')
             return
 
-        while (True):
-            try:
-                self.LS370.write('HTRRNG ' + str(n))
-                return
-            except:
-                time.sleep(1)
+        self._write('HTRRNG ' + str(n))
 
     def heater_status(self):
         """Returns the status ofthe heater:
@@ -145,17 +137,7 @@ class Lakeshore370:
 
     def get_min_max(self, n):
         """Returns the min and max data recorded on channel n."""
-        while (True):
-            try:
-                min_max = self.LS370.query('MDAT? ' + str(n)).rstrip()
-
-                if min_max != self.id_string:
-                    return min_max
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query('MDAT? ' + str(n))
 
     def reset_min_max(self):
         """Resets the min and max data for all channels."""
@@ -167,34 +149,15 @@ class Lakeshore370:
 
     def get_manual_heater_output(self):
         """Returns the manual heater output."""
-        while (True):
-            try:
-                output = self.LS370.query('MOUT?').rstrip()
-
-                if output != self.id_string:
-                    return output
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query('MOUT?')
 
     def get_ramp(self):
         """Returns the setpoint ramp parameters.
         First parameter: 0 if off, 1 if on
         Second parameter: ramp rate in K per min."""
 
-        while (True):
-            try:
-                outp = self.LS370.query('RAMP?').rstrip().split(',')
-
-                if outp != 'LSCI,MODEL370,370AF8,04102008':
-                    return [int(outp[0]), float(outp[1])]
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        outp = self._query('RAMP?').split(',')
+        return [int(outp[0]), float(outp[1])]
 
     def set_ramp(self, o, r):
         """Sets the setpoint ramp parameters.
@@ -215,71 +178,26 @@ class Lakeshore370:
 
     def get_temp(self, chan):
         """Returns the temperature in K of channel chan."""
-        while (True):
-            try:
-                temp = self.LS370.query('RDGK? ' + str(chan)).rstrip()
-
-                if temp != self.id_string:
-                    return temp
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query('RDGK? ' + str(chan))
 
     def get_controlsetup(self):
         """ returns the control settings for the different channels """
 
-        while (True):
-            try:
-                setup = self.LS370.query("CSET?")
-
-                if setup != self.id_string:
-                    return setup
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query("CSET?")
 
     def get_setpoint(self):
         """Returns the temperature control setpoint in the control units (likely K)."""
-        while (True):
-            try:
-                setpoint = self.LS370.query('SETP?').rstrip()
-
-                if setpoint != self.id_string:
-                    return setpoint
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query('SETP?')
 
     def set_setpoint(self, s):
         """Sets the temperature control setpoint in the control units."""
         s = s * 1e-3  ### convert to mK
 
-        while (True):
-            try:
-                self.LS370.write('SETP ' + str(s))
-                return
-            except:
-                time.sleep(1)
+        self._write('SETP ' + str(s))
 
     def get_scan(self):
         """ check for which channel is being scanned """
-        while (True):
-            try:
-                scan = self.LS370.query("SCAN?")
-
-                if scan != self.id_string:
-                    return scan
-                else:
-                    time.sleep(1)
-
-            except:
-                time.sleep(1)
+        return self._query("SCAN?")
 
     def set_scan(self, n, auto):
         """ sets the channel being scanned and toggles autoscan """
@@ -290,56 +208,218 @@ class Lakeshore370:
             print('auto must be 0 (autoscan off) or 1 (autoscan on)')
             return
 
-        while (True):
-            try:
-                self.LS370.write('SCAN ' + str(n) + ', ' + str(auto))
-                return
-            except:
-                time.sleep(1)
+        self._write('SCAN ' + str(n) + ', ' + str(auto))
 
     ### define function to set temperature and wait to stabilize
-    def set_temp(self, temperature, heater_range=4):
-
+    def set_temp(self, temperature, heater_range=4, chan=7, while_waiting=None, retry_wait=300):
+        """
+        Sets the setpoint (mK) and returns as soon as the temperature of channel chan has settled on it, as decided
+        by self.stabilizer. while_waiting is called between temperature reads, e.g. to take a spec slice while the
+        fridge settles. If the temperature does not settle before the stabilizer timeout the heater is turned off
+        for retry_wait seconds and the setpoint is tried again.
+        returns the result of TempStabilizer.wait
+        """
         print("setting temperature: " + str(temperature) + " mK")
 
-        #### set heater setting, if below 10 turn heater off
-        if temperature <= 10:
-            self.set_heater_range(0)
-        else:
-            self.set_heater_range(heater_range)
-
-        #### set the temperature point
-        self.set_setpoint(temperature)
-
-        ### wait 15s initially
-        time.sleep(15)
-
-        idx = 0
         while (True):
-            idx += 1
-            print('current temp: ' + str(self.get_temp(7)) + ' K')
-            time.sleep(30)
+            #### set heater setting, if below 10 turn heater off
+            if temperature <= 10:
+                self.set_heater_range(0)
+            else:
+                self.set_heater_range(heater_range)
 
-            if np.abs(float(self.get_temp(7)) - temperature * 1e-3) < 0.001:
+            #### set the temperature point
+            self.set_setpoint(temperature)
 
-                print('almost there! \n current temp: ' + str(self.get_temp(7)))
-                time.sleep(60)
-                temp_diff = np.abs(float(self.get_temp(7)) - temperature * 1e-3)
-                if temp_diff < 0.001:
-                    print('congrats! \n current temp: ' + str(self.get_temp(7)))
-                    break
-                else:
-                    continue
+            result = self.stabilizer.wait(lambda: float(self.get_temp(chan)), temperature * 1e-3,
+                                          while_waiting=while_waiting)
+            if result['settled']:
+                print('congrats! \n current temp: ' + str(result['temps'][-1]) + ' K, settled in '
+                      + str(round(result['elapsed'])) + ' s')
+                return result
 
-            #### if 15 minutes have paused turn the temp to 0
-            if idx >= 30:
-                ### set temp to 9mK and turn off heater
-                self.set_setpoint(9)
-
-                self.set_heater_range(0)
-                print('temp not reached, turnning off heater and trying again')
-                time.sleep(300)
-                ### turn the heater back on
-                self.set_heater_range(heater_range)
-                idx = 0
+            ### set temp to 9mK and turn off heater
+            self.set_setpoint(9)
 
+            self.set_heater_range(0)
+            print('temp not reached, turnning off heater and trying again')
+            self.stabilizer.sleep(retry_wait)
+
+
+class TempStabilizer:
+    """
+    Waits for a temperature to settle. The temperature is read every poll_interval seconds and it has settled once
+    the reads of the last window seconds
+        - have a mean within tolerance (K) of the target,
+        - drift by less than max_drift (K) over the window, from a linear fit,
+        - have a standard deviation below max_std (K).
+    clock and sleep default to the wall clock, a simulated fridge passes its own so a run takes no real time.
+    """
+    def __init__(self, poll_interval=2, window=60, tolerance=1e-3, max_drift=0.5e-3, max_std=0.5e-3, timeout=900,
+                 clock=time.time, sleep=time.sleep):
+        self.poll_interval = poll_interval
+        self.window = window
+        self.tolerance = tolerance
+        self.max_drift = max_drift
+        self.max_std = max_std
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+
+    def is_settled(self, times, temps, target):
+        times = np.asarray(times)
+        temps = np.asarray(temps)
+        sel = times >= times[-1] - self.window
+        if times[-1] - times[0] < self.window or np.sum(sel) < 3:
+            return False
+        times = times[sel]
+        temps = temps[sel]
+        if np.abs(np.mean(temps) - target) > self.tolerance or np.std(temps) > self.max_std:
+            return False
+        slope = np.polyfit(times - times[0], temps, 1)[0]
+        return np.abs(slope) * self.window < self.max_drift
+
+    def wait(self, get_temp, target, while_waiting=None):
+        """
+        get_temp: function returning the temperature in K, target: K
+        while_waiting: function called between reads while the temperature is not settled, its return values are
+        collected in results. A read is taken right after each call. Settling needs at least 3 reads in the window, so
+        once a call takes longer than window / 3 it is skipped while the latest read is within tolerance of the
+        target, and the temperature is polled every poll_interval until it settles or moves away again.
+        returns: dict with settled, elapsed (s), times (s from the start), temps (K), results
+        """
+        start = self.clock()
+        times = []
+        temps = []
+        results = []
+        next_read = start
+        slow = False ### the last while_waiting call took too long to leave 3 reads in the window
+        while (True):
+            now = self.clock()
+            times.append(now - start)
+            temps.append(get_temp())
+            if self.is_settled(times, temps, target):
+                return {'settled': True, 'elapsed': now - start, 'times': times, 'temps': temps, 'results': results}
+            if now - start > self.timeout:
+                return {'settled': False, 'elapsed': now - start, 'times': times, 'temps': temps, 'results': results}
+
+            next_read += self.poll_interval
+            if while_waiting is not None and not (slow and np.abs(temps[-1] - target) <= self.tolerance):
+                t_call = self.clock()
+                results.append(while_waiting())
+                slow = self.clock() - t_call > self.window / 3
+            self.sleep(max(0, next_read - self.clock()))
+            next_read = max(next_read, self.clock())
+
+
+class SimulatedLS370Resource:
+    """
+    Stand in for the pyvisa resource of the 370 with a simple thermal model of the mixing chamber, to test the
+    temperature sweeps without the fridge. Time is simulated: sleep advances the clock instead of waiting.
+    The setpoint is ramped at the ramp rate, the temperature relaxes to it with time constant tau (s) when the
+    heater is on and to base (K) when it is off, and every read has gaussian noise of noise (K).
+    """
+    def __init__(self, base=0.009, tau=120, noise=50e-6, query_time=0.05, seed=None):
+        self.base = base
+        self.tau = tau
+        self.noise = noise
+        self.query_time = query_time ### simulated time a GPIB query takes
+        self.rng = np.random.default_rng(seed)
+        self.t = 0.0
+        self.temp = base
+        self.setpoint = base
+        self.ramp_setpoint = base
+        self.ramp = [1, 0.05]
+        self.heater_range = 0
+        self.cmode = 1
+        self.timeout = 0
+
+    def time(self):
+        return self.t
+
+    def sleep(self, dt):
+        #### integrate the model in steps of at most 1 s
+        while dt > 0:
+            step = min(dt, 1.0)
+            if self.ramp[0] == 1:
+                max_move = self.ramp[1] / 60 * step
+                self.ramp_setpoint += np.clip(self.setpoint - self.ramp_setpoint, -max_move, max_move)
+            else:
+                self.ramp_setpoint = self.setpoint
+            goal = max(self.ramp_setpoint, self.base) if self.heater_range > 0 else self.base
+            self.temp += (goal - self.temp) * (1 - np.exp(-step / self.tau))
+            self.t += step
+            dt -= step
+
+    def write(self, command):
+        self.sleep(self.query_time)
+        name, _, args = command.strip().partition(' ')
+        if name == 'SETP':
+            self.setpoint = float(args)
+        elif name == 'HTRRNG':
+            self.heater_range = int(args)
+        elif name == 'RAMP':
+            self.ramp = [int(args.split(',')[0]), float(args.split(',')[1])]
+        elif name == 'CMODE':
+            self.cmode = int(args)
+
+    def query(self, command):
+        self.sleep(self.query_time)
+        name, _, args = command.strip().partition(' ')
+        if name == 'RDGK?':
+            if args.strip() == '7':
+                return '%.6E\n' % (self.temp + self.noise * self.rng.standard_normal())
+            return '%.6E\n' % 4.0
+        answers = {'IDN?': 'LSCI,MODEL370,SIMULATED,0', 'CMODE?': str(self.cmode), 'HTRRNG?': str(self.heater_range),
+                   'SETP?': '%.6E' % self.setpoint, 'RAMP?': str(self.ramp[0]) + ',' + str(self.ramp[1]),
+                   'RAMPST?': str(int(self.ramp_setpoint != self.setpoint)), 'HTR?': '0', 'HTRST?': '0'}
+        return answers.get(name, '0') + '\n'
+
+
+def check_slow_callback(durations=(10, 29, 31, 35, 50), temperature=30, seed=0):
+    """
+    simulated set_temp with a while_waiting that takes durations[i] seconds (e.g. a full spec slice), every one has
+    to settle before the stabilizer timeout
+    """
+    for duration in durations:
+        resource = SimulatedLS370Resource(seed=seed)
+        Lakeshore = Lakeshore370(resource, stabilizer=TempStabilizer(clock=resource.time, sleep=resource.sleep))
+        result = Lakeshore.set_temp(temperature, while_waiting=lambda: resource.sleep(duration))
+        print(str(duration) + ' s callback: settled after ' + str(round(resource.time())) + ' s, '
+              + str(len(result['results'])) + ' calls')
+        assert resource.time() < Lakeshore.stabilizer.timeout, str(duration) + ' s callback did not settle'
+
+
+def benchmark(temp_vec=None, seed=0):
+    """
+    simulated time of a temperature sweep waiting with the fixed sleeps used before (set_temp polling every 30 s
+    and confirming after 60 s, then 60 s more before measuring) and with the settle detection
+    """
+    if temp_vec is None:
+        temp_vec = [15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 55, 50, 45, 40, 35, 30, 25, 20, 15, 10] * 4
+
+    resource = SimulatedLS370Resource(seed=seed)
+    Lakeshore = Lakeshore370(resource)
+    start = resource.time()
+    for temperature in temp_vec:
+        Lakeshore.set_heater_range(0 if temperature <= 10 else 4)
+        Lakeshore.set_setpoint(temperature)
+        resource.sleep(15)
+        while (True):
+            resource.sleep(30)
+            if np.abs(float(Lakeshore.get_temp(7)) - temperature * 1e-3) < 0.001:
+                resource.sleep(60)
+                if np.abs(float(Lakeshore.get_temp(7)) - temperature * 1e-3) < 0.001:
+                    break
+        resource.sleep(60)
+    t_fixed = resource.time() - start
+
+    resource = SimulatedLS370Resource(seed=seed)
+    Lakeshore = Lakeshore370(resource, stabilizer=TempStabilizer(clock=resource.time, sleep=resource.sleep))
+    start = resource.time()
+    for temperature in temp_vec:
+        Lakeshore.set_temp(temperature)
+    t_settle = resource.time() - start
+
+    print('fixed sleeps: ' + str(round(t_fixed / 60)) + ' min, settle detection: ' + str(round(t_settle / 60))
+          + ' min for ' + str(len(temp_vec)) + ' setpoints')
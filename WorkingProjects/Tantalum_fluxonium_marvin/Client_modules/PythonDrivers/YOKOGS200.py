@@ -2,6 +2,7 @@ import sys
 import pyvisa as visa
 import numpy as np
 import time
+import threading
 
 class YOKOGS200:
     _rampstep = 0.001 #0.0001 #0.001 # increment step when setting voltage/current
@@ -17,37 +18,77 @@ class YOKOGS200:
                     %VISAaddress)
             sys.exit()
 
+        #### background ramp, only one runs at a time and every other access to the session waits for it
+        self._ramp_thread = None
+        self._ramp_error = None
+        self._lock = threading.RLock()
+
     #==========================================================================#
 
     # Turn on output
     def OutputOn(self):
-        self.session.write('OUTPut 1')
+        with self._lock:
+            self.session.write('OUTPut 1')
 
     # Turn off output
     def OutputOff(self):
+        self.WaitForRamp()
         self.session.write('OUTPut 0')
 
     #==========================================================================#
 
     # Ramp up the voltage (volts) in increments of _rampstep, waiting _rampinterval
-    # between each increment.
+    # between each increment. Blocks until the ramp is done.
     def SetVoltage(self, voltage, toPrint = True):
-        start = self.GetVoltage()
-        stop = voltage
-        steps = max(1, round(abs(stop-start)/self._rampstep))
-        tempvolts = np.linspace(start, stop, num=steps+1, endpoint=True)
-        # print(tempvolts)
-        self.OutputOn()
-        for tempvolt in tempvolts:
-            self.session.write(':SOURce:LEVel:AUTO %.8f' %tempvolt)
-            time.sleep(self._rampinterval)
+        self.SetVoltageAsync(voltage)
+        self.WaitForRamp()
 
         if toPrint:
             print("Yoko Voltage set to ", str(voltage), " V")
 
+    # Start the same ramp in a background thread and return right away, so the ramp can run while the
+    # previous point is analysed or plotted. A ramp that is still running is finished first.
+    # The ramp starts from the level read back from the source, other sessions (another YOKOGS200 on the same
+    # address, the front panel) may have changed it since this one last wrote
+    def SetVoltageAsync(self, voltage):
+        self.WaitForRamp()
+        start = self.GetVoltage()
+        steps = max(1, round(abs(voltage-start)/self._rampstep))
+        tempvolts = np.linspace(start, voltage, num=steps+1, endpoint=True)
+        self.OutputOn()
+        self._ramp_thread = threading.Thread(target=self._ramp, args=(tempvolts,), daemon=True)
+        self._ramp_thread.start()
+
+    # True while a background ramp is running
+    def IsRamping(self):
+        return self._ramp_thread is not None and self._ramp_thread.is_alive()
+
+    # Wait for a background ramp to finish, raises the error of the ramp if it failed
+    def WaitForRamp(self):
+        if self._ramp_thread is not None:
+            self._ramp_thread.join()
+            self._ramp_thread = None
+        if self._ramp_error is not None:
+            error, self._ramp_error = self._ramp_error, None
+            raise error
+
+    def _ramp(self, tempvolts):
+        #### every write is followed by a wait until _rampinterval after its start, so the time spent writing is not
+        #### added on top of _rampinterval. a late write (stall) pushes the following ones back instead of being
+        #### caught up, the ramp rate never exceeds _rampstep per _rampinterval
+        try:
+            for tempvolt in tempvolts:
+                with self._lock:
+                    t_write = time.time()
+                    self.session.write(':SOURce:LEVel:AUTO %.8f' %tempvolt)
+                time.sleep(max(0, t_write + self._rampinterval - time.time()))
+        except Exception as ex:
+            self._ramp_error = ex
+
     # Ramp up the current (amps) in increments of _rampstep, waiting _rampinterval
     # between each increment.
     def SetCurrent(self, current):
+        self.WaitForRamp()
         start = self.GetCurrent()
         stop = current
         steps = max(1, round(abs(stop-start)/self._rampstep))
@@ -61,19 +102,23 @@ class YOKOGS200:
         if not (mode == 'voltage' or mode == 'current'):
             sys.stderr.write("Unknown output mode %s." %mode)
             return
+        self.WaitForRamp()
         self.session.write('SOURce:FUNCtion %s' %mode)
 
     #==========================================================================#
 
     # Returns the voltage in volts as a float
     def GetVoltage(self):
-        self.session.write('SOURce:FUNCtion VOLTage')
-        self.session.write('SOURce:LEVel?')
-        result = self.session.read()
+        self.WaitForRamp()
+        with self._lock:
+            self.session.write('SOURce:FUNCtion VOLTage')
+            self.session.write('SOURce:LEVel?')
+            result = self.session.read()
         return float(result.rstrip('\n'))
 
     # Returns the current in amps as a float
     def GetCurrent(self):
+        self.WaitForRamp()
         self.session.write('SOURce:FUNCtion CURRent')
         self.session.write('SOURce:LEVel?')
         result = self.session.read()
@@ -81,6 +126,7 @@ class YOKOGS200:
 
     # Returns the mode (voltage or current)
     def GetMode(self):
+        self.WaitForRamp()
         self.session.write('SOURce:FUNCtion?')
         result = self.session.read()
         result = result.rstrip('\n')
@@ -89,6 +135,51 @@ class YOKOGS200:
 
     #==========================================================================#
 
+
+#### stand in for a pyvisa resource manager and a GS200 session, answers the commands used above so the driver
+#### and the flux sweeps can be run without the instrument, e.g.
+####     yoko1 = YOKOGS200(VISAaddress='GPIB1::2::INSTR', rm=SimulatedResourceManager())
+class SimulatedYOKOResource:
+    def __init__(self, VISAaddress, write_delay = 0.0):
+        self.VISAaddress = VISAaddress
+        self.write_delay = write_delay ### time a write takes, to mimic the bus
+        self.mode = 'VOLT'
+        self.level = {'VOLT': 0.0, 'CURR': 0.0}
+        self.output = False
+        self.history = [] ### every level written, in order
+        self._reply = None
+
+    def write(self, command):
+        time.sleep(self.write_delay)
+        command = command.strip()
+        name = command.split(' ')[0].upper()
+        if name.startswith('OUTP'):
+            self.output = command.split(' ')[1] == '1'
+        elif name.startswith('SOUR:FUNC') or name.startswith('SOURCE:FUNC'):
+            if name.endswith('?'):
+                self._reply = self.mode + '\n'
+            else:
+                self.mode = 'VOLT' if command.split(' ')[1].upper().startswith('VOLT') else 'CURR'
+        elif name.startswith(':SOUR:LEV') or name.startswith(':SOURCE:LEV'):
+            self.level[self.mode] = float(command.split(' ')[1])
+            self.history.append(self.level[self.mode])
+        elif name.startswith('SOUR:LEV') or name.startswith('SOURCE:LEV'):
+            self._reply = '%.8E\n' % self.level[self.mode]
+
+    def read(self):
+        reply, self._reply = self._reply, None
+        return reply
+
+class SimulatedResourceManager:
+    def __init__(self, write_delay = 0.0):
+        self.write_delay = write_delay
+        self.resources = {}
+
+    def open_resource(self, VISAaddress):
+        if VISAaddress not in self.resources:
+            self.resources[VISAaddress] = SimulatedYOKOResource(VISAaddress, write_delay=self.write_delay)
+        return self.resources[VISAaddress]
+
 # def main(i):
 #     rm = visa.ResourceManager()
 #     # VISAaddress = 'GPIB2::2::INSTR'